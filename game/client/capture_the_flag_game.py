@@ -1,4 +1,5 @@
 import sys
+import time
 import pygame
 import pygame_gui
 from game_client import GameClient
@@ -9,20 +10,29 @@ class CaptureTheFlagGame:
     # - Initializes the network client (or creates one if none provided)
     # - Creates a GameRenderer for visuals
     # - Sets the game loop to running
-    # - Stores the player's ID
-    def __init__(self, game_client = None, player_id = None):
+    # - Stores the player's ID, and the Profiler F9 starts a capture with, if any
+    def __init__(self, game_client = None, player_id = None, profiler = None):
         self.game_client = game_client or GameClient()
-        self.renderer = GameRenderer()
+        # The camera shows the area the server sends us state for, if it only sends part of the map.
+        view_radius = self.game_client.view_radius
+        self.renderer = GameRenderer(grid_size=self.game_client.grid_size, bases=self.game_client.bases,
+                                     view_cells=2 * view_radius + 1 if view_radius else None)
         self.running = True
         self.player_id = player_id
+        self.profiler = profiler
 
-    # Ensures the player ID is valid (between 0 and 3).
-    # If it’s not already set, prompts the user to input their ID (1-4), 
+    # Ensures the player ID is valid (a slot in the room's lobby).
+    # A spectator watching through a spectator relay has no slot (its lobby_init has no player id), so it
+    # just watches. Otherwise, if it’s not already set, prompts the user to input their ID (1 to the lobby size), 
     # then converts it to 0-indexed.
     def choose_player(self):
-        while self.player_id not in [0, 1, 2, 3]:
+        if self.game_client.lobby_state["player_id"] is None:
+            self.player_id = None
+            return
+        slots = len(self.game_client.lobby_state["players"])
+        while self.player_id not in range(slots):
             try:
-                one_indexed = int(input("Enter your player ID (1-4): "))
+                one_indexed = int(input(f"Enter your player ID (1-{slots}): "))
                 self.player_id = one_indexed - 1
             except ValueError:
                 continue
@@ -30,11 +40,16 @@ class CaptureTheFlagGame:
     # Handles Pygame events:
     # Quits the game if the window is closed
     # Detects movement input (W, A, S, D) and sends it to the server using the network client
+    # F9 starts a profile capture (see profiler.py)
     def process_events(self):
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 self.running = False
             elif event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_F9 and self.profiler is not None:
+                    if self.profiler.start():
+                        print(f"Profiling into {self.profiler.directory}/")
+                    continue
                 dx, dy = 0, 0
                 if event.key == pygame.K_w:
                     dy = -1
@@ -44,7 +59,7 @@ class CaptureTheFlagGame:
                     dx = -1
                 elif event.key == pygame.K_d:
                     dx = 1
-                if dx != 0 or dy != 0:
+                if (dx != 0 or dy != 0) and self.player_id is not None:
                     self.game_client.send_input(self.player_id, dx, dy)
 
     # Main game loop:
@@ -52,13 +67,16 @@ class CaptureTheFlagGame:
     # Starts the network listener (if not already running)
     # Loops while the game is active:
     # - Processes user input
-    # - Gets game state from the server
-    # - Renders players and flag with GameRenderer
+    # - Reads the latest game state snapshot, without locking; if its revision is the one already on screen and
+    #   every player has finished gliding, the frame is skipped
+    # - Otherwise draws it with GameRenderer, with our own moves predicted and other players interpolated
     def run(self):
         self.choose_player() 
         if not self.game_client.listening:
             self.game_client.start_listener()
 
+        drawn_revision = None
+        settled = False
         while self.running:
             self.process_events()
 
@@ -67,10 +85,15 @@ class CaptureTheFlagGame:
                 self.show_server_down_alert()
                 break
             
-            state = self.game_client.get_state()
-            players = state.get("players", [])
-            flag_pos = state.get("flag", (self.renderer.grid_size // 2, self.renderer.grid_size // 2))
-            self.renderer.render(players, flag_pos)
+            snapshot = self.game_client.get_state()
+            now = time.perf_counter()
+            if snapshot.revision == drawn_revision and settled and not self.renderer.needs_full_redraw:
+                self.renderer.idle()
+                continue
+            players, flag_pos = self.game_client.get_predicted_state(snapshot, now)
+            self.renderer.render(players, flag_pos, snapshot.flag_carried, focus=snapshot.predicted_pos)
+            drawn_revision = snapshot.revision
+            settled = snapshot.glide.finished(now)
 
         self.cleanup()
 
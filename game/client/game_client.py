@@ -2,29 +2,95 @@ import sys
 import queue
 import socket
 import threading
+import time
 import json
 import tkinter as tk
+from collections import deque, namedtuple
 from tkinter import messagebox
+from types import MappingProxyType
+from compression import SUPPORTED_COMPRESSIONS, InflatingReader
+from protocol import JSON, SUPPORTED_PROTOCOLS, ProtocolError, encode, read_message
+from prediction import Glide, replay_inputs
+from udp_client import UdpChannel
+
+# Unacknowledged inputs kept for replay; older ones are forgotten if the server stops acknowledging.
+MAX_PENDING_INPUTS = 64
+
+# How long to keep trying to reattach to our slot after the connection drops (e.g. while a crashed
+# server restarts from its checkpoint), and how long to wait between attempts.
+REATTACH_WINDOW = 30.0
+REATTACH_RETRY_INTERVAL = 0.5
+
+# An immutable view of the in-game state. Every update builds a new one and publishes it by replacing
+# GameClient.snapshot, so the game loop can read it without locking or copying.
+# - revision: bumped on every publish (server updates and our own predicted moves); same revision, same picture
+# - version, tick: the server's state version and simulation tick
+# - players: tuple of read-only player dicts; flag: (x, y); flag_carried: whether any player holds the flag
+# - locked_cells: frozenset of (x, y); acks: read-only {player_id: seq of the last input the server applied}
+# - predicted_pos: our own position with unacknowledged inputs replayed, or None
+# - glide: the Glide other players are drawn along
+StateSnapshot = namedtuple("StateSnapshot", [
+    "revision", "version", "tick", "players", "flag", "flag_carried", "locked_cells", "acks",
+    "predicted_pos", "glide",
+])
+
+EMPTY_SNAPSHOT = StateSnapshot(
+    revision=0, version=None, tick=0, players=(), flag=(0, 0), flag_carried=False, locked_cells=frozenset(),
+    acks=MappingProxyType({}), predicted_pos=None, glide=Glide(),
+)
 
 class GameClient:
     # Initializes the client, connects to the server, sets up state and message handling, 
-    # and prepares for communication.
-    def __init__(self, host='127.0.0.1', port=12345):
+    # and joins a room: the given room_id, a new room if create_room is set, or any open room.
+    # protocols is the wire protocol offer, most preferred first; the server's choice arrives in lobby_init.
+    # If use_udp is set, state snapshots and inputs go over a UDP channel when the server offers one (see
+    # udp_client.py), and over the TCP connection otherwise.
+    # compression is the stream compression offer for what the server sends us (see compression.py); pass () to
+    # receive everything uncompressed.
+    # Raises ConnectionError if the server refuses the join.
+    # With connect=False the client stays offline, for tools that feed it messages directly (tools/benchmark.py).
+    def __init__(self, host='127.0.0.1', port=12345, room_id=None, create_room=False, protocols=SUPPORTED_PROTOCOLS,
+                 use_udp=True, compression=SUPPORTED_COMPRESSIONS, connect=True):
         self.host = host
         self.port = port
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client_socket.connect((self.host, self.port))
+        self.client_socket = None
+        self.file = None
+        if connect:
+            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.client_socket.connect((self.host, self.port))
+            self.file = self.client_socket.makefile('rb')
+        # The join handshake is always JSON; lobby_init switches to the negotiated protocol.
+        self.protocol = JSON
+        self.room_id = None
+        self.protocols = protocols
+        # Token from lobby_init that lets us reclaim our slot after losing the connection.
+        self.session = None
+        self.use_udp = use_udp
+        self.compressions = compression
+        # The compression the server picked in lobby_init, or None.
+        self.compression = None
+        self.udp_channel = None
         self.lock = threading.Lock()
         self.message_queue = queue.Queue()
         self.listening = False
         self.game_start = False
         self.server_down = False
         
-        self.state = {
-            "players": [],
-            "flag": (0, 0),
-            "locked_cells": [],
-        }
+        # Written only with self.lock held (by the listener and send_input); read freely by the game loop.
+        self.snapshot = EMPTY_SNAPSHOT
+        # Sequence number of the last input sent; the server echoes the last one it applied in "acks".
+        self.input_seq = 0
+        # Client-side prediction: our own (seq, dx, dy) inputs the server hasn't applied yet. They are replayed on
+        # every authoritative state to give snapshot.predicted_pos; other players glide between snapshots.
+        self.grid_size = 15
+        # Team bases from lobby_init, for the renderer; None until then (the renderer then assumes the corners).
+        self.bases = None
+        # Radius of the area around us the server sends state for (lobby_init), or None if it sends everything.
+        self.view_radius = None
+        self.pending_inputs = deque()
+        # Read-only player dicts by id, so deltas can replace single entries; snapshot.players is built from it.
+        self.players_by_id = {}
+        self.keyframe_requested = False
         
         self.lobby_state = {
             "players": [None] * 4,
@@ -36,12 +102,38 @@ class GameClient:
         
         self.message_handlers = {
             'update': self.handle_update,
+            'delta': self.handle_delta,
             'lobby_update': self.handle_lobby_update,
             'lobby_init': self.handle_lobby_init,
             'game_start': self.handle_game_start,
             'server_down': self.handle_server_down 
         }
         
+        if connect:
+            self.join_room(room_id, create_room, protocols)
+        
+    # Sends the join request and waits for the server's answer before any other traffic is read.
+    # lobby_init is processed as usual; join_error closes the socket and raises ConnectionError. If lobby_init
+    # names a compression, everything after it is read through an InflatingReader.
+    # session, if given, reclaims the slot it was issued for instead of taking a new one.
+    def join_room(self, room_id, create_room, protocols=SUPPORTED_PROTOCOLS, session=None):
+        join_message = {"room_id": room_id, "create": create_room, "protocols": list(protocols), "udp": self.use_udp,
+                        "compression": list(self.compressions)}
+        if session is not None:
+            join_message["session"] = session
+        self.send_message("join", join_message)
+        line = self.file.readline()
+        if not line:
+            self.close()
+            raise ConnectionError("Server closed the connection")
+        message = json.loads(line)
+        if message.get("type") == "join_error":
+            self.close()
+            raise ConnectionError(message.get("message", "Could not join room"))
+        self.process_message(message)
+        if self.compression is not None:
+            self.file = InflatingReader(self.file, self.compression)
+        
     # Sets the game_start flag and queues the message for further processing.
     def handle_game_start(self, message):
         with self.lock:
@@ -54,21 +146,60 @@ class GameClient:
         thread.daemon = True
         thread.start()
 
-    # Continuously reads messages from the server, parses them, and hands them off to the handler.
+    # Continuously reads messages from the server in the negotiated protocol and hands them off to the handler.
+    # If the connection drops without a server_down notice, tries to reattach to our slot (see reattach).
+    # A malformed message on a plain stream is skipped, but nothing after one on a compressed stream (or after
+    # corrupt compressed data) can be decoded, so that counts as a dropped connection too.
     def listen(self):
         self.listening = True
-        file = self.client_socket.makefile('r')
         while self.listening:
             try:
-                line = file.readline()
-                
-                if not line:
-                    break
-                
-                message = json.loads(line)
+                message = read_message(self.file, self.protocol)
+            except ProtocolError as e:
+                if self.compression is None:
+                    continue
+                print(f"Can't decode the compressed stream past a bad message ({e}); dropping the connection.")
+                message = None
+            except ConnectionError as e:
+                print(f"Lost the connection to the server: {e}")
+                message = None
+
+            if message is None:
+                if self.listening and not self.server_down and self.reattach():
+                    continue
+                break
+
+            try:
                 self.process_message(message)
-            except (json.JSONDecodeError,ConnectionError):
+            except (ProtocolError,ConnectionError):
                 continue
+
+    # Reconnects and asks for our old slot back with the session token, retrying for up to REATTACH_WINDOW
+    # seconds so a server restarting from a checkpoint has time to come back. Returns True once reattached;
+    # the server follows up with a keyframe, and play carries on from the restored state.
+    def reattach(self):
+        if self.session is None:
+            return False
+        deadline = time.monotonic() + REATTACH_WINDOW
+        while self.listening and time.monotonic() < deadline:
+            try:
+                new_socket = socket.create_connection((self.host, self.port), timeout=REATTACH_RETRY_INTERVAL)
+                new_socket.settimeout(None)
+            except OSError:
+                time.sleep(REATTACH_RETRY_INTERVAL)
+                continue
+            old_socket = self.client_socket
+            self.client_socket = new_socket
+            self.file = new_socket.makefile('rb')
+            self.protocol = JSON
+            old_socket.close()
+            try:
+                self.join_room(self.room_id, False, self.protocols, self.session)
+                print("Reattached to the game after losing the connection.")
+                return True
+            except (ConnectionError, OSError, ValueError):
+                return False
+        return False
     
     # Returns all messages currently in the queue — used by the game to process new events.
     def get_messages(self):
@@ -87,26 +218,74 @@ class GameClient:
         else:
             print(f"Unhandled message type: {message.get('type')}")
     
-    # Updates the in-game state (players, flag, locked cells) from the server.
+    # Replaces the in-game state (players, flag, locked cells, input acks) with a full keyframe from the server.
     def handle_update(self, message):
         with self.lock:
-            self.state.update({
-                'players': message.get('players', []),
-                'flag': tuple(message.get('flag', (0, 0))),
-                'locked_cells': [tuple(c) for c in message.get('locked_cells', [])]
-            })
+            self.players_by_id = {p['id']: MappingProxyType(p) for p in message.get('players', [])}
+            self.keyframe_requested = False
+            self.apply_snapshot(
+                version=message.get('version'),
+                tick=message.get('tick', 0),
+                acks=MappingProxyType({pid: seq for pid, seq in message.get('acks', [])}),
+                flag=tuple(message.get('flag', (0, 0))),
+                locked_cells=frozenset(tuple(c) for c in message.get('locked_cells', [])),
+            )
+
+    # Applies a delta on top of the current state. If the delta doesn't start from our version
+    # (we missed something), asks the server for a keyframe instead.
+    def handle_delta(self, message):
+        with self.lock:
+            if message.get('base') != self.snapshot.version:
+                if self.keyframe_requested:
+                    return
+                self.keyframe_requested = True
+                gap = True
+            else:
+                gap = False
+                for player in message.get('players', []):
+                    self.players_by_id[player['id']] = MappingProxyType(player)
+                for player_id in message.get('removed', []):
+                    self.players_by_id.pop(player_id, None)
+                changes = {'version': message.get('version'), 'tick': message.get('tick', self.snapshot.tick)}
+                if 'flag' in message:
+                    changes['flag'] = tuple(message['flag'])
+                if 'locked_cells' in message:
+                    changes['locked_cells'] = frozenset(tuple(c) for c in message['locked_cells'])
+                if message.get('acks'):
+                    acks = dict(self.snapshot.acks)
+                    acks.update((pid, seq) for pid, seq in message['acks'])
+                    changes['acks'] = MappingProxyType(acks)
+                self.apply_snapshot(**changes)
+        if gap:
+            self.send_message("keyframe_request", {"player_id": self.lobby_state["player_id"]})
     
-    # Processes initial lobby info: assigns player ID, checks if host, and updates player list and ready states.
+    # Processes initial lobby info: assigns player ID, checks if host, switches to the negotiated wire protocol,
+    # and updates player list and ready states.
     def handle_lobby_init(self, message):
         # Includes getting ID and host
         with self.lock:
+            self.room_id = message.get("room_id")
+            self.protocol = message.get("protocol", JSON)
+            self.grid_size = message.get("grid_size", self.grid_size)
+            self.bases = message.get("bases", self.bases)
+            self.view_radius = message.get("view_radius")
+            self.compression = message.get("compression")
+            self.session = message.get("session")
             self.lobby_state = {
-                "players": message.get("players", [None]*4),
-                "ready_states": message.get("ready_states", [False]*4),
+                "players": message.get("players", self.lobby_state["players"]),
+                "ready_states": message.get("ready_states", self.lobby_state["ready_states"]),
                 "player_id": message["your_id"],
                 "can_start": message.get("can_start", False),
                 "host": message.get("is_host", False)
             }
+        # A reattach gets a fresh channel (and token); the old one goes quiet.
+        if self.udp_channel is not None:
+            self.udp_channel.close()
+            self.udp_channel = None
+        udp = message.get("udp")
+        if udp:
+            self.udp_channel = UdpChannel(self, udp["port"], udp["token"])
+            self.udp_channel.start()
     
     # Updates lobby state (players, ready states, and whether the game can start).
     def handle_lobby_update(self, message):
@@ -138,6 +317,13 @@ class GameClient:
             {"player_id": self.lobby_state["player_id"]}
         )
     
+    # Asks the server to send at most rate state updates a second, e.g. on a slow link; None restores the full rate.
+    def send_rate_request(self, rate):
+        self.send_message(
+            "send_rate",
+            {"player_id": self.lobby_state["player_id"], "rate": rate}
+        )
+
     # Informs the server the player is leaving the game.
     def send_disconnect(self):
         self.send_message(
@@ -145,35 +331,105 @@ class GameClient:
             {"player_id": self.lobby_state["player_id"]}
         )
 
-    # Sends a structured message to the server, merging any extra data.
+    # Sends a structured message to the server, tagged with the current room and merging any extra data.
     def send_message(self,message_type,additional_data = None):
-        message = {"type": message_type}
+        message = {"type": message_type, "room_id": self.room_id}
         
         if additional_data:
             message.update(additional_data)
             
         try:
-            encoded_message = (json.dumps(message) + "\n").encode()
+            encoded_message = encode(message, self.protocol)
             self.client_socket.sendall(encoded_message)
             
         except Exception as e:
             print(f"Send {message_type} error: {e} \n")
     
-    # Sends movement input (directional) to the server for the specified player.
+    # Returns our player's id in the game state (lobby ids are 0-3, game state ids 1-4).
+    def own_game_id(self):
+        player_id = self.lobby_state["player_id"]
+        return None if player_id is None else player_id + 1
+
+    # Makes snapshot the current one with the next revision number. The single assignment is the publish:
+    # readers see either the old snapshot or the new one, never a mix. Caller must hold self.lock.
+    def publish(self, snapshot):
+        self.snapshot = snapshot._replace(revision=self.snapshot.revision + 1)
+
+    # Called with self.lock held after every authoritative update, with the snapshot fields it changed:
+    # forgets the inputs the server has applied, replays the rest on top of the new state, starts the other
+    # players' glide towards their new cells and publishes the result.
+    def apply_snapshot(self, **changes):
+        players = tuple(self.players_by_id.values())
+        snapshot = self.snapshot._replace(players=players, flag_carried=any(p['has_flag'] for p in players), **changes)
+        ack = snapshot.acks.get(self.own_game_id(), 0)
+        while self.pending_inputs and self.pending_inputs[0][0] <= ack:
+            self.pending_inputs.popleft()
+        self.publish(snapshot._replace(
+            predicted_pos=self.predict(snapshot),
+            glide=snapshot.glide.advance({pid: tuple(p['pos']) for pid, p in self.players_by_id.items()}),
+        ))
+
+    # Returns our position in snapshot with the pending inputs replayed on it, or None if we aren't in the game.
+    # Caller must hold self.lock.
+    def predict(self, snapshot):
+        game_id = self.own_game_id()
+        own = self.players_by_id.get(game_id)
+        if own is None:
+            return None
+        blocked = set(snapshot.locked_cells)
+        blocked.update(tuple(p['pos']) for pid, p in self.players_by_id.items() if pid != game_id)
+        return replay_inputs(tuple(own['pos']), self.pending_inputs, self.grid_size, blocked)
+
+    # Sends movement input (directional) to the server for the specified player, tagged with the next sequence number.
+    # The move is applied to our predicted position right away instead of waiting for the server's update.
+    # Returns the sequence number so callers can match it against the server's acks.
     def send_input(self, player_id, dx, dy):
+        with self.lock:
+            self.input_seq += 1
+            seq = self.input_seq
+            self.pending_inputs.append((seq, dx, dy))
+            if len(self.pending_inputs) > MAX_PENDING_INPUTS:
+                self.pending_inputs.popleft()
+            self.publish(self.snapshot._replace(predicted_pos=self.predict(self.snapshot)))
+            pending = list(self.pending_inputs)
+        channel = self.udp_channel
+        if channel is not None and channel.send_inputs(pending):
+            return seq
         self.send_message("input", {
             "player_id": player_id,
+            "seq": seq,
             "move": {"dx": dx, "dy": dy}
         })
+        return seq
     
-    # Returns a copy of the current game state (used for rendering or logic on the client side).
+    # Returns the latest StateSnapshot. Snapshots are never modified after they are published, so this needs
+    # no lock and no copy; keep the returned object to work on a consistent state.
     def get_state(self):
-        with self.lock:
-            return self.state.copy()
+        return self.snapshot
+
+    # Returns (players, flag position) to draw for a snapshot: our own player at its predicted position (carrying
+    # the flag along if they hold it) and other players at their gliding, possibly fractional, positions.
+    def get_predicted_state(self, snapshot, now=None):
+        game_id = self.own_game_id()
+        positions = snapshot.glide.positions_at(now)
+        flag_pos = snapshot.flag
+        players = []
+        for player in snapshot.players:
+            pid = player['id']
+            if pid == game_id and snapshot.predicted_pos is not None:
+                player = dict(player, pos=snapshot.predicted_pos)
+                if player['has_flag']:
+                    flag_pos = snapshot.predicted_pos
+            elif pid in positions:
+                player = dict(player, pos=positions[pid])
+            players.append(player)
+        return players, flag_pos
     
     # Stops listening and closes the socket connection safely.
     def close(self):
         self.listening = False
+        if self.udp_channel is not None:
+            self.udp_channel.close()
         if self.client_socket:
             try:
                 self.client_socket.shutdown(socket.SHUT_RDWR)
@@ -5,6 +5,8 @@ from game_client import GameClient
 from lobby import Lobby
 from enum import Enum, auto
 from capture_the_flag_game import CaptureTheFlagGame
+from game_renderer import GameRenderer
+from profiler import Profiler, install_profile_signal
 
 # Represents the current screen/state of the app:
 # MENU: Main menu screen
@@ -20,8 +22,12 @@ class AppState(Enum):
 class GameMenu:
     # Sets up the Pygame window, initializes the menu, and creates the main menu UI.
     # Also initializes app state and network client variables.
-    def __init__(self,screen_width = 750,screen_height=750):
+    # profiler captures profiles of the client on demand (F9 in game, or SIGUSR1); one writing to profiles/ is
+    # made if none is given.
+    def __init__(self,screen_width = 750,screen_height=750, profiler=None):
         pygame.init()
+        self.profiler = profiler or Profiler("client")
+        install_profile_signal(self.profiler)
         
         self.surface = pygame.display.set_mode((screen_width,screen_height))
         pygame.display.set_caption("Capture the Flag")
@@ -63,8 +69,16 @@ class GameMenu:
             maxchar=10, 
         )
         
+        # Optional room to join; left blank, the server picks any open room
+        self.room_input = self.menu.add.text_input(
+            "Room ID:", 
+            default="", 
+            maxchar=10, 
+        )
+        
         # self.menu.add.button('Connect', self.prepare_connection_details)
         self.menu.add.button('Connect', self.connect_to_server)
+        self.menu.add.button('Create Room', self.create_room)
         # pygame_menu.events.EXIT also works
         self.menu.add.button('Quit', self.quit_game)
         
@@ -76,12 +90,16 @@ class GameMenu:
             )
             error_label.set_max_width(700)
     
-    # Reads IP and port from input fields, then:
-    # - Attempts to connect to the server
+    # Connects and asks the server for a brand new room instead of joining an existing one.
+    def create_room(self):
+        self.connect_to_server(create_room=True)
+    
+    # Reads IP, port and optional room ID from input fields, then:
+    # - Attempts to connect to the server and join the room (or any open room)
     # - Starts the network listener
     # - Changes app state to LOBBY if successful
     # - Shows error message on failure and refreshes menu
-    def connect_to_server(self):
+    def connect_to_server(self, create_room=False):
         if self.connection_in_progress:
             return
         
@@ -95,8 +113,18 @@ class GameMenu:
             self.create_main_menu()
             return
         
+        room_id = None
+        if not create_room and self.room_input.get_value().strip():
+            try:
+                room_id = int(self.room_input.get_value())
+            except ValueError:
+                self.error_message = "Invalid room ID"
+                self.create_main_menu()
+                return
+        
         try:
-            self.game_client = GameClient(host,port)
+            self.game_client = GameClient(host, port, room_id, create_room)
+            self.profiler.set_sections(self.profile_sections())
             self.game_client.initialized = True
             self.game_client.start_listener()
             self.state = AppState.LOBBY
@@ -106,6 +134,13 @@ class GameMenu:
             self.error_message = f"Connection failed: {str(e)}"
             self.create_main_menu()
     
+    # The functions client profile samples are attributed to: the game loop, rendering and every message handler.
+    def profile_sections(self):
+        sections = {"game_loop": CaptureTheFlagGame.run, "GameRenderer.render": GameRenderer.render}
+        sections.update((f"handler:{message_type}", handler)
+                        for message_type, handler in self.game_client.message_handlers.items())
+        return sections
+
     # Closes the network connection if active, shuts down Pygame, and exits the program.
     def quit_game(self):
         if self.game_client:
@@ -141,7 +176,7 @@ class GameMenu:
                     self.menu.enable()
                     
             elif self.state == AppState.GAME:
-                game = CaptureTheFlagGame(self.game_client, player_id)
+                game = CaptureTheFlagGame(self.game_client, player_id, self.profiler)
                 game.run()
                 
             elif self.state == AppState.ERROR:
@@ -1,21 +1,37 @@
 import pygame
 
+# Grids wider than this many cells don't fit on screen at the default cell size; the renderer then shows a
+# window of DEFAULT_VIEW_CELLS cells onto them instead of the whole board.
+MAX_BOARD_CELLS = 20
+DEFAULT_VIEW_CELLS = 15
+
 class GameRenderer:
     # Sets grid and screen dimensions
     # Defines player colors, flag color, base color
     # Creates the Pygame display window and clock for frame timing
+    # Pre-renders the static background (grid and bases) and sets up the caches used for dirty-rectangle drawing
+    # Players are drawn in the color the server gave their team, unless player_colors maps their id to another.
+    # bases lists the team bases as the server sent them (default: the four corners).
+    # view_cells, if smaller than the grid, turns on the camera: the window shows that many cells square, scrolled
+    # to keep the focus passed to render (our own player) in the middle, and only the cells, players and bases in
+    # it are drawn. Grids over MAX_BOARD_CELLS wide always use a camera.
     def __init__(self, grid_size=15, cell_size=50,
-                 player_colors=None, flag_color=(0, 255, 0), base_color=(100, 100, 100)):
+                 player_colors=None, flag_color=(0, 255, 0), base_color=(100, 100, 100), bases=None,
+                 view_cells=None):
         self.grid_size = grid_size
         self.cell_size = cell_size
-        self.screen_width = grid_size * cell_size
-        self.screen_height = grid_size * cell_size
-        self.player_colors = player_colors or {
-            0: (255, 0, 0),
-            1: (0, 0, 255),
-            2: (255, 255, 0),
-            3: (0, 255, 255)
-        }
+        if view_cells is None and grid_size > MAX_BOARD_CELLS:
+            view_cells = DEFAULT_VIEW_CELLS
+        self.view_cells = min(view_cells or grid_size, grid_size)
+        # Top-left cell of the window onto the grid; (0, 0) for good when the whole grid fits.
+        start = (grid_size - self.view_cells) // 2
+        self.camera = (start, start)
+        self.screen_width = self.view_cells * cell_size
+        self.screen_height = self.view_cells * cell_size
+        self.player_colors = player_colors or {}
+        self.bases = [tuple(base) for base in bases] if bases else [
+            (0, 0), (grid_size - 1, 0), (0, grid_size - 1), (grid_size - 1, grid_size - 1)
+        ]
         self.flag_color = flag_color
         self.base_color = base_color
 
@@ -24,74 +40,182 @@ class GameRenderer:
         pygame.display.set_caption("Capture the Flag Client")
         self.clock = pygame.time.Clock()
 
-    # Draws a light gray grid on the screen, dividing it into cells for easier position visualization.
-    def draw_grid(self):
-        for x in range(self.grid_size):
-            for y in range(self.grid_size):
+        self.font = pygame.font.Font(None, 36)
+        self.background = self.build_background()
+        # Rendered score text by (label, score, color), kept until that score changes.
+        self.score_surfaces = {}
+        # What the last frame drew: its inputs (to skip identical frames) and the screen areas it covered.
+        self.last_frame_key = None
+        self.last_rects = []
+        self.needs_full_redraw = True
+
+    # Draws the grid and bases in view into an off-screen surface that every frame is restored from. Built once,
+    # and again whenever the camera moves.
+    def build_background(self):
+        background = pygame.Surface((self.screen_width, self.screen_height))
+        background.fill((0, 0, 0))
+        self.draw_grid(background)
+        self.draw_bases(background)
+        return background
+
+    # Forces the next frame to redraw the whole screen, e.g. after something else drew over it.
+    def invalidate(self):
+        self.needs_full_redraw = True
+        self.last_frame_key = None
+
+    # Draws a light gray grid on the surface, dividing the view into cells for easier position visualization.
+    def draw_grid(self, surface):
+        for x in range(self.view_cells):
+            for y in range(self.view_cells):
                 rect = pygame.Rect(x * self.cell_size, y * self.cell_size,
                                    self.cell_size, self.cell_size)
-                pygame.draw.rect(self.screen, (200, 200, 200), rect, 1)
+                pygame.draw.rect(surface, (200, 200, 200), rect, 1)
+
+    # Moves the camera so focus (a grid position) is in the middle of the view, as far as the grid's edges allow.
+    # A moved camera means a new background and a full redraw. Nothing to do without a camera or a focus.
+    def follow(self, focus):
+        if focus is None or self.view_cells == self.grid_size:
+            return
+        half = self.view_cells // 2
+        limit = self.grid_size - self.view_cells
+        camera = tuple(min(max(int(round(c)) - half, 0), limit) for c in focus)
+        if camera != self.camera:
+            self.camera = camera
+            self.background = self.build_background()
+            self.invalidate()
+
+    # Returns True if any part of the cell at pos (possibly fractional) is in view.
+    def in_view(self, pos):
+        x, y = pos
+        left, top = self.camera
+        return left - 1 < x < left + self.view_cells and top - 1 < y < top + self.view_cells
+
+    # Returns the screen position of a cell's top-left corner.
+    def screen_pos(self, pos):
+        x, y = pos
+        left, top = self.camera
+        return (x - left) * self.cell_size, (y - top) * self.cell_size
+
+    # Returns the screen rectangle covered by a cell; positions may be fractional while a player glides.
+    def cell_rect(self, pos):
+        x, y = self.screen_pos(pos)
+        return pygame.Rect(int(x), int(y), self.cell_size + 1, self.cell_size + 1)
 
     # Renders each player on the grid using their ID color.
     # If a player is carrying the flag, a smaller flag-colored square is drawn inside their cell.
     def draw_players(self, players):
         for player in players:
-            x, y = player["pos"]
-            color = self.player_colors.get(player["id"], (255, 255, 255))
+            x, y = self.screen_pos(player["pos"])
+            color = self.color_of(player)
 
             # Draw player
-            pygame.draw.rect(self.screen, color, (x * self.cell_size, y * self.cell_size,
-                                                    self.cell_size, self.cell_size))
-        
+            pygame.draw.rect(self.screen, color, (x, y, self.cell_size, self.cell_size))
+
             # Draw flag indicator if player has it
             if player["has_flag"]:
                 flag_rect = pygame.Rect(
-                    x * self.cell_size + self.cell_size//4,
-                    y * self.cell_size + self.cell_size//4,
+                    x + self.cell_size//4,
+                    y + self.cell_size//4,
                     self.cell_size//2, self.cell_size//2
                 )
                 pygame.draw.rect(self.screen, self.flag_color, flag_rect)
 
     # Draws the standalone flag on the grid if it’s not currently being carried.
     def draw_flag(self, flag_pos):
-        x, y = flag_pos
-        pygame.draw.rect(self.screen, self.flag_color,
-                         (x * self.cell_size, y * self.cell_size, self.cell_size, self.cell_size))
-        
-    # Draws the bases in each corner of the grid.
-    def draw_bases(self):
-        bases = {
-            1: (0, 0),
-            2: (self.grid_size - 1, 0),
-            3: (0, self.grid_size - 1),
-            4: (self.grid_size - 1, self.grid_size - 1)
-        }
-        for base in bases.values():
-            x, y = base
-            pygame.draw.rect(self.screen, self.base_color,
-                             (x * self.cell_size, y * self.cell_size, self.cell_size, self.cell_size))
-
-    # Displays the current scores for all players on the top-left corner of the screen, sorted from highest to lowest.
-    def draw_scores(self, players):
-        font = pygame.font.Font(None, 36)
-        sorted_players = sorted(players, key=lambda p: p["score"], reverse=True)
-        for i, player in enumerate(sorted_players):
-            text = font.render(f"Player {player['id']}: {player['score']}", True,
-                               self.player_colors.get(player["id"], (255, 255, 255)))
-            self.screen.blit(text, (10, 10 + i * 40))
+        x, y = self.screen_pos(flag_pos)
+        pygame.draw.rect(self.screen, self.flag_color, (x, y, self.cell_size, self.cell_size))
+
+    # Returns the color a player is drawn in.
+    def color_of(self, player):
+        return self.player_colors.get(player["id"]) or tuple(player.get("color") or (255, 255, 255))
+
+    # Draws the team bases in view.
+    def draw_bases(self, surface):
+        for base in self.bases:
+            if self.in_view(base):
+                x, y = self.screen_pos(base)
+                pygame.draw.rect(surface, self.base_color, (x, y, self.cell_size, self.cell_size))
+
+    # Returns the scoreboard lines as (label, score, color), highest score first: one per player, or one per
+    # team once teams have more than one player (player id p plays for team (p - 1) % the number of bases).
+    def score_lines(self, players):
+        if len(players) <= len(self.bases):
+            lines = [(f"Player {p['id']}", p["score"], self.color_of(p)) for p in players]
+        else:
+            teams = {}
+            for player in players:
+                team = (player["id"] - 1) % len(self.bases)
+                label, score, color = teams.get(team, (f"Team {team + 1}", 0, self.color_of(player)))
+                teams[team] = (label, score + player["score"], color)
+            lines = list(teams.values())
+        return sorted(lines, key=lambda line: line[1], reverse=True)
+
+    # Returns the rendered text of a scoreboard line, rendering it only when its score has changed.
+    def score_surface(self, line):
+        surface = self.score_surfaces.get(line)
+        if surface is None:
+            label, score, color = line
+            surface = self.font.render(f"{label}: {score}", True, color)
+            self.score_surfaces[line] = surface
+        return surface
+
+    # Displays the current scores on the top-left corner of the screen, sorted from highest to lowest.
+    def draw_scores(self, lines):
+        for i, line in enumerate(lines):
+            self.screen.blit(self.score_surface(line), (10, 10 + i * 40))
+        # Forget text for scores nobody has any more.
+        current = set(lines)
+        for key in [key for key in self.score_surfaces if key not in current]:
+            del self.score_surfaces[key]
 
     # Main rendering method:
-    # - Clears the screen
-    # - Draws grid, bases, and flag (only if not carried)
-    # - Draws players and their scores
-    # - Updates the display and caps frame rate at 30 FPS
-    def render(self, players, flag_pos):
-        self.screen.fill((0, 0, 0))
-        self.draw_grid()
-        self.draw_bases()
-        if not any(p["has_flag"] for p in players):
+    # - Moves the camera to focus, if there is a camera (see follow)
+    # - Skips the frame entirely if nothing that would be drawn has changed since the last one
+    # - Restores the cached background only where the last frame or this one draws something
+    # - Draws the flag (only if not carried) and the players in view, and everyone's scores
+    # - Pushes just those areas to the display (the whole screen on the first frame)
+    # - Caps frame rate at 30 FPS
+    # flag_carried can be passed in when the caller already knows it (the client's snapshots do).
+    def render(self, players, flag_pos, flag_carried=None, focus=None):
+        self.follow(focus)
+        carried = any(p["has_flag"] for p in players) if flag_carried is None else flag_carried
+        frame_key = (
+            tuple((p["id"], tuple(p["pos"]), p["has_flag"], p["score"]) for p in players),
+            None if carried else tuple(flag_pos),
+        )
+        if frame_key == self.last_frame_key and not self.needs_full_redraw:
+            self.idle()
+            return
+
+        # Everything this frame will draw over, computed up front so the background can be restored first.
+        score_lines = self.score_lines(players)
+        players = [p for p in players if self.in_view(p["pos"])]
+        show_flag = not carried and self.in_view(flag_pos)
+        rects = [self.cell_rect(p["pos"]) for p in players]
+        if show_flag:
+            rects.append(self.cell_rect(flag_pos))
+        rects += [self.score_surface(line).get_rect(topleft=(10, 10 + i * 40)) for i, line in enumerate(score_lines)]
+
+        if self.needs_full_redraw:
+            self.screen.blit(self.background, (0, 0))
+        else:
+            for rect in self.last_rects + rects:
+                self.screen.blit(self.background, rect, rect)
+
+        if show_flag:
             self.draw_flag(flag_pos)
         self.draw_players(players)
-        self.draw_scores(players)
-        pygame.display.flip()
-        self.clock.tick(30)
\ No newline at end of file
+        self.draw_scores(score_lines)
+
+        if self.needs_full_redraw:
+            pygame.display.flip()
+            self.needs_full_redraw = False
+        else:
+            pygame.display.update(self.last_rects + rects)
+        self.last_rects = rects
+        self.last_frame_key = frame_key
+        self.clock.tick(30)
+
+    # Waits out a frame without drawing anything, keeping the 30 FPS pace while nothing has changed.
+    def idle(self):
+        self.clock.tick(30)
@@ -26,13 +26,15 @@ class Lobby:
         self.lobby_state = LobbyState.WAITING
         self.surface = pygame.display.set_mode((screen_width, screen_height))
         
-        self.players = [None] * 4
-        self.ready_states = [False] * 4
+        # One row per lobby slot; the server decides how many players a room holds.
+        slots = len(game_client.lobby_state["players"])
+        self.players = [None] * slots
+        self.ready_states = [False] * slots
         self.is_ready = False
         self.starting_game = False
         
         self.menu = pygame_menu.Menu(
-            title="Game Lobby",
+            title=f"Game Lobby - Room {game_client.room_id}",
             width=screen_width,
             height=screen_height,
             theme=pygame_menu.themes.THEME_DARK
@@ -40,7 +42,7 @@ class Lobby:
         
         self.player_widgets = []
         self.player_labels = []
-        for i in range(4):
+        for i in range(slots):
             frame = self.menu.add.frame_v(
                 width = 300,
                 height = 60,
@@ -100,7 +102,7 @@ class Lobby:
         lobby_state = self.game_client.lobby_state
         current_player_id = lobby_state["player_id"]
         
-        for i in range(4):
+        for i in range(len(self.player_widgets)):
             frame,status = self.player_widgets[i]
             player = lobby_state["players"][i]
             is_ready = lobby_state["ready_states"][i]
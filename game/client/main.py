@@ -1,12 +1,34 @@
+import argparse
+import os
+import sys
+
+# protocol.py is shared with the server
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
 from capture_the_flag_game import CaptureTheFlagGame
 from game_client import GameClient
 from game_menu import GameMenu
 from lobby import Lobby
+from profiler import Profiler, parse_profile_seconds
 
 if __name__ == "__main__":
-    menu = GameMenu()
+    parser = argparse.ArgumentParser(description="Capture the Flag client")
+    parser.add_argument("--profile", metavar="SECONDS",
+                        help="capture a profile of the first SECONDS (later ones: F9 in game, or SIGUSR1)")
+    parser.add_argument("--profile-dir", default="profiles", help="directory profiles are written to")
+    args = parser.parse_args()
+    if args.profile is not None:
+        try:
+            args.profile = parse_profile_seconds(args.profile)
+        except ValueError as e:
+            parser.error(f"--profile: {e}")
+
+    profiler = Profiler("client", args.profile_dir)
+    menu = GameMenu(profiler=profiler)
+    if args.profile:
+        profiler.start(args.profile)
     menu.run()
 
     # Game is runnable by itself (with server)
     # game = CaptureTheFlagGame()
-    # game.run()
\ No newline at end of file
+    # game.run()
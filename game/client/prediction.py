@@ -0,0 +1,58 @@
+import time
+
+# Longest time (seconds) a remote player's glide between two snapshots may take, so a player who was idle
+# for a while still moves promptly once they start again.
+MAX_INTERPOLATION_INTERVAL = 0.1
+MIN_INTERPOLATION_INTERVAL = 1 / 60
+
+# Client-side copy of the movement checks in the server's GameState.move_player: the move must stay on the
+# board and may not enter a locked cell or a cell another player stands on. Flag stealing, capturing and
+# scoring are left to the server; their results arrive with the next authoritative update.
+def is_valid_move(pos, dx, dy, grid_size, blocked):
+    new_x, new_y = pos[0] + dx, pos[1] + dy
+    return 0 <= new_x < grid_size and 0 <= new_y < grid_size and (new_x, new_y) not in blocked
+
+# Replays (seq, dx, dy) inputs on top of an authoritative position and returns the predicted position.
+def replay_inputs(pos, inputs, grid_size, blocked):
+    for _, dx, dy in inputs:
+        if is_valid_move(pos, dx, dy, grid_size, blocked):
+            pos = (pos[0] + dx, pos[1] + dy)
+    return pos
+
+class Glide:
+    # Smooths other players' movement: each new snapshot starts a short glide from where the player is
+    # currently drawn to their new cell, so motion stays smooth even when updates arrive less often than frames.
+    # A glide never changes once made; advance() returns the next one, so it can be shared with the render
+    # thread inside an immutable snapshot.
+    __slots__ = ("previous", "current", "started", "interval")
+
+    def __init__(self, previous=None, current=None, started=0.0, interval=MIN_INTERPOLATION_INTERVAL):
+        self.previous = previous or {}
+        self.current = current or {}
+        self.started = started
+        self.interval = interval
+
+    # Returns the glide towards a new snapshot of {player_id: (x, y)}, starting from where players are drawn now.
+    def advance(self, positions, now=None):
+        now = time.perf_counter() if now is None else now
+        interval = min(MAX_INTERPOLATION_INTERVAL, max(MIN_INTERPOLATION_INTERVAL, now - self.started))
+        return Glide(self.positions_at(now), dict(positions), now, interval)
+
+    # True once every player has reached the cell of the latest snapshot.
+    def finished(self, now=None):
+        now = time.perf_counter() if now is None else now
+        return now - self.started >= self.interval
+
+    # Returns {player_id: (x, y)} with fractional coordinates while a glide is in progress.
+    # Players who jumped more than one cell (e.g. a new game) are drawn at their new cell straight away.
+    def positions_at(self, now=None):
+        now = time.perf_counter() if now is None else now
+        alpha = min(1.0, (now - self.started) / self.interval)
+        positions = {}
+        for pid, (x, y) in self.current.items():
+            start = self.previous.get(pid)
+            if start is None or alpha >= 1.0 or abs(start[0] - x) + abs(start[1] - y) > 1.5:
+                positions[pid] = (x, y)
+            else:
+                positions[pid] = (start[0] + (x - start[0]) * alpha, start[1] + (y - start[1]) * alpha)
+        return positions
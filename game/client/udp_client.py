@@ -0,0 +1,115 @@
+import socket
+import struct
+import threading
+import time
+from protocol import (MAX_DATAGRAM_SIZE, UDP_HEADER, UDP_HELLO, UDP_STATE, UDP_WELCOME, ProtocolError,
+                      decode_update, encode_udp_inputs)
+
+# How often to send a hello while waiting for the server's welcome, and how long to wait in all before
+# staying on TCP (e.g. UDP is blocked on the way).
+HANDSHAKE_INTERVAL = 0.2
+HANDSHAKE_TIMEOUT = 2.0
+# How often to send a hello once the channel is up, which keeps NAT mappings open.
+KEEPALIVE_INTERVAL = 1.0
+# How long the server may stay silent on the channel before state goes back to TCP.
+SILENCE_TIMEOUT = 3.0
+# Unacknowledged inputs repeated in every input datagram, so a lost datagram is covered by the next one.
+INPUTS_PER_DATAGRAM = 4
+
+class UdpChannel:
+    # The client end of the UDP channel offered in lobby_init (see the UDP_* notes in protocol.py). A daemon
+    # thread says hello until the server welcomes us, then asks over TCP for state to come this way; snapshots
+    # newer than the last one go to client.handle_update. If the welcome never comes, or the server goes quiet
+    # for SILENCE_TIMEOUT, the channel closes and asks for state to go back to TCP, where it carries on as before.
+    def __init__(self, client, port, token):
+        self.client = client
+        self.address = (client.host, port)
+        self.token = token
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.settimeout(HANDSHAKE_INTERVAL)
+        self.active = False
+        self.closed = False
+        self.hello_seq = 0
+        self.last_state_seq = 0
+        self.stale = 0
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def send_hello(self):
+        self.hello_seq += 1
+        try:
+            self.socket.sendto(UDP_HEADER.pack(UDP_HELLO, self.token, self.hello_seq), self.address)
+        except OSError:
+            pass
+
+    # Sends the newest unacknowledged inputs (a sequence of (seq, dx, dy)). Returns False if the channel isn't
+    # up, in which case the caller sends them over TCP.
+    def send_inputs(self, inputs):
+        if not self.active:
+            return False
+        try:
+            self.socket.sendto(encode_udp_inputs(self.token, list(inputs)[-INPUTS_PER_DATAGRAM:]), self.address)
+        except OSError:
+            return False
+        return True
+
+    def run(self):
+        started = time.monotonic()
+        last_heard = None
+        last_hello = 0.0
+        while not self.closed:
+            now = time.monotonic()
+            if last_heard is None and now - started > HANDSHAKE_TIMEOUT:
+                break
+            if last_heard is not None and now - last_heard > SILENCE_TIMEOUT:
+                break
+            if now - last_hello >= (HANDSHAKE_INTERVAL if last_heard is None else KEEPALIVE_INTERVAL):
+                self.send_hello()
+                last_hello = now
+            try:
+                data, _ = self.socket.recvfrom(MAX_DATAGRAM_SIZE)
+                kind, token, seq = UDP_HEADER.unpack_from(data)
+            except socket.timeout:
+                continue
+            except OSError:  # closed, or an ICMP error from an earlier send
+                if self.closed:
+                    return
+                continue
+            except struct.error:
+                continue
+            if token != self.token:
+                continue
+            last_heard = time.monotonic()
+            if kind == UDP_WELCOME and not self.active:
+                self.active = True
+                self.client.send_message("udp", {"player_id": self.client.lobby_state["player_id"], "enabled": True})
+            elif kind == UDP_STATE:
+                if seq <= self.last_state_seq:
+                    self.stale += 1
+                    continue
+                self.last_state_seq = seq
+                try:
+                    self.client.handle_update(decode_update(data[UDP_HEADER.size:]))
+                except (ProtocolError, struct.error):
+                    continue
+        self.fall_back()
+
+    # Stops using the channel and, if it was carrying state, asks the server to send state over TCP again.
+    def fall_back(self):
+        was_active = self.active
+        self.active = False
+        self.close()
+        if was_active:
+            print("UDP channel went quiet; state goes over TCP again.")
+            self.client.send_message("udp", {"player_id": self.client.lobby_state["player_id"], "enabled": False})
+
+    def close(self):
+        self.active = False
+        self.closed = True
+        try:
+            self.socket.close()
+        except OSError:
+            pass
@@ -0,0 +1,108 @@
+import time
+import zlib
+from protocol import BINARY, JSON, encode
+
+# Optional compression of everything the server sends on a connection after lobby_init, negotiated like the
+# wire protocol: the join message offers "compression" methods, most preferred first, and lobby_init names
+# the one picked. The stream is one zlib stream for the whole connection, flushed (Z_SYNC_FLUSH) after every
+# message, so each message can be decoded as soon as it arrives while still being compressed against
+# everything sent before it: successive updates repeat the same keys, ids and colors, which then cost almost
+# nothing. ZLIB_DICT also primes the stream with COMPRESSION_DICTIONARY, which helps the first messages most.
+ZLIB = "zlib"
+ZLIB_DICT = "zlib-dict"
+SUPPORTED_COMPRESSIONS = (ZLIB_DICT, ZLIB)
+
+COMPRESSION_LEVEL = 6
+
+# Builds the preset dictionary from typical lobby_update, update and delta messages in both protocols.
+# Client and server build it from the same code, so they always agree on it. zlib favours matches near the
+# end of the dictionary, so the most common messages (updates) come last.
+def build_dictionary():
+    players = [{"id": i, "pos": [i, i], "color": [255, 0, 0], "has_flag": False, "score": 0} for i in range(1, 5)]
+    samples = [
+        {"type": "lobby_update", "room_id": 1, "players": ["Player_1", "Player_2", None, None],
+         "ready_states": [True, False, False, False], "can_start": False},
+        {"type": "game_start", "room_id": 1},
+        {"type": "delta", "room_id": 1, "base": 1, "version": 2, "players": players[:1], "tick": 1,
+         "removed": [], "acks": [[1, 1]], "flag": [7, 7], "locked_cells": []},
+        {"type": "update", "room_id": 1, "keyframe": True, "version": 1, "tick": 1, "players": players,
+         "flag": [7, 7], "locked_cells": [], "acks": [[1, 1], [2, 1]]},
+    ]
+    return b"".join(encode(message, BINARY) + encode(message, JSON) for message in samples)
+
+COMPRESSION_DICTIONARY = build_dictionary()
+
+# Picks the compression for a connection from the client's offer, in the client's order of preference, or
+# None (send uncompressed) if there is nothing both sides support.
+def choose_compression(offered, allowed=SUPPORTED_COMPRESSIONS):
+    for method in offered or ():
+        if method in allowed:
+            return method
+    return None
+
+class StreamCompressor:
+    # The sending end of a compressed stream. Only used by the connection's writer, one message at a time and
+    # in the order they go out. Counts the bytes in and out and the time spent compressing, for the stats.
+    def __init__(self, method, level=COMPRESSION_LEVEL):
+        if method == ZLIB_DICT:
+            self.compressor = zlib.compressobj(level, zdict=COMPRESSION_DICTIONARY)
+        else:
+            self.compressor = zlib.compressobj(level)
+        self.method = method
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.seconds = 0.0
+
+    # Returns the bytes to send for data: its compressed form, flushed so the client can decode it right away.
+    def compress(self, data):
+        started = time.perf_counter()
+        compressed = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.seconds += time.perf_counter() - started
+        self.raw_bytes += len(data)
+        self.compressed_bytes += len(compressed)
+        return compressed
+
+class InflatingReader:
+    # The receiving end of a compressed stream: wraps a binary file object (socket.makefile('rb')) reading
+    # the compressed bytes and offers the readline() and read(n) that read_message needs on the plain stream.
+    def __init__(self, file, method, read_size=64 * 1024):
+        if method == ZLIB_DICT:
+            self.inflater = zlib.decompressobj(zdict=COMPRESSION_DICTIONARY)
+        else:
+            self.inflater = zlib.decompressobj()
+        self.file = file
+        self.read_size = read_size
+        self.buffer = bytearray()
+
+    # Reads and inflates whatever compressed bytes have arrived. Returns False at the end of the stream.
+    # Raises ConnectionError if the stream is corrupt, since nothing after that point can be decoded.
+    def fill(self):
+        chunk = self.file.read1(self.read_size)
+        if not chunk:
+            return False
+        try:
+            self.buffer += self.inflater.decompress(chunk)
+        except zlib.error as e:
+            raise ConnectionError(f"Corrupt compressed stream: {e}")
+        return True
+
+    def readline(self):
+        start = 0
+        while True:
+            end = self.buffer.find(b"\n", start)
+            if end != -1:
+                line = bytes(self.buffer[:end + 1])
+                del self.buffer[:end + 1]
+                return line
+            start = len(self.buffer)
+            if not self.fill():
+                line = bytes(self.buffer)
+                self.buffer.clear()
+                return line
+
+    def read(self, size):
+        while len(self.buffer) < size and self.fill():
+            pass
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
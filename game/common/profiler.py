@@ -0,0 +1,140 @@
+import math
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+# Defaults for a capture: how long it runs and how often every thread's stack is sampled.
+PROFILE_SECONDS = 10.0
+PROFILE_INTERVAL = 0.005
+# Longest capture parse_profile_seconds allows; tracemalloc slows everything down while it runs.
+MAX_PROFILE_SECONDS = 120.0
+# Frames kept per allocation traceback, and allocation hot spots listed in the summary.
+ALLOCATION_FRAMES = 16
+ALLOCATION_TOP = 25
+
+# Returns the folded-stack name of a frame: function, file and first line, e.g. "tick_room (game_server.py:850)".
+def frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+# Parses a capture length (from a command line option or a /profile request) and caps it at
+# MAX_PROFILE_SECONDS. Raises ValueError unless it is a positive, finite number.
+def parse_profile_seconds(text):
+    seconds = float(text)
+    if not math.isfinite(seconds) or seconds <= 0:
+        raise ValueError(f"{text!r} is not a positive number of seconds")
+    return min(seconds, MAX_PROFILE_SECONDS)
+
+class Profiler:
+    # On-demand profiling for a running server or client, without restarting it under cProfile. A capture
+    # (start) runs for a bounded number of seconds on a daemon thread, which meanwhile:
+    # - samples the stack of every other thread each interval, and
+    # - traces allocations with tracemalloc.
+    # Samples are attributed to sections: each stack is rooted at "[label]" for the innermost function of it
+    # registered with set_sections (e.g. "[broadcast_game_state]"), or "[thread name]" if there is none, so
+    # flame graphs split the time by game loop, broadcast, message handler, rendering and so on.
+    # At the end it writes, to directory, <prefix>-<time>.folded (sampled stacks) and <prefix>-<time>-alloc.folded
+    # (bytes still allocated, by allocation traceback), both in the folded "frame;frame;frame count" format that
+    # flamegraph.pl, inferno and speedscope read, plus <prefix>-<time>-alloc.txt, the top allocating lines.
+    def __init__(self, prefix, directory="profiles", interval=PROFILE_INTERVAL):
+        self.prefix = prefix
+        self.directory = directory
+        self.interval = interval
+        self.sections = {}
+        self.lock = threading.Lock()
+        self.running = False
+        self.last_files = []
+
+    # Registers the functions (or bound methods) samples are attributed to, as {label: function}.
+    def set_sections(self, sections):
+        self.sections = {getattr(function, "__func__", function).__code__: label
+                         for label, function in sections.items()}
+
+    # Starts a capture of the given length. Returns False if one is already running.
+    def start(self, seconds=PROFILE_SECONDS):
+        with self.lock:
+            if self.running:
+                return False
+            self.running = True
+        thread = threading.Thread(target=self.capture, args=(seconds,), name="profiler")
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def capture(self, seconds):
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(ALLOCATION_FRAMES)
+        try:
+            stacks, samples = self.sample(seconds)
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+        try:
+            self.last_files = self.write(stacks, snapshot, samples, seconds)
+            print(f"Profile written to {self.last_files[0]} ({samples} samples)")
+        except OSError as e:
+            print(f"Could not write the profile: {e}")
+        finally:
+            with self.lock:
+                self.running = False
+
+    # Samples every other thread's stack for seconds; returns ({folded stack: samples}, number of samples).
+    def sample(self, seconds):
+        own = threading.get_ident()
+        stacks = {}
+        samples = 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = self.fold(frame, names.get(ident, "thread"))
+                stacks[stack] = stacks.get(stack, 0) + 1
+            samples += 1
+            time.sleep(self.interval)
+        return stacks, samples
+
+    # Returns the folded form of one stack, outermost frame first, rooted at its section (see the class notes).
+    def fold(self, frame, thread_name):
+        names = []
+        section = None
+        while frame is not None:
+            code = frame.f_code
+            names.append(frame_name(code))
+            if section is None:
+                section = self.sections.get(code)
+            frame = frame.f_back
+        names.append(f"[{section or thread_name}]")
+        names.reverse()
+        return ";".join(names)
+
+    # Writes the three profile files; returns their paths.
+    def write(self, stacks, snapshot, samples, seconds):
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, f"{self.prefix}-{time.strftime('%Y%m%d-%H%M%S')}")
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        paths = [base + ".folded", base + "-alloc.folded", base + "-alloc.txt"]
+        with open(paths[0], "w") as file:
+            for stack, count in sorted(stacks.items()):
+                file.write(f"{stack} {count}\n")
+        with open(paths[1], "w") as file:
+            for statistic in snapshot.statistics("traceback"):
+                frames = ";".join(f"{os.path.basename(f.filename)}:{f.lineno}" for f in statistic.traceback)
+                file.write(f"{frames} {statistic.size}\n")
+        with open(paths[2], "w") as file:
+            file.write(f"{samples} stack samples over {seconds:g}s; bytes still allocated at the end, by line:\n")
+            for statistic in snapshot.statistics("lineno")[:ALLOCATION_TOP]:
+                file.write(f"{statistic}\n")
+        return paths
+
+# Starts a capture whenever the process gets SIGUSR1 (e.g. kill -USR1 <pid>). Does nothing where there is no
+# SIGUSR1 (Windows), or when not called from the main thread, where Python can't install signal handlers.
+def install_profile_signal(profiler, seconds=PROFILE_SECONDS):
+    if not hasattr(signal, "SIGUSR1") or threading.current_thread() is not threading.main_thread():
+        return
+    signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.start(seconds))
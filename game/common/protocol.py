@@ -0,0 +1,363 @@
+import json
+import struct
+
+# Wire protocols a connection can use after the join handshake. The join message and lobby_init
+# are always newline-delimited JSON; lobby_init tells the client which protocol the rest of the
+# connection uses. JSON stays available as a readable fallback for debugging.
+JSON = "json"
+BINARY = "binary"
+SUPPORTED_PROTOCOLS = (BINARY, JSON)
+
+# Binary framing: every frame starts with a 4-byte payload length and a 1-byte kind.
+# The hot messages (state updates, deltas and inputs) have fixed-layout records;
+# everything else (lobby and control messages) is carried as a JSON payload inside a frame.
+FRAME_HEADER = struct.Struct("!IB")
+KIND_JSON = 0
+KIND_UPDATE = 1
+KIND_DELTA = 2
+KIND_INPUT = 3
+
+# Frames larger than this are treated as a corrupt stream rather than allocated.
+MAX_FRAME_SIZE = 1 << 20
+
+# update: room_id, version, tick, flag x, flag y, player count, locked cell count, ack count
+UPDATE_HEADER = struct.Struct("!IIIHHBHB")
+# delta: room_id, base, version, tick, field bits, flag x, flag y, player count, removed count,
+# locked cell count, ack count
+DELTA_HEADER = struct.Struct("!IIIIBHHBBHB")
+DELTA_HAS_FLAG = 1
+DELTA_HAS_LOCKED = 2
+# input: room_id, player_id, seq, dx, dy
+INPUT_RECORD = struct.Struct("!IBIbb")
+# player: id, x, y, color (r, g, b), has_flag, score
+PLAYER_RECORD = struct.Struct("!BHHBBB?I")
+CELL_RECORD = struct.Struct("!HH")
+REMOVED_RECORD = struct.Struct("!B")
+# ack: player id, sequence number of the last input applied for that player
+ACK_RECORD = struct.Struct("!BI")
+
+# Optional UDP channel for state snapshots and inputs, so a lost TCP segment can't hold up newer snapshots.
+# lobby_init carries {"port", "token"} when the server offers it. Every datagram starts with UDP_HEADER:
+# kind, the channel token and a sequence number. Each side drops datagrams whose sequence number is not newer
+# than the last one it accepted (old or duplicate).
+# - UDP_HELLO (client): opens the channel and keeps it alive; answered with UDP_WELCOME.
+# - UDP_STATE (server): an update message encoded as by encode_update.
+# - UDP_INPUT (client): a count byte, then a UDP_INPUT_RECORD (seq, dx, dy) for each recent unacknowledged
+#   input, oldest first, so one lost datagram is covered by the next. Its header sequence number is the newest seq.
+UDP_HEADER = struct.Struct("!BQI")
+UDP_HELLO = 1
+UDP_WELCOME = 2
+UDP_STATE = 3
+UDP_INPUT = 4
+UDP_INPUT_RECORD = struct.Struct("!Ibb")
+MAX_DATAGRAM_SIZE = 65507
+
+class ProtocolError(ValueError):
+    # Raised when a frame can't be decoded; the frame is skipped like a malformed JSON line.
+    pass
+
+# Picks the protocol for a connection from the client's offer, in the client's order of preference.
+# Clients that don't offer anything (older clients) get JSON.
+def choose_protocol(offered, allowed=SUPPORTED_PROTOCOLS):
+    for protocol in offered or ():
+        if protocol in allowed:
+            return protocol
+    return JSON
+
+class PlayerList(list):
+    # The "players" of a state message as objects that keep their own encodings: to_json() returns a player's
+    # JSON text and to_record() its PLAYER_RECORD (the server's Player caches both). Encoding the message joins
+    # those instead of building and serializing a dict per player. The objects are read when the message is
+    # encoded, so such a message has to be encoded before the players change again.
+    pass
+
+# Encodes a message as a newline-terminated JSON line. A PlayerList is written as the message's last field.
+def encode_json(message):
+    players = message.get("players")
+    if isinstance(players, PlayerList):
+        rest = dict(message)
+        del rest["players"]
+        text = json.dumps(rest)
+        return (text[:-1] + ', "players": [' + ", ".join([p.to_json() for p in players]) + "]}\n").encode()
+    return (json.dumps(message) + "\n").encode()
+
+def pack_players(players):
+    if isinstance(players, PlayerList):
+        return b"".join([p.to_record() for p in players])
+    return b"".join(
+        PLAYER_RECORD.pack(p["id"], p["pos"][0], p["pos"][1], *p["color"], p["has_flag"], p["score"])
+        for p in players
+    )
+
+def unpack_players(payload, offset, count):
+    players = []
+    for _ in range(count):
+        pid, x, y, r, g, b, has_flag, score = PLAYER_RECORD.unpack_from(payload, offset)
+        offset += PLAYER_RECORD.size
+        players.append({"id": pid, "pos": (x, y), "color": (r, g, b), "has_flag": has_flag, "score": score})
+    return players, offset
+
+def pack_cells(cells):
+    return b"".join(CELL_RECORD.pack(x, y) for x, y in cells)
+
+def unpack_cells(payload, offset, count):
+    cells = []
+    for _ in range(count):
+        cells.append(CELL_RECORD.unpack_from(payload, offset))
+        offset += CELL_RECORD.size
+    return cells, offset
+
+def pack_acks(acks):
+    return b"".join(ACK_RECORD.pack(pid, seq) for pid, seq in acks)
+
+def unpack_acks(payload, offset, count):
+    acks = []
+    for _ in range(count):
+        acks.append(list(ACK_RECORD.unpack_from(payload, offset)))
+        offset += ACK_RECORD.size
+    return acks, offset
+
+def encode_update(message):
+    players = message["players"]
+    locked = message["locked_cells"]
+    acks = message["acks"]
+    flag_x, flag_y = message["flag"]
+    return b"".join((
+        UPDATE_HEADER.pack(message["room_id"], message["version"], message["tick"], flag_x, flag_y,
+                           len(players), len(locked), len(acks)),
+        pack_players(players),
+        pack_cells(locked),
+        pack_acks(acks),
+    ))
+
+def decode_update(payload):
+    (room_id, version, tick, flag_x, flag_y,
+     player_count, locked_count, ack_count) = UPDATE_HEADER.unpack_from(payload)
+    players, offset = unpack_players(payload, UPDATE_HEADER.size, player_count)
+    locked, offset = unpack_cells(payload, offset, locked_count)
+    acks, _ = unpack_acks(payload, offset, ack_count)
+    return {"type": "update", "room_id": room_id, "keyframe": True, "version": version, "tick": tick,
+            "players": players, "flag": (flag_x, flag_y), "locked_cells": locked, "acks": acks}
+
+def encode_delta(message):
+    players = message["players"]
+    removed = message["removed"]
+    fields = 0
+    flag_x, flag_y = 0, 0
+    if "flag" in message:
+        fields |= DELTA_HAS_FLAG
+        flag_x, flag_y = message["flag"]
+    locked = message.get("locked_cells", ())
+    if "locked_cells" in message:
+        fields |= DELTA_HAS_LOCKED
+    acks = message["acks"]
+    return b"".join((
+        DELTA_HEADER.pack(message["room_id"], message["base"], message["version"], message["tick"], fields,
+                          flag_x, flag_y, len(players), len(removed), len(locked), len(acks)),
+        pack_players(players),
+        b"".join(REMOVED_RECORD.pack(pid) for pid in removed),
+        pack_cells(locked),
+        pack_acks(acks),
+    ))
+
+def decode_delta(payload):
+    (room_id, base, version, tick, fields, flag_x, flag_y,
+     player_count, removed_count, locked_count, ack_count) = DELTA_HEADER.unpack_from(payload)
+    players, offset = unpack_players(payload, DELTA_HEADER.size, player_count)
+    removed = list(payload[offset:offset + removed_count])
+    offset += removed_count
+    locked, offset = unpack_cells(payload, offset, locked_count)
+    acks, _ = unpack_acks(payload, offset, ack_count)
+    message = {"type": "delta", "room_id": room_id, "base": base, "version": version, "tick": tick,
+               "players": players, "removed": removed, "acks": acks}
+    if fields & DELTA_HAS_FLAG:
+        message["flag"] = (flag_x, flag_y)
+    if fields & DELTA_HAS_LOCKED:
+        message["locked_cells"] = locked
+    return message
+
+def encode_input(message):
+    move = message.get("move", {})
+    return INPUT_RECORD.pack(message["room_id"], message["player_id"], message.get("seq", 0),
+                             move.get("dx", 0), move.get("dy", 0))
+
+def decode_input(payload):
+    room_id, player_id, seq, dx, dy = INPUT_RECORD.unpack(payload)
+    return {"type": "input", "room_id": room_id, "player_id": player_id, "seq": seq, "move": {"dx": dx, "dy": dy}}
+
+# Encodes a UDP_INPUT datagram for inputs, a list of up to 255 (seq, dx, dy) records, oldest first.
+def encode_udp_inputs(token, inputs):
+    newest = inputs[-1][0] if inputs else 0
+    return b"".join((
+        UDP_HEADER.pack(UDP_INPUT, token, newest),
+        bytes((len(inputs),)),
+        b"".join(UDP_INPUT_RECORD.pack(seq, dx, dy) for seq, dx, dy in inputs),
+    ))
+
+# Returns the (seq, dx, dy) records of a UDP_INPUT datagram's payload (the bytes after UDP_HEADER).
+def decode_udp_inputs(payload):
+    if not payload:
+        raise ProtocolError("Empty input datagram")
+    count = payload[0]
+    try:
+        return [UDP_INPUT_RECORD.unpack_from(payload, 1 + i * UDP_INPUT_RECORD.size) for i in range(count)]
+    except struct.error as e:
+        raise ProtocolError(f"Malformed input datagram: {e}")
+
+# Fixed-layout encoders by message type; any other message type is sent as a KIND_JSON frame.
+BINARY_ENCODERS = {
+    "update": (KIND_UPDATE, encode_update),
+    "delta": (KIND_DELTA, encode_delta),
+    "input": (KIND_INPUT, encode_input),
+}
+
+BINARY_DECODERS = {
+    KIND_UPDATE: decode_update,
+    KIND_DELTA: decode_delta,
+    KIND_INPUT: decode_input,
+    KIND_JSON: json.loads,
+}
+
+# Encodes a message dict for the given protocol: a JSON line, or a length-prefixed binary frame.
+def encode(message, protocol=JSON):
+    if protocol != BINARY:
+        return encode_json(message)
+    kind, encoder = BINARY_ENCODERS.get(message.get("type"), (KIND_JSON, None))
+    payload = encoder(message) if encoder else json.dumps(message).encode()
+    return FRAME_HEADER.pack(len(payload), kind) + payload
+
+# Decodes one binary frame's payload back into the same message dict the JSON protocol would produce.
+def decode_frame(kind, payload):
+    decoder = BINARY_DECODERS.get(kind)
+    if decoder is None:
+        raise ProtocolError(f"Unknown frame kind {kind}")
+    try:
+        return decoder(payload)
+    except (struct.error, ValueError, KeyError) as e:
+        raise ProtocolError(f"Malformed frame of kind {kind}: {e}")
+
+# Bytes to ask the socket for per read; a read returns whatever has arrived, up to this much.
+READ_SIZE = 64 * 1024
+
+class MessageBuffer:
+    # Splits a received byte stream into messages, so a server can read whatever has arrived in one large
+    # recv and decode every complete message in it, instead of one readline or frame read per message.
+    # Bytes of an incomplete message stay buffered until the rest arrives. protocol may be switched once the
+    # join line has been read (with read_line) to parse the rest of the connection.
+    # Malformed messages are skipped and counted in malformed; a JSON line or frame over MAX_FRAME_SIZE raises
+    # ConnectionError, like read_message. on_read, if given, is called with each message's size on the wire.
+    def __init__(self, protocol=JSON, on_read=None):
+        self.protocol = protocol
+        self.on_read = on_read
+        self.buffer = bytearray()
+        self.malformed = 0
+
+    def feed(self, data):
+        self.buffer += data
+
+    # Removes and returns the next complete line (with its newline), or None if there isn't one yet.
+    def read_line(self):
+        end = self.buffer.find(b"\n")
+        if end == -1:
+            if len(self.buffer) > MAX_FRAME_SIZE:
+                raise ConnectionError(f"Line of over {MAX_FRAME_SIZE} bytes")
+            return None
+        line = bytes(self.buffer[:end + 1])
+        del self.buffer[:end + 1]
+        return line
+
+    # Removes and returns every complete message in the buffer, decoded, in order.
+    def drain(self):
+        messages = []
+        buffer = self.buffer
+        offset = 0
+        if self.protocol != BINARY:
+            while True:
+                end = buffer.find(b"\n", offset)
+                if end == -1:
+                    break
+                line = buffer[offset:end + 1]
+                offset = end + 1
+                if self.on_read:
+                    self.on_read(len(line))
+                try:
+                    messages.append(json.loads(line))
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    self.malformed += 1
+            if len(buffer) - offset > MAX_FRAME_SIZE:
+                raise ConnectionError(f"Line of over {MAX_FRAME_SIZE} bytes")
+        else:
+            while len(buffer) - offset >= FRAME_HEADER.size:
+                length, kind = parse_header(buffer[offset:offset + FRAME_HEADER.size])
+                end = offset + FRAME_HEADER.size + length
+                if end > len(buffer):
+                    break
+                payload = bytes(buffer[offset + FRAME_HEADER.size:end])
+                offset = end
+                if self.on_read:
+                    self.on_read(FRAME_HEADER.size + length)
+                try:
+                    messages.append(decode_frame(kind, payload))
+                except ProtocolError:
+                    self.malformed += 1
+        del buffer[:offset]
+        return messages
+
+# Reads the fixed frame header and returns (payload length, kind), or None at end of stream.
+def parse_header(header):
+    if len(header) < FRAME_HEADER.size:
+        return None
+    length, kind = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ConnectionError(f"Frame of {length} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    return length, kind
+
+# Reads one message from a blocking binary file object (socket.makefile('rb')).
+# Returns the message dict, or None when the connection has closed.
+# Raises ProtocolError if the frame is malformed; the stream stays aligned on the next frame.
+# on_read, if given, is called with the number of bytes the message took on the wire.
+def read_message(file, protocol=JSON, on_read=None):
+    if protocol != BINARY:
+        line = file.readline()
+        if not line:
+            return None
+        if on_read:
+            on_read(len(line))
+        try:
+            return json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ProtocolError(f"Malformed JSON line: {e}")
+    header = parse_header(file.read(FRAME_HEADER.size))
+    if header is None:
+        return None
+    length, kind = header
+    payload = file.read(length)
+    if len(payload) < length:
+        return None
+    if on_read:
+        on_read(FRAME_HEADER.size + length)
+    return decode_frame(kind, payload)
+
+# Coroutine version of read_message for an asyncio StreamReader.
+async def read_message_async(reader, protocol=JSON, on_read=None):
+    if protocol != BINARY:
+        line = await reader.readline()
+        if not line:
+            return None
+        if on_read:
+            on_read(len(line))
+        try:
+            return json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ProtocolError(f"Malformed JSON line: {e}")
+    try:
+        header = parse_header(await reader.readexactly(FRAME_HEADER.size))
+        if header is None:
+            return None
+        length, kind = header
+        payload = await reader.readexactly(length)
+    except EOFError:  # asyncio.IncompleteReadError: the client went away mid-frame
+        return None
+    if on_read:
+        on_read(FRAME_HEADER.size + length)
+    return decode_frame(kind, payload)
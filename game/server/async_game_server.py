@@ -0,0 +1,161 @@
+import asyncio
+import socket
+from game_server import GameServer
+from outbound import MAX_PENDING_BYTES, MAX_STALE_FRAMES, OutboundQueue
+from protocol import READ_SIZE, MessageBuffer
+from rate_limit import MessageLimiter
+from profiler import install_profile_signal
+from udp_channel import UdpServerProtocol
+
+class StreamConnection(OutboundQueue):
+    # Outbound queue for the event-loop server: a writer task per client drains the queue into the
+    # asyncio StreamWriter, waiting on drain() so frames only pile up in the bounded queue, where stale
+    # state can still be dropped, rather than in the transport's own unbounded buffer.
+    def __init__(self, writer, max_pending_bytes=MAX_PENDING_BYTES, max_stale_frames=MAX_STALE_FRAMES):
+        super().__init__(max_pending_bytes, max_stale_frames)
+        self.writer = writer
+        self.wakeup = asyncio.Event()
+        self.writer_task = asyncio.create_task(self.write_loop())
+
+    def wake(self):
+        self.wakeup.set()
+
+    # Writer task: sends queued frames in order until the connection is closed and the queue is empty.
+    async def write_loop(self):
+        try:
+            while True:
+                frame = self.next_frame()
+                if frame is None:
+                    if self.closed:
+                        break
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+                data = self.wire_bytes(frame)
+                self.writer.write(data)
+                self.count_sent(len(data))
+                await self.writer.drain()
+        except ConnectionError:
+            self.closed = True
+        finally:
+            self.writer.close()
+
+    # Waits until everything queued has been handed to the client.
+    async def flush(self):
+        while self.pending and not self.writer.is_closing():
+            await asyncio.sleep(0.01)
+        await self.writer.drain()
+
+    def close(self):
+        self.closed = True
+        self.wake()
+
+    # Also ends the client's read loop straight away.
+    def abort(self):
+        self.closed = True
+        self.pending.clear()
+        self.writer.transport.abort()
+        self.wake()
+
+class AsyncGameServer(GameServer):
+    # Runs accept, per-client reads, message dispatch and the broadcast tick on one asyncio event loop,
+    # instead of one thread per client plus a game loop thread. The wire protocol is unchanged, and so are the
+    # constructor's parameters, which are GameServer's own.
+    # The event loop's game loop is a coroutine of its own.
+    def profile_sections(self):
+        sections = super().profile_sections()
+        sections["game_loop"] = self.game_loop_async
+        return sections
+
+    # Coroutine version of handle_client: reads the join message and registers the connection
+    # in a room, then reads messages in the negotiated protocol and dispatches them until the client goes away.
+    # Like handle_client, each wakeup reads whatever has arrived and dispatches every complete message in it.
+    async def handle_client_async(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        print(f"Client {address} connected.")
+        connection = StreamConnection(writer, self.max_outbound_bytes, self.max_stale_frames)
+        buffer = MessageBuffer(on_read=connection.count_received)
+        room, player_id = None, -1
+        try:
+            line = buffer.read_line()
+            while line is None:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    return
+                buffer.feed(data)
+                line = buffer.read_line()
+            join_message = self.parse_join(line)
+            if join_message.get('relay'):
+                room, protocol = self.register_relay(connection, address, join_message)
+            else:
+                room, player_id, protocol = self.register_client(connection, address, join_message)
+            if room is None:
+                return
+            buffer.protocol = protocol
+            limiter = MessageLimiter(self.message_rate, self.message_burst, self.control_rate, self.control_burst)
+            while True:
+                self.dispatch_buffered(buffer, room, limiter, player_id)
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                buffer.feed(data)
+        except (ConnectionError, ValueError):
+            print(f"Client {address} disconnected abruptly")
+        finally:
+            self.handle_network_disconnect(room, player_id, connection)
+
+    # Coroutine version of game_loop: runs the same scheduler, sleeping on the event loop between deadlines.
+    # Rooms still in their lobby are not ticked.
+    async def game_loop_async(self):
+        scheduler = self.build_scheduler()
+        while True:
+            await asyncio.sleep(scheduler.run_pending())
+
+    # Waits (briefly) for a connection's queued data to reach the client.
+    async def flush_connection(self, connection, timeout=1.0):
+        try:
+            await asyncio.wait_for(connection.flush(), timeout)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+
+    # Gives queued shutdown messages a moment to reach the clients before the loop stops.
+    async def flush_connections(self, timeout=1.0):
+        with self.lock:
+            rooms = list(self.rooms.values())
+        connections = [conn for room in rooms for _, conn in room.connected_sockets()]
+        await asyncio.gather(*(self.flush_connection(conn, timeout) for conn in connections))
+
+    # Opens the listening socket and runs the game loop until the server is interrupted. Checkpointed rooms are
+    # restored before any port opens, so no client can join or reattach before they exist.
+    async def serve(self):
+        self.restore_checkpoint()
+        server = await asyncio.start_server(
+            self.handle_client_async, self.host, self.port, reuse_address=True,
+            backlog=socket.SOMAXCONN
+        )
+        print(f"Server listening on {self.host}:{self.port} (async mode)")
+        if self.udp_port is not None:
+            self.udp_transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: UdpServerProtocol(self.handle_datagram), local_addr=(self.host or "0.0.0.0", self.udp_port)
+            )
+            print(f"UDP state channel on {self.host}:{self.udp_port}")
+        self.start_stats()
+        install_profile_signal(self.profiler)
+        game_task = asyncio.create_task(self.game_loop_async())
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            print("Server shutting down.")
+            self.broadcast_server_shutdown()
+            await self.flush_connections()
+            raise
+        finally:
+            game_task.cancel()
+
+    # Starts the event loop; Ctrl+C notifies clients and shuts down like the threaded server.
+    def start(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
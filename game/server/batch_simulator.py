@@ -0,0 +1,174 @@
+import numpy as np
+
+# Actions for BatchSimulator.step: one per player per match. NO_MOVE means the player sent no input that tick;
+# the others are the unit moves a client sends, as (dx, dy) in ACTION_MOVES.
+NO_MOVE = 0
+UP = 1
+DOWN = 2
+LEFT = 3
+RIGHT = 4
+ACTION_MOVES = np.array([(0, 0), (0, -1), (0, 1), (-1, 0), (1, 0)], dtype=np.int16)
+
+# Marks a match with nobody carrying the flag in BatchSimulator.carrier.
+NO_CARRIER = -1
+
+# Returns the bases (= starting cells) of player ids 1 to 4 on a grid, as in GameState.
+def corner_bases(grid_size):
+    return [(0, 0), (grid_size - 1, 0), (0, grid_size - 1), (grid_size - 1, grid_size - 1)]
+
+class BatchSimulator:
+    # Steps many independent matches at once, for bot training and balance studies where stepping GameState
+    # one move_player call at a time is far too slow. Every match has the same grid size and the same
+    # players (ids 1 to player_count, starting on their bases), and follows exactly GameState.move_player's
+    # rules: bounds, collisions, locked cells, stealing from an adjacent carrier, picking the flag up, scoring
+    # at your own base and the flag respawning on a random free cell.
+    # The state of match k lives in plain arrays, indexed [k] or [k, slot] where slot = player id - 1:
+    # - x, y: player positions; score: player scores
+    # - carrier: slot of the player holding the flag, or NO_CARRIER
+    # - flag_x, flag_y: the flag's cell; flag_locked: whether it is locked (GameState.locked_cells only ever
+    #   holds the flag's cell, from the moment it is picked up until its carrier first moves off it)
+    # - occupancy: slot + 1 of the player on each cell (0 = empty), indexed [k, y * grid_size + x]
+    # Each call to step() is one server tick in which the players' inputs are applied in slot order,
+    # vectorized across matches, so a tick costs a few dozen array operations per player however many
+    # matches there are. The flag RNG is a NumPy generator, so flag spawns won't match GameState's seeded
+    # ones; see tools/batch_check.py, which checks the rules against GameState.
+    def __init__(self, matches, grid_size=15, player_count=4, seed=None):
+        if not 1 <= player_count <= 4:
+            raise ValueError("player_count must be between 1 and 4")
+        self.matches = matches
+        self.grid_size = grid_size
+        self.player_count = player_count
+        self.rng = np.random.default_rng(seed)
+        bases = corner_bases(grid_size)
+        # The flag never spawns on a base, even one whose player isn't in the match.
+        self.base_mask = np.zeros(grid_size * grid_size, dtype=bool)
+        for x, y in bases:
+            self.base_mask[y * grid_size + x] = True
+        bases = bases[:player_count]
+        self.base_x = np.array([x for x, _ in bases], dtype=np.int16)
+        self.base_y = np.array([y for _, y in bases], dtype=np.int16)
+        self.rows = np.arange(matches)
+
+        self.x = np.empty((matches, player_count), dtype=np.int16)
+        self.y = np.empty((matches, player_count), dtype=np.int16)
+        self.score = np.zeros((matches, player_count), dtype=np.int32)
+        self.carrier = np.empty(matches, dtype=np.int8)
+        self.flag_x = np.empty(matches, dtype=np.int16)
+        self.flag_y = np.empty(matches, dtype=np.int16)
+        self.flag_locked = np.empty(matches, dtype=bool)
+        self.occupancy = np.empty((matches, grid_size * grid_size), dtype=np.int8)
+        self.tick = np.zeros(matches, dtype=np.int64)
+        self.reset()
+
+    # Starts the given matches (a boolean mask or index array; all of them by default) over: players back on
+    # their bases with no score, and the flag on a random free cell.
+    def reset(self, matches=None):
+        rows = self.rows if matches is None else self.rows[matches]
+        self.x[rows] = self.base_x
+        self.y[rows] = self.base_y
+        self.score[rows] = 0
+        self.carrier[rows] = NO_CARRIER
+        self.flag_locked[rows] = False
+        self.tick[rows] = 0
+        self.occupancy[rows] = 0
+        cells = self.base_y.astype(np.intp) * self.grid_size + self.base_x
+        self.occupancy[rows[:, None], cells] = np.arange(1, self.player_count + 1, dtype=np.int8)
+        self.flag_x[rows] = self.grid_size // 2
+        self.flag_y[rows] = self.grid_size // 2
+        self.spawn_flags(rows)
+
+    # Moves the flag of each match in rows to a uniformly random cell that is neither a base nor occupied, like
+    # GameState.generate_random_flag_position. A match with no such cell keeps its flag where it is.
+    def spawn_flags(self, rows):
+        if len(rows) == 0:
+            return
+        free = (self.occupancy[rows] == 0) & ~self.base_mask
+        counts = free.sum(axis=1)
+        picks = (self.rng.random(len(rows)) * counts).astype(np.intp)
+        # The pick-th free cell of each row is the first one where the running count of free cells passes pick.
+        cells = np.argmax(free.cumsum(axis=1) > picks[:, None], axis=1)
+        spawned = counts > 0
+        rows = rows[spawned]
+        cells = cells[spawned]
+        self.flag_x[rows] = cells % self.grid_size
+        self.flag_y[rows] = cells // self.grid_size
+
+    # Advances every match by one tick. actions is an int array of shape (matches, player_count) holding each
+    # player's action (NO_MOVE, UP, DOWN, LEFT or RIGHT); they are applied in slot order, as GameState.step
+    # would apply inputs queued in that order. Returns a boolean array marking the matches in which someone scored.
+    def step(self, actions):
+        actions = np.asarray(actions)
+        grid_size = self.grid_size
+        occupancy = self.occupancy.reshape(-1)
+        scored = np.zeros(self.matches, dtype=bool)
+        self.tick += 1
+        for slot in range(self.player_count):
+            rows = np.flatnonzero(actions[:, slot])
+            if len(rows) == 0:
+                continue
+            move = ACTION_MOVES[actions[rows, slot]]
+            old_x = self.x[rows, slot]
+            old_y = self.y[rows, slot]
+            new_x = old_x + move[:, 0]
+            new_y = old_y + move[:, 1]
+
+            # Bounds, the locked cell and other players.
+            valid = (new_x >= 0) & (new_x < grid_size) & (new_y >= 0) & (new_y < grid_size)
+            rows, old_x, old_y, new_x, new_y = rows[valid], old_x[valid], old_y[valid], new_x[valid], new_y[valid]
+            offsets = rows * (grid_size * grid_size)
+            new_cells = offsets + new_y.astype(np.intp) * grid_size + new_x
+            occupant = occupancy[new_cells]
+            valid = ~(self.flag_locked[rows] & (new_x == self.flag_x[rows]) & (new_y == self.flag_y[rows]))
+            valid &= (occupant == 0) | (occupant == slot + 1)
+            rows, old_x, old_y, new_x, new_y = rows[valid], old_x[valid], old_y[valid], new_x[valid], new_y[valid]
+            offsets = offsets[valid]
+            new_cells = new_cells[valid]
+            if len(rows) == 0:
+                continue
+
+            # A carrier takes the flag along, unlocking the cell it was picked up on.
+            carrier = self.carrier[rows]
+            carrying = rows[carrier == slot]
+            self.flag_locked[carrying] = False
+            self.flag_x[carrying] = new_x[carrier == slot]
+            self.flag_y[carrying] = new_y[carrier == slot]
+
+            occupancy[offsets + old_y.astype(np.intp) * grid_size + old_x] = 0
+            occupancy[new_cells] = slot + 1
+            self.x[rows, slot] = new_x
+            self.y[rows, slot] = new_y
+
+            # Stealing from a carrier next to the new cell.
+            others = (carrier != slot) & (carrier != NO_CARRIER)
+            victims = carrier[others].astype(np.intp)
+            distance = (np.abs(new_x[others] - self.x[rows[others], victims]) +
+                        np.abs(new_y[others] - self.y[rows[others], victims]))
+            self.carrier[rows[others][distance == 1]] = slot
+
+            # Picking up a flag nobody holds.
+            pickup = ((carrier == NO_CARRIER) & (new_x == self.flag_x[rows]) & (new_y == self.flag_y[rows]))
+            self.carrier[rows[pickup]] = slot
+            self.flag_locked[rows[pickup]] = True
+
+            # Scoring by bringing the flag to your own base.
+            captured = rows[(self.carrier[rows] == slot) & (new_x == self.base_x[slot]) & (new_y == self.base_y[slot])]
+            if len(captured):
+                self.score[captured, slot] += 1
+                self.carrier[captured] = NO_CARRIER
+                self.flag_locked[captured] = False
+                scored[captured] = True
+                self.spawn_flags(captured)
+        return scored
+
+    # Returns match k as plain Python values in GameState's terms: {"players": {id: (pos, has_flag, score)},
+    # "flag": pos, "locked_cells": set}.
+    def match_state(self, k):
+        carrier = int(self.carrier[k])
+        flag = (int(self.flag_x[k]), int(self.flag_y[k]))
+        return {
+            "players": {slot + 1: ((int(self.x[k, slot]), int(self.y[k, slot])), slot == carrier,
+                                   int(self.score[k, slot]))
+                        for slot in range(self.player_count)},
+            "flag": flag,
+            "locked_cells": {flag} if self.flag_locked[k] else set(),
+        }
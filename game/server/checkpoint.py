@@ -0,0 +1,148 @@
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+# Checkpoints of every room, so a restarted server can restore its lobbies and games (see
+# GameServer.restore_checkpoint). The file is append-only: each checkpoint is one round holding every room.
+# - round: ROUND_HEADER (magic, body length, wall-clock time, room count), the body, then a CRC32 of the body.
+#   A round cut short by a crash fails its length or CRC check, and loading falls back to the round before it.
+# - room: ROOM_HEADER (room id, grid size, slot count, in game, tick, version, flag x, flag y, game player
+#   count, locked cell count), one SLOT record per lobby slot (SLOT_TAKEN/SLOT_READY bits and the slot's session
+#   token), then one PLAYER record per player in the game and one CELL record per locked cell.
+# Once the file passes MAX_FILE_BYTES, the next round starts a fresh file, which replaces the old one atomically.
+MAGIC = b"CTFC"
+ROUND_HEADER = struct.Struct("!4sIdI")
+ROUND_CRC = struct.Struct("!I")
+ROOM_HEADER = struct.Struct("!IHB?IIHHBH")
+SLOT = struct.Struct("!BQ")
+SLOT_TAKEN = 1
+SLOT_READY = 2
+PLAYER = struct.Struct("!BHH?I")
+CELL = struct.Struct("!HH")
+MAX_FILE_BYTES = 4 * 1024 * 1024
+
+# Packs one room into a checkpoint record. Called from the simulation tick, which owns the GameState; the lobby
+# lists are read without room.lock, so a slot changing at that very moment is caught by the next checkpoint.
+def pack_room(room):
+    game_state = room.game_state
+    lobby = room.lobby_state
+    players = game_state.players.values() if room.in_game else ()
+    locked = game_state.locked_cells if room.in_game else ()
+    flag_x, flag_y = game_state.flag_pos
+    parts = [ROOM_HEADER.pack(room.room_id, room.grid_size, room.max_players, room.in_game, game_state.tick,
+                              game_state.version, flag_x, flag_y, len(players), len(locked))]
+    for name, ready, session in zip(lobby['players'], lobby['ready_states'], room.sessions):
+        bits = (SLOT_TAKEN if name is not None else 0) | (SLOT_READY if ready else 0)
+        parts.append(SLOT.pack(bits, session or 0))
+    parts.extend(PLAYER.pack(p.id, p.pos[0], p.pos[1], p.has_flag, p.score) for p in players)
+    parts.extend(CELL.pack(x, y) for x, y in locked)
+    return b"".join(parts)
+
+# Frames packed rooms as one checkpoint round.
+def pack_round(room_records, now=None):
+    body = b"".join(room_records)
+    now = time.time() if now is None else now
+    return ROUND_HEADER.pack(MAGIC, len(body), now, len(room_records)) + body + ROUND_CRC.pack(zlib.crc32(body))
+
+def unpack_room(data, offset):
+    (room_id, grid_size, max_players, in_game, tick, version, flag_x, flag_y,
+     player_count, locked_count) = ROOM_HEADER.unpack_from(data, offset)
+    offset += ROOM_HEADER.size
+    slots = []
+    for _ in range(max_players):
+        bits, session = SLOT.unpack_from(data, offset)
+        offset += SLOT.size
+        slots.append((bool(bits & SLOT_TAKEN), bool(bits & SLOT_READY), session or None))
+    players = []
+    for _ in range(player_count):
+        players.append(PLAYER.unpack_from(data, offset))
+        offset += PLAYER.size
+    locked = []
+    for _ in range(locked_count):
+        locked.append(CELL.unpack_from(data, offset))
+        offset += CELL.size
+    room = {
+        "room_id": room_id, "grid_size": grid_size, "in_game": in_game, "tick": tick, "version": version,
+        "flag": (flag_x, flag_y), "slots": slots, "players": players, "locked_cells": locked,
+    }
+    return room, offset
+
+# Reads a checkpoint file and returns (wall-clock time, [room dict, ...]) from its last complete round,
+# or None if there is no file or no complete round in it.
+def load_checkpoint(path):
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+    except FileNotFoundError:
+        return None
+    latest = None
+    offset = 0
+    while offset + ROUND_HEADER.size <= len(data):
+        magic, length, written_at, room_count = ROUND_HEADER.unpack_from(data, offset)
+        body_start = offset + ROUND_HEADER.size
+        body_end = body_start + length
+        if magic != MAGIC or body_end + ROUND_CRC.size > len(data):
+            break
+        body = data[body_start:body_end]
+        if ROUND_CRC.unpack_from(data, body_end)[0] != zlib.crc32(body):
+            break
+        latest = (written_at, body, room_count)
+        offset = body_end + ROUND_CRC.size
+    if latest is None:
+        return None
+    written_at, body, room_count = latest
+    rooms = []
+    room_offset = 0
+    for _ in range(room_count):
+        room, room_offset = unpack_room(body, room_offset)
+        rooms.append(room)
+    return written_at, rooms
+
+class CheckpointWriter:
+    # Appends checkpoint rounds to a file from a background thread, so the tick only pays for packing the rooms.
+    # If the disk falls behind, rounds still waiting are skipped: only the newest one matters.
+    def __init__(self, path, max_file_bytes=MAX_FILE_BYTES):
+        self.path = path
+        self.max_file_bytes = max_file_bytes
+        self.rounds = queue.Queue(maxsize=1)
+        thread = threading.Thread(target=self.write_loop)
+        thread.daemon = True
+        thread.start()
+
+    # Hands a packed round to the writer thread, replacing one it hasn't got to yet.
+    def submit(self, data):
+        try:
+            self.rounds.get_nowait()
+        except queue.Empty:
+            pass
+        self.rounds.put_nowait(data)
+
+    def write_loop(self):
+        while True:
+            data = self.rounds.get()
+            try:
+                self.write(data)
+            except OSError as e:
+                print(f"Failed to write checkpoint to {self.path}: {e}")
+
+    # Appends a round and flushes it to disk; starts a fresh file instead once the current one is too big.
+    def write(self, data):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        if size + len(data) > self.max_file_bytes:
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "wb") as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.path)
+            return
+        with open(self.path, "ab") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
@@ -1,264 +1,1060 @@
 import socket
 import threading
 import json
-import pygame  # Used for the clock in the game loop
+import hmac
+import ipaddress
+import itertools
+import os
+import secrets
+import struct
+import time
+from collections import deque
+from checkpoint import CheckpointWriter, load_checkpoint, pack_room, pack_round
 from game_state import GameState
+from room import Room
+from metrics import Metrics, TimedLock, serve_stats
+from outbound import MAX_PENDING_BYTES, MAX_STALE_FRAMES, SocketConnection
+from rate_limit import CONTROL_BURST, CONTROL_RATE, MESSAGE_BURST, MESSAGE_RATE, MessageLimiter
+from recording import MatchRecorder
+from scheduler import TickScheduler
+from team_layout import TeamLayout
+from compression import SUPPORTED_COMPRESSIONS, StreamCompressor, choose_compression
+from profiler import PROFILE_SECONDS, Profiler, install_profile_signal, parse_profile_seconds
+from protocol import (JSON, READ_SIZE, SUPPORTED_PROTOCOLS, UDP_HEADER, UDP_HELLO, UDP_INPUT, UDP_WELCOME,
+                      MessageBuffer, ProtocolError, choose_protocol, decode_udp_inputs, encode, encode_json,
+                      encode_update)
+from udp_channel import UdpPeer, serve_udp_in_thread
+
+# Broadcast ticks between periodic keyframes, so a client can never drift for long on deltas alone.
+KEYFRAME_INTERVAL = 60
+
+# Default state frame rate for spectators, and the lowest rate a client may ask for (see handle_send_rate).
+SPECTATOR_SEND_RATE = 10
+MIN_SEND_RATE = 1
+
+# Most players a room can hold: player ids travel as one byte, and recordings use its top bit to mark removals.
+MAX_ROOM_PLAYERS = 127
+
+# Default for the most moves a player gets per simulation tick; extra moves queued in the same tick are dropped.
+MAX_MOVES_PER_TICK = 2
 
 class GameServer:
-    # Initializes the server with network settings, lobby state, and sets up message handlers.
-    def __init__(self, host, port, grid_size=15):
+    # Initializes the server with network settings, the room registry, and sets up message handlers.
+    # self.lock guards the room registry; each Room has its own lock for its lobby state.
+    # Lock order is always self.lock before room.lock.
+    # protocols lists the wire protocols clients may negotiate (see protocol.py); pass (JSON,) to force
+    # readable JSON on every connection for debugging.
+    # Every client gets a bounded outbound queue (see outbound.py); a client with more than max_outbound_bytes
+    # waiting, or that misses max_stale_frames state frames in a row, is disconnected as a slow consumer.
+    # If stats_port is set, the metrics registry is served as plain text on http://127.0.0.1:stats_port/.
+    # A profile (see profiler.py) can be captured into profile_dir at any time: GET /profile?seconds=N on the
+    # stats endpoint, SIGUSR1, or the profiler attribute.
+    # Games are simulated tick_rate times a second and state is broadcast broadcast_rate times a second
+    # (default: every tick). Spectators get at most spectator_rate state frames a second.
+    # If record_dir is set, every match is recorded there for replay (see recording.py).
+    # If checkpoint_path is set, every room is checkpointed there each checkpoint_interval seconds, and a server
+    # started on an existing checkpoint restores its rooms. Their players then have reattach_grace seconds to
+    # reconnect to their old slot with the session token from lobby_init before the slot is given up.
+    # Each room holds up to max_players players, split into teams by layout (a TeamLayout; by default a base in
+    # each corner of the grid, see team_layout.py).
+    # Client input is read in large chunks and every complete message in a chunk is dispatched at once. Each
+    # connection may send message_rate moves a second (with bursts of message_burst); the rest are dropped
+    # (messages_rate_limited). Lobby and control messages have their own limit of control_rate a second (with
+    # bursts of control_burst; control_messages_rate_limited), and a disconnect is never dropped. A player's
+    # moves past max_moves_per_tick in one tick are dropped too (inputs_coalesced).
+    # If udp_port is set, clients may also open a UDP channel there for state snapshots and inputs (see
+    # udp_channel.py); lobby, control and start messages stay on TCP, and so does everything for other clients.
+    # With a view_radius, players are only sent the players within that many cells of their own (see interest.py),
+    # so their updates grow with the view rather than the map; spectators still get everything.
+    # compressions lists the stream compression methods clients may negotiate for what the server sends them
+    # (see compression.py); pass () to send everything uncompressed.
+    # Spectator relays get every room's full state, unfiltered by view_radius or the spectator rate, so only a
+    # relay that sends relay_secret may subscribe; without a secret, only relays connecting over loopback may.
+    def __init__(self, host, port, grid_size=15, max_rooms=500, protocols=SUPPORTED_PROTOCOLS,
+                 max_outbound_bytes=MAX_PENDING_BYTES, max_stale_frames=MAX_STALE_FRAMES,
+                 tick_rate=30, stats_port=None, broadcast_rate=None, spectator_rate=SPECTATOR_SEND_RATE,
+                 record_dir=None, checkpoint_path=None, checkpoint_interval=5.0, reattach_grace=30.0,
+                 max_players=4, layout=None, message_rate=MESSAGE_RATE, message_burst=MESSAGE_BURST,
+                 control_rate=CONTROL_RATE, control_burst=CONTROL_BURST, max_moves_per_tick=MAX_MOVES_PER_TICK,
+                 udp_port=None, view_radius=None, compressions=SUPPORTED_COMPRESSIONS, profile_dir="profiles",
+                 relay_secret=None):
+        if not 2 <= max_players <= MAX_ROOM_PLAYERS:
+            raise ValueError(f"Rooms must hold between 2 and {MAX_ROOM_PLAYERS} players")
+        if view_radius is not None and view_radius < 1:
+            raise ValueError("The view radius must be at least one cell")
         self.host = host
         self.port = port
         self.grid_size = grid_size
-        self.game_state = GameState(grid_size)
-        self.clients = []
-        self.clients_lock = threading.Lock()
-        self.player_count = 0
-        self.lock = threading.Lock()
-        
-        self.lobby_state = {
-            'players': [None] * 4,
-            'ready_states': [False] * 4,
-            'sockets': [None] * 4,
-            'addresses': [None] * 4
-        }
-        
+        self.max_players = max_players
+        self.layout = layout or TeamLayout.corners(grid_size)
+        self.message_rate = message_rate
+        self.message_burst = message_burst
+        self.control_rate = control_rate
+        self.control_burst = control_burst
+        self.max_moves_per_tick = max_moves_per_tick
+        self.udp_port = udp_port
+        self.view_radius = view_radius
+        self.compressions = compressions
+        self.relay_secret = relay_secret
+        # The socket (threaded) or datagram transport (event loop) of the UDP port, and its channels by token.
+        self.udp_transport = None
+        self.udp_peers = {}
+        self.max_rooms = max_rooms
+        self.protocols = protocols
+        self.max_outbound_bytes = max_outbound_bytes
+        self.max_stale_frames = max_stale_frames
+        self.tick_rate = tick_rate
+        self.broadcast_rate = broadcast_rate or tick_rate
+        self.spectator_rate = spectator_rate
+        self.record_dir = record_dir
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self.reattach_grace = reattach_grace
+        self.checkpoint_writer = None
+        self.stats_port = stats_port
+        self.metrics = Metrics()
+        self.lock = TimedLock(self.metrics, "server_lock")
+        for counter in ("messages_rate_limited", "control_messages_rate_limited", "messages_malformed",
+                        "inputs_coalesced", "udp_stale_datagrams", "udp_unknown_datagrams", "udp_fallbacks"):
+            self.metrics.count(counter, 0)
+
+        self.rooms = {}
+        # Rooms with a game in progress; only these are ticked by the game loop.
+        self.active_rooms = {}
+        self.room_ids = itertools.count(1)
+        # GameStates of matches that have ended, whose recordings the game loop finishes on its next tick.
+        self.finished_games = deque()
+
         self.message_handlers = {
             'input': self.handle_input,
             'ready': self.handle_ready_toggle,
             'start_request': self.handle_start_request,
-            'disconnect': self.handle_disconnect_message
+            'disconnect': self.handle_disconnect_message,
+            'keyframe_request': self.handle_keyframe_request,
+            'send_rate': self.handle_send_rate,
+            'udp': self.handle_udp_toggle
         }
-    
-    # Returns True if at least two players are ready — used to validate game start conditions.
-    def check_can_start(self):
-        players = self.lobby_state['players']
-        ready = self.lobby_state['ready_states']
-        ready_count = sum(
-            1 for p, r in zip(players, ready) if p is not None and r
-        )
-        return ready_count >= 2
-    
-    # If enough players are ready, initializes a new game state 
+        self.profiler = Profiler("server", profile_dir)
+        self.profiler.set_sections(self.profile_sections())
+
+    # The functions profile samples are attributed to (see Profiler.set_sections): the game loop, the state
+    # broadcast and every message handler.
+    def profile_sections(self):
+        sections = {"game_loop": self.game_loop, "broadcast_game_state": self.broadcast_game_state}
+        sections.update((f"handler:{message_type}", handler) for message_type, handler in self.message_handlers.items())
+        return sections
+
+    # Admin request from the stats endpoint (GET /profile?seconds=N): starts a profile capture of up to
+    # profiler.MAX_PROFILE_SECONDS and says where it will be written. Raises ValueError (a 400 response) if seconds
+    # isn't a positive, finite number.
+    def handle_profile_request(self, query):
+        seconds = parse_profile_seconds(query.get("seconds", [PROFILE_SECONDS])[0])
+        if not self.profiler.start(seconds):
+            return "A profile is already being captured\n"
+        return f"Profiling for {seconds:g}s into {os.path.abspath(self.profiler.directory)}\n"
+
+    # Creates and registers a new empty room. Caller must hold self.lock.
+    # Returns None if the server already hosts max_rooms rooms.
+    def create_room(self):
+        if len(self.rooms) >= self.max_rooms:
+            return None
+        room = Room(next(self.room_ids), self.grid_size, self.max_players, lock=TimedLock(self.metrics, "room_lock"),
+                    view_radius=self.view_radius)
+        self.rooms[room.room_id] = room
+        print(f"Created room {room.room_id} ({len(self.rooms)} rooms open)")
+        return room
+
+    # Returns the first room still accepting players in its lobby, or None. Caller must hold self.lock.
+    def find_open_room(self):
+        for room in self.rooms.values():
+            if room.is_open():
+                return room
+        return None
+
+    # Removes an empty room from the registry so it is no longer ticked or joinable.
+    def teardown_room(self, room):
+        with self.lock:
+            with room.lock:
+                if room.player_count > 0:  # Someone joined in the meantime
+                    return
+                room.closed = True
+                relays, room.relays = room.relays, []
+                if room.in_game:
+                    self.finished_games.append(room.game_state)
+            self.rooms.pop(room.room_id, None)
+            self.active_rooms.pop(room.room_id, None)
+        for connection, _ in relays:
+            connection.close()
+        print(f"Closed room {room.room_id} ({len(self.rooms)} rooms open)")
+
+    # Returns the team layout for a room's grid: the server's own, unless a restored room has another grid size.
+    def layout_for(self, room):
+        if room.grid_size == self.layout.grid_size:
+            return self.layout
+        return TeamLayout.corners(room.grid_size)
+
+    # Looks up the room a message belongs to, or None if it has been torn down.
+    def get_room(self, message):
+        return self.rooms.get(message.get('room_id'))
+
+    # If enough players are ready, initializes a new game state
     # and sends a start signal to all ready players.
     def handle_start_request(self, message):
-        with self.lock:
-            if self.check_can_start():
+        room = self.get_room(message)
+        if room is None:
+            return
+        started = False
+        with room.lock:
+            if room.check_can_start():
                 connected_ready_ids = [
-                    i + 1 for i, (p, r) in enumerate(zip(self.lobby_state['players'], self.lobby_state['ready_states']))
+                    i + 1 for i, (p, r) in enumerate(zip(room.lobby_state['players'], room.lobby_state['ready_states']))
                     if p is not None and r
                 ]
-                self.broadcast_game_start()
-                self.game_state = GameState(self.grid_size, connected_ready_ids)
-                
-    # Sends a game_start message to all players in the lobby.
-    def broadcast_game_start(self):
-        start_msg = json.dumps({"type": "game_start"}) + "\n"
-        for i, socket in enumerate(self.lobby_state["sockets"]):
-            if socket:
-                try:
-                    socket.sendall(start_msg.encode())
-                except Exception as e:
-                    print(f"Failed to send start to player {i + 1}: {e}")
-                    self.cleanup_player(i)
-
-    # Continuously sends the current game state to all clients — used in the game loop.
-    def broadcast_game_state(self):
-        state = {"type": "update"}
-        state.update(self.game_state.get_state())
-        message = json.dumps(state) + "\n"
-        message = message.encode()
-        
-        for i, socket in enumerate(self.lobby_state["sockets"]):
-            if socket:
-                try:
-                    socket.sendall(message)
-                except Exception as e:
-                    print(f"Failed to send game state to player {i + 1}: {e}")
-                    pass
+                self.broadcast_game_start(room)
+                if room.in_game:
+                    self.finished_games.append(room.game_state)
+                room.game_state = GameState(room.grid_size, connected_ready_ids, layout=self.layout_for(room))
+                room.game_state.max_moves_per_tick = self.max_moves_per_tick
+                if self.record_dir is not None:
+                    room.game_state.recorder = MatchRecorder.create(self.record_dir, room.room_id, room.game_state,
+                                                                     self.tick_rate)
+                room.in_game = True
+                for i, _ in room.connected_sockets():
+                    self.apply_send_rate(room, i)
+                started = True
+        if started:
+            with self.lock:
+                if not room.closed:
+                    self.active_rooms[room.room_id] = room
+
+    # Encodes message in the given protocol, reusing the bytes if another client in the same
+    # broadcast already needed that encoding. cache maps protocol -> encoded message.
+    def encode_once(self, cache, message, protocol):
+        payload = cache.get(protocol)
+        if payload is None:
+            with self.metrics.timer("broadcast_encode"):
+                payload = cache[protocol] = encode(message, protocol)
+        return payload
+
+    # Sends a game_start message to all players in the room.
+    def broadcast_game_start(self, room):
+        start_msg = {"type": "game_start", "room_id": room.room_id}
+        encoded = {}
+        for i, socket in room.connected_sockets():
+            try:
+                socket.send(self.encode_once(encoded, start_msg, room.protocol_of(i)))
+            except Exception as e:
+                print(f"Failed to send start to player {i + 1}: {e}")
+                # The caller holds room.lock, so closing is enough: the client's
+                # read loop ends and cleans up the slot once the lock is released.
+                socket.close()
+
+    # Sends the room's game state changes to its clients — used in the game loop.
+    # Clients that are up to date get a compact delta; new clients, clients that asked for one,
+    # and everyone every KEYFRAME_INTERVAL ticks get a full keyframe instead.
+    # Nothing is sent when the state version hasn't changed. Each message is encoded once per tick and protocol.
+    # Sends only queue the frame. A client whose previous frame is still queued (is_behind) gets a keyframe,
+    # which replaces the stale frame in its queue, since a delta can't be applied without the one before it.
+    # Clients on a reduced send rate are skipped until they are due (is_due at monotonic time now); they
+    # missed the deltas in between, so they get a keyframe if the state moved on since their last frame.
+    # Clients with a working UDP channel get every change as a keyframe datagram instead: a lost datagram is
+    # simply superseded by the next one, which a delta couldn't be. In a room with a view radius, every player's
+    # frame is cut down to their view and encoded for them alone; spectator relays share the full frames.
+    def broadcast_game_state(self, room, now=None):
+        game_state = room.game_state
+        if game_state is not room.broadcast_source:
+            # A new game started: versions from the previous GameState mean nothing now.
+            room.broadcast_source = game_state
+            room.sent_versions = {}
+            room.ticks_since_keyframe = 0
+            if room.interest is not None:
+                room.interest.reset()
+
+        now = time.monotonic() if now is None else now
+        connected = [subscriber for subscriber in room.subscribers() if subscriber[1].is_due(now)]
+        udp = {key for key, socket, _ in connected if socket.udp_peer is not None}
+        room.ticks_since_keyframe += 1
+        # Only replace a real change with a keyframe, so idle rooms still send (and encode) nothing.
+        changed = game_state.version != game_state.delta_base
+        periodic = room.ticks_since_keyframe >= KEYFRAME_INTERVAL and changed
+        # Clients whose last frame is neither the current state nor this delta's base.
+        lagging = {
+            key for key, _, _ in connected
+            if key not in udp and room.sent_versions.get(key) not in (None, game_state.version, game_state.delta_base)
+        }
+        needs_keyframe = periodic or bool(lagging) or (changed and bool(udp)) or any(
+            room.sent_versions.get(key) is None or (changed and socket.is_behind()) for key, socket, _ in connected
+        )
+        delta, state = game_state.collect_delta(include_state=needs_keyframe)
+        if delta is None and not needs_keyframe:
+            return
+        if periodic:
+            room.ticks_since_keyframe = 0
+
+        keyframe_message = {"type": "update", "room_id": room.room_id, "keyframe": True}
+        if state is not None:
+            keyframe_message.update(state)
+        delta_message = {"type": "delta", "room_id": room.room_id}
+        if delta is not None:
+            delta_message.update(delta)
+        interest = room.interest
+        keyframes = {}
+        deltas = {}
+        udp_payload = None
+        send_time = 0.0
+        for key, socket, protocol in connected:
+            sent = room.sent_versions.get(key)
+            if key in udp:
+                peer = socket.udp_peer
+                if peer is None or state is None or sent == state["version"]:
+                    continue
+                if interest is not None:
+                    with self.metrics.timer("broadcast_encode"):
+                        peer.send_state(self.udp_transport,
+                                        encode_update(interest.filter_keyframe(key, game_state, keyframe_message)))
+                else:
+                    if udp_payload is None:
+                        with self.metrics.timer("broadcast_encode"):
+                            udp_payload = encode_update(keyframe_message)
+                    peer.send_state(self.udp_transport, udp_payload)
+                room.sent_versions[key] = state["version"]
+                continue
+            behind = (delta is not None and socket.is_behind()) or key in lagging
+            if sent is None or (delta is not None and periodic) or (behind and state is not None):
+                if interest is not None and isinstance(key, int):
+                    with self.metrics.timer("broadcast_encode"):
+                        payload = encode(interest.filter_keyframe(key, game_state, keyframe_message), protocol)
+                else:
+                    payload = self.encode_once(keyframes, keyframe_message, protocol)
+                version = state["version"]
+            elif behind:
+                # The state changed after needs_keyframe was decided; catch this client up next tick.
+                room.sent_versions[key] = None
+                continue
+            elif delta is not None and sent == delta["base"]:
+                if interest is not None and isinstance(key, int):
+                    with self.metrics.timer("broadcast_encode"):
+                        payload = encode(interest.filter_delta(key, game_state, delta_message), protocol)
+                else:
+                    payload = self.encode_once(deltas, delta_message, protocol)
+                version = delta["version"]
+            else:
+                continue
+            started = time.perf_counter()
+            try:
+                socket.send_state(payload)
+                room.sent_versions[key] = version
+            except Exception as e:
+                print(f"Failed to send game state to {room.describe(key)}: {e}")
+                pass
+            send_time += time.perf_counter() - started
+        self.metrics.observe("broadcast_send", send_time)
+
+    # A client detected a gap in the delta stream; send it a full keyframe on the next tick.
+    def handle_keyframe_request(self, message):
+        room = self.get_room(message)
+        player_id = message.get("player_id")
+        if room is not None and player_id is not None:
+            room.sent_versions[player_id] = None
     
-    # Sends the current lobby info (players, ready states, etc.) to all connected players.
-    def broadcast_lobby_state(self):
+    # A client reports how many state frames a second it can take, e.g. on a low-bandwidth link.
+    # The rate is clamped to MIN_SEND_RATE..broadcast_rate; a missing rate or 0 asks for the full rate again.
+    def handle_send_rate(self, message):
+        room = self.get_room(message)
+        player_id = message.get("player_id")
+        if room is None or player_id is None:
+            return
+        with room.lock:
+            connection = room.connection_of(player_id)
+            if connection is None:
+                return
+            rate = message.get("rate")
+            connection.requested_rate = max(MIN_SEND_RATE, rate) if rate else None
+            self.apply_send_rate(room, player_id)
+
+    # A client reports whether its UDP channel works ("enabled"): its state frames move to the channel, or back
+    # to TCP once the client has stopped hearing from it. Either way its next frame is a keyframe.
+    # player_id is the sender's own slot (see dispatch_message), and only a channel opened for that same
+    # connection and slot is used.
+    def handle_udp_toggle(self, message):
+        room = self.get_room(message)
+        player_id = message.get("player_id")
+        if room is None or player_id is None:
+            return
+        with room.lock:
+            connection = room.connection_of(player_id)
+            if connection is None:
+                return
+            peer = self.udp_peers.get(connection.udp_token)
+            if peer is not None and (peer.connection is not connection or peer.player_id != player_id):
+                peer = None
+            if message.get("enabled") and peer is not None and peer.address is not None:
+                connection.udp_peer = peer
+            else:
+                if connection.udp_peer is not None:
+                    self.metrics.count("udp_fallbacks")
+                connection.udp_peer = None
+            room.sent_versions[player_id] = None
+
+    # Offers a UDP channel to a client whose join message asked for one ("udp"), if the server has a UDP port.
+    # The token goes out in lobby_init. Caller must hold room.lock.
+    def open_udp_peer(self, room, player_id, connection, join_message):
+        if self.udp_port is None or not join_message.get('udp'):
+            return
+        token = secrets.randbelow(2 ** 63 - 1) + 1
+        connection.udp_token = token
+        self.udp_peers[token] = UdpPeer(room, player_id, connection, token, self.message_rate, self.message_burst)
+
+    # Closes a connection's UDP channel, if it has one.
+    def close_udp_peer(self, connection):
+        connection.udp_peer = None
+        if connection.udp_token is not None:
+            self.udp_peers.pop(connection.udp_token, None)
+
+    # Handles one datagram on the UDP port (see protocol.py). A hello (re)opens its channel from the sender's
+    # address and is answered with a welcome. An input datagram's inputs newer than the last one taken from the
+    # channel are dispatched like TCP input, within the channel's rate limit; older or duplicate ones are dropped.
+    # Inputs that already came over TCP before the channel opened are skipped by the tick (see GameState.step).
+    # Datagrams with an unknown token or that can't be parsed are dropped and counted.
+    def handle_datagram(self, data, address):
+        try:
+            kind, token, seq = UDP_HEADER.unpack_from(data)
+        except struct.error:
+            self.metrics.count("udp_unknown_datagrams")
+            return
+        peer = self.udp_peers.get(token)
+        if peer is None:
+            self.metrics.count("udp_unknown_datagrams")
+            return
+        peer.address = address
+        if kind == UDP_HELLO:
+            try:
+                self.udp_transport.sendto(UDP_HEADER.pack(UDP_WELCOME, token, seq), address)
+            except OSError:
+                pass
+        elif kind == UDP_INPUT:
+            if seq <= peer.last_input_seq:
+                self.metrics.count("udp_stale_datagrams")
+                return
+            if not peer.limiter.allow():
+                self.metrics.count("messages_rate_limited")
+                return
+            try:
+                inputs = decode_udp_inputs(data[UDP_HEADER.size:])
+            except ProtocolError:
+                self.metrics.count("messages_malformed")
+                return
+            for input_seq, dx, dy in inputs:
+                if input_seq > peer.last_input_seq:
+                    peer.last_input_seq = input_seq
+                    self.dispatch_message({"type": "input", "room_id": peer.room.room_id, "seq": input_seq,
+                                           "move": {"dx": dx, "dy": dy}}, peer.room, peer.player_id)
+
+    # Sets the state frame rate of the client in a slot: every broadcast for players in the game, at most
+    # spectator_rate for spectators, and never more than the client asked for. Caller must hold room.lock.
+    def apply_send_rate(self, room, player_id):
+        connection = room.lobby_state['sockets'][player_id]
+        rates = [connection.requested_rate]
+        if room.in_game and (player_id + 1) not in room.game_state.players:
+            rates.append(self.spectator_rate)
+        rates = [rate for rate in rates if rate and rate < self.broadcast_rate]
+        connection.set_send_rate(min(rates) if rates else None)
+
+    # Sends the room's lobby info (players, ready states, etc.) to all of its connected players.
+    def broadcast_lobby_state(self, room):
         state = {
             'type': 'lobby_update',
-            'players': self.lobby_state['players'],
-            'ready_states': self.lobby_state['ready_states'],
-            'can_start':  self.check_can_start()
+            'room_id': room.room_id,
+            'players': room.lobby_state['players'],
+            'ready_states': room.lobby_state['ready_states'],
+            'can_start':  room.check_can_start()
         }
         print(f"\nPreparing to broadcast: {state}")  # Debug print
-        
-        encoded = (json.dumps(state) + '\n').encode()
-        # print(f"Sockets: {self.lobby_state['sockets']}")  # Debug sockets
-        for i, socket in enumerate(self.lobby_state["sockets"]):
-            if socket:
-                try:
-                    print(f"Sending lobby state to player {i + 1}")
-                    socket.sendall(encoded)
-                except Exception as e:
-                    print(f"Failed to send to player {i + 1}: {e}") 
-                    pass
-        
-    # Assigns a player to a lobby slot if available, initializes their data, and notifies all clients.
-    # returns assigned player id or -1 if if failed
-    def initialize_lobby(self, client_socket, address) -> int:
-        for i in range(4):
-            if self.lobby_state['players'][i] is None:
-                self.lobby_state['players'][i] = f"Player_{i+1}"
-                self.lobby_state['sockets'][i] = client_socket
-                self.lobby_state['ready_states'][i] = False
-                self.lobby_state['addresses'][i] = address
-                # player_id is equal to i
-                self.send_lobby_init(client_socket, i)
-                
-                # broadcast to everyone when someone new joins
-                self.broadcast_lobby_state()
-                
-                print(f"Sent lobby initialization to ", address)
-                return i
-            
-        return -1
-        
-    # Handles individual client connection: processes incoming messages and dispatches them to handlers.
-    # Each client has its own thread handled by the server.
+
+        encoded = {}
+        for i, socket in room.connected_sockets():
+            try:
+                print(f"Sending lobby state to player {i + 1} in room {room.room_id}")
+                socket.send(self.encode_once(encoded, state, room.protocol_of(i)))
+            except Exception as e:
+                print(f"Failed to send to player {i + 1}: {e}")
+                pass
+
+    # Assigns a player to a free slot in the room, initializes their data and sends them lobby_init.
+    # Caller must hold room.lock. The socket only goes into its slot once lobby_init is queued on it, so no
+    # lobby or state broadcast (the game loop's doesn't take room.lock) can reach the client before it.
+    # returns assigned player id or -1 if the room is full
+    def initialize_lobby(self, room, client_socket, address, join_message, protocol=JSON) -> int:
+        i = room.free_slot()
+        if i == -1:
+            return -1
+        room.lobby_state['players'][i] = f"Player_{i+1}"
+        room.lobby_state['ready_states'][i] = False
+        room.lobby_state['addresses'][i] = address
+        room.lobby_state['protocols'][i] = protocol
+        room.sessions[i] = secrets.randbelow(2 ** 63 - 1) + 1
+        room.sent_versions[i] = None
+        room.player_count += 1
+        self.open_udp_peer(room, i, client_socket, join_message)
+        client_socket.compression = choose_compression(join_message.get('compression'), self.compressions)
+        self.send_lobby_init(room, client_socket, i)
+        room.lobby_state['sockets'][i] = client_socket
+        return i
+
+    # Puts a reconnecting player back into the slot their session token belongs to, e.g. after a server restart.
+    # Replies like a normal join: lobby_init, or join_error if the slot is gone. Returns (room, player_id, protocol).
+    def reattach_client(self, client_socket, address, join_message):
+        room = self.get_room(join_message)
+        protocol = choose_protocol(join_message.get('protocols'), self.protocols)
+        player_id = -1
+        if room is not None:
+            with room.lock:
+                player_id = room.reserved_slot(join_message.get('session'))
+                if player_id != -1:
+                    room.lobby_state['addresses'][player_id] = address
+                    room.lobby_state['protocols'][player_id] = protocol
+                    room.reserved_until[player_id] = None
+                    room.sent_versions[player_id] = None
+                    self.open_udp_peer(room, player_id, client_socket, join_message)
+                    client_socket.compression = choose_compression(join_message.get('compression'), self.compressions)
+                    # As in initialize_lobby: lobby_init is queued before anything else can be sent to the slot.
+                    self.send_lobby_init(room, client_socket, player_id)
+                    room.lobby_state['sockets'][player_id] = client_socket
+                    self.broadcast_lobby_state(room)
+        if player_id == -1:
+            error = "Your slot is no longer available"
+            print(f"Rejecting reattach from {address}: {error}")
+            self.send_join_error(client_socket, error)
+            client_socket.close()
+            return None, -1, JSON
+        print(f"Player {player_id} reattached to room {room.room_id} from {address}")
+        return room, player_id, protocol
+
+    # Places a newly connected client according to its join message:
+    # - "create": open a new room
+    # - "room_id": join that room by id, unless its game has already started
+    # - neither: join the first open room, creating one if none is open
+    # The wire protocol for the rest of the connection is picked from the join message's "protocols" offer.
+    # Sends lobby_init and a lobby broadcast on success; on failure sends join_error and closes the socket.
+    # Shared by the threaded and event-loop server modes; returns (room, player_id, protocol) or (None, -1, JSON).
+    # A join carrying a "session" token is a reattach to an earlier slot (see reattach_client).
+    def register_client(self, client_socket, address, join_message):
+        if join_message.get('session') is not None:
+            return self.reattach_client(client_socket, address, join_message)
+        requested_id = join_message.get('room_id')
+        protocol = choose_protocol(join_message.get('protocols'), self.protocols)
+        error = None
+        room = None
+        player_id = -1
+        with self.lock:
+            if join_message.get('create'):
+                room = self.create_room()
+            elif requested_id is not None:
+                room = self.rooms.get(requested_id)
+            else:
+                room = self.find_open_room() or self.create_room()
+
+            if room is None:
+                error = f"Room {requested_id} does not exist" if requested_id is not None else "Server is full"
+            else:
+                with room.lock:
+                    if room.in_game or room.closed:
+                        error = f"Room {room.room_id} has already started"
+                    else:
+                        player_id = self.initialize_lobby(room, client_socket, address, join_message, protocol)
+                        if player_id == -1:
+                            error = f"Room {room.room_id} is full"
+                        else:
+                            # broadcast to everyone when someone new joins
+                            self.broadcast_lobby_state(room)
+
+        if error:
+            print(f"Rejecting {address}: {error}")
+            self.send_join_error(client_socket, error)
+            client_socket.close()
+            return None, -1, JSON
+
+        print(f"Sent lobby initialization for room {room.room_id} to ", address, f"({protocol} protocol)")
+        return room, player_id, protocol
+
+    # Subscribes a spectator relay (see spectator_relay.py) to a room's state stream. The relay receives
+    # exactly what a player receives, once per room however many spectators it serves, and sends nothing back.
+    # Replies with relay_init, always as JSON, or join_error. Returns (room, protocol) or (None, JSON).
+    def register_relay(self, connection, address, join_message):
+        if not self.relay_allowed(address, join_message):
+            error = "Spectator relays need the server's relay secret"
+            print(f"Rejecting relay {address}: {error}")
+            self.send_join_error(connection, error)
+            connection.close()
+            return None, JSON
+        room = self.get_room(join_message)
+        if room is None:
+            error = f"Room {join_message.get('room_id')} does not exist"
+            print(f"Rejecting relay {address}: {error}")
+            self.send_join_error(connection, error)
+            connection.close()
+            return None, JSON
+        protocol = choose_protocol(join_message.get('protocols'), self.protocols)
+        with room.lock:
+            if room.closed:
+                connection.close()
+                return None, JSON
+            connection.send(encode_json({
+                "type": "relay_init",
+                "room_id": room.room_id,
+                "protocol": protocol,
+                "grid_size": room.grid_size,
+                "bases": [list(base) for base in self.layout_for(room).bases],
+            }))
+            room.relays.append((connection, protocol))
+        print(f"Spectator relay {address} subscribed to room {room.room_id} ({protocol} protocol)")
+        return room, protocol
+
+    # Whether a relay join may subscribe: it carries the relay secret, or there is none and it came over loopback.
+    def relay_allowed(self, address, join_message):
+        if self.relay_secret is not None:
+            secret = join_message.get("secret")
+            return isinstance(secret, str) and hmac.compare_digest(secret.encode(), self.relay_secret.encode())
+        try:
+            return ipaddress.ip_address(address[0]).is_loopback
+        except (ValueError, TypeError, IndexError):
+            return False
+
+    # Unsubscribes a relay once its connection has ended.
+    def remove_relay(self, room, connection):
+        with room.lock:
+            room.relays = [(relay, protocol) for relay, protocol in room.relays if relay is not connection]
+            room.sent_versions.pop(connection, None)
+        connection.close()
+
+    # Tells a client why it could not be placed in a room.
+    def send_join_error(self, client_socket, error):
+        try:
+            client_socket.send(encode_json({"type": "join_error", "message": error}))
+        except Exception:
+            pass
+
+    # Parses the join message a client sends right after connecting. Anything else is treated as
+    # a request to be matched into any open room.
+    def parse_join(self, line):
+        try:
+            message = json.loads(line)
+        except json.JSONDecodeError:
+            return {}
+        if not isinstance(message, dict) or message.get("type") != "join":
+            return {}
+        return message
+
+    # Dispatches every complete message waiting in a connection's MessageBuffer, from the client in slot
+    # player_id. Messages beyond the connection's rate limits (a MessageLimiter) are dropped: moves and other
+    # messages have separate limits, so a client flooding moves can't lose its ready or start. Dropped and
+    # malformed messages are counted in the metrics.
+    def dispatch_buffered(self, buffer, room, limiter, player_id):
+        malformed = buffer.malformed
+        limited = 0
+        control_limited = 0
+        for message in buffer.drain():
+            message_type = message.get("type")
+            if limiter.allow(message_type):
+                self.dispatch_message(message, room, player_id)
+            elif message_type == "input":
+                limited += 1
+            else:
+                control_limited += 1
+        if limited:
+            self.metrics.count("messages_rate_limited", limited)
+        if control_limited:
+            self.metrics.count("control_messages_rate_limited", control_limited)
+        if buffer.malformed != malformed:
+            self.metrics.count("messages_malformed", buffer.malformed - malformed)
+
+    # Routes one decoded client message to its handler in message_handlers.
+    # Messages are scoped to the sender's room and slot: a room_id that doesn't match the connection is ignored,
+    # and "player_id" is always set to the sender's own slot, whatever the message says, so a client can't act
+    # for another one. Spectator relays (player_id -1) have no slot, and nothing they send is handled.
+    def dispatch_message(self, message, room, player_id):
+        if message.setdefault("room_id", room.room_id) != room.room_id:
+            print(f"Ignoring message for room {message['room_id']} from a client in room {room.room_id}")
+            return
+        if player_id == -1:
+            return
+        message["player_id"] = player_id
+        message_type = message.get("type")
+
+        handler = self.message_handlers.get(message_type)
+        if handler:
+            with self.metrics.timer(f"handler_{message_type}"):
+                handler(message)
+        else:
+            # shouldn't hit error when using gui
+            print(f"Unhandled message type from client: {message_type}")
+
+    # Handles individual client connection: reads the join message, then processes incoming messages
+    # in the negotiated protocol and dispatches them to handlers. Each client has its own thread handled by the server,
+    # plus a writer thread that drains its outbound queue.
+    # Each wakeup reads up to READ_SIZE bytes and dispatches every complete message in them (see dispatch_buffered).
     def handle_client(self, client_socket, address):
         print(f"Client {address} connected.")
-        player_id = -1
+        connection = SocketConnection(client_socket, self.max_outbound_bytes, self.max_stale_frames)
+        buffer = MessageBuffer(on_read=connection.count_received)
+        room, player_id = None, -1
         try:
-            with self.lock:
-                print(f"Currently there are {self.player_count} players")
-                if self.player_count >= 4:
-                    client_socket.close()
-                    return
-                    
-                player_id = self.initialize_lobby(client_socket, address)
-                if player_id == -1:
-                    print(f"Too many players, reject {address}")
-                    client_socket.close()
+            line = buffer.read_line()
+            while line is None:
+                data = client_socket.recv(READ_SIZE)
+                if not data:
                     return
-                
-                self.player_count += 1
-            file = client_socket.makefile('r')
-            for line in file:
-                try:
-                    message = json.loads(line)
-                    message_type = message.get("type")
-                    
-                    handler = self.message_handlers.get(message_type)
-                    if handler:
-                        handler(message)
-                    else:
-                        # shouldn't hit error when using gui
-                        print(f"Unhandled message type from client: {message_type}")
-                except json.JSONDecodeError:
-                    continue
-        except ConnectionError:
+                buffer.feed(data)
+                line = buffer.read_line()
+            join_message = self.parse_join(line)
+            if join_message.get('relay'):
+                room, protocol = self.register_relay(connection, address, join_message)
+            else:
+                room, player_id, protocol = self.register_client(connection, address, join_message)
+            if room is None:
+                return
+            buffer.protocol = protocol
+            limiter = MessageLimiter(self.message_rate, self.message_burst, self.control_rate, self.control_burst)
+            while True:
+                self.dispatch_buffered(buffer, room, limiter, player_id)
+                data = client_socket.recv(READ_SIZE)
+                if not data:
+                    break
+                buffer.feed(data)
+        except OSError:
             print(f"Client {address} disconnected abruptly")
         finally:
-            self.handle_network_disconnect(player_id)
-    
-    # Sends initial lobby info to a new player, including their ID, 
-    # current lobby state, and whether they're the host.
-    def send_lobby_init(self, socket, player_id):
+            self.handle_network_disconnect(room, player_id, connection)
+
+    # Sends initial lobby info to a new player, including their room, ID, the negotiated wire protocol, the grid size
+    # and team bases, current lobby state, whether they're the host, the view radius if the server filters state
+    # by view, the UDP channel's port and token if they were offered one, and the negotiated stream compression.
+    # Always sent as JSON and uncompressed; later messages use the protocol, and the compression if there is one.
+    def send_lobby_init(self, room, socket, player_id):
         print(f"Broadcasting lobby state to all players")
         init_msg = {
             "type": "lobby_init",
+            "room_id": room.room_id,
             "your_id": player_id,
+            "protocol": room.protocol_of(player_id),
+            "grid_size": room.grid_size,
+            "bases": [list(base) for base in self.layout_for(room).bases],
             "is_host": (player_id == 0), # todo: host logic
-            "players": self.lobby_state['players'],
-            "ready_states": self.lobby_state['ready_states'],
-            "can_start": self.check_can_start()
+            "session": room.sessions[player_id],
+            "players": room.lobby_state['players'],
+            "ready_states": room.lobby_state['ready_states'],
+            "can_start": room.check_can_start()
         }
-        if self.lobby_state['sockets'][player_id] is not None:
-            socket.sendall(json.dumps(init_msg).encode() + b'\n')
-    
+        if self.view_radius is not None:
+            init_msg["view_radius"] = self.view_radius
+        if socket.udp_token is not None:
+            init_msg["udp"] = {"port": self.udp_port, "token": socket.udp_token}
+        if socket.compression is not None:
+            init_msg["compression"] = socket.compression
+        try:
+            socket.send(encode_json(init_msg))
+        except ConnectionError as e:
+            # The client's read loop ends with the connection and frees the slot.
+            print(f"Failed to send lobby_init to player {player_id + 1}: {e}")
+            return
+        if socket.compression is not None:
+            socket.start_compression(StreamCompressor(socket.compression))
+
     # Toggles a player’s ready status and broadcasts the updated lobby state.
     def handle_ready_toggle(self, message):
+        room = self.get_room(message)
+        if room is None:
+            return
         player_id = message.get("player_id")
-        with self.lock:
-            current_ready_state = self.lobby_state["ready_states"][player_id]
-            
-            self.lobby_state["ready_states"][player_id] = not current_ready_state
-            print(f"Updating ready state of player with id", player_id)
+        with room.lock:
+            current_ready_state = room.lobby_state["ready_states"][player_id]
+
+            room.lobby_state["ready_states"][player_id] = not current_ready_state
+            print(f"Updating ready state of player with id", player_id, "in room", room.room_id)
             print(f"Player with id", player_id, "ready:", current_ready_state)
-            self.broadcast_lobby_state()
-            if all(self.lobby_state["ready_states"]):
-                # maybe start
-                pass
-    
-    # Processes movement input from a player and updates their position in the game state.
+            self.broadcast_lobby_state(room)
+
+    # Queues movement input from a player, tagged with its client sequence number ("seq"), which the tick uses
+    # to skip inputs it has already applied. The room's next simulation tick applies it (see tick_room); inputs
+    # outside a game are ignored, and so are inputs whose seq isn't an integer.
     def handle_input(self, message):
+        room = self.get_room(message)
+        if room is None or not room.in_game:
+            return
         lobby_id = message.get("player_id")
-        game_state_id = lobby_id + 1  # Convert to 1-4 for GameState
+        game_state_id = lobby_id + 1  # GameState ids start at 1
+        seq = message.get("seq")
+        if seq is not None and (not isinstance(seq, int) or isinstance(seq, bool)):
+            return
         move = message.get("move", {})
         dx = move.get("dx", 0)
         dy = move.get("dy", 0)
-        self.game_state.move_player(game_state_id, dx, dy)
-    
-    # Called when a player disconnects abruptly (e.g., connection error); cleans up their lobby slot.
-    def handle_network_disconnect(self, player_id: int):
-        self.cleanup_player(player_id)
-    
+        room.game_state.queue_input(game_state_id, seq, dx, dy)
+
+    # Called when a player's connection ends (e.g., connection error); cleans up their lobby slot.
+    # A connection without a slot may be a spectator relay, which is unsubscribed instead.
+    def handle_network_disconnect(self, room, player_id: int, client_socket):
+        if room is None:
+            return
+        if player_id == -1:
+            self.remove_relay(room, client_socket)
+        else:
+            self.cleanup_player(room, player_id, client_socket)
+
     # Handles an intentional disconnect message from a player.
     def handle_disconnect_message(self, message):
+        room = self.get_room(message)
         player_id = message.get('player_id')
-        if player_id is not None:
-            self.cleanup_player(player_id)
-    
-    # Clears all player data (name, socket, etc.) from the lobby and broadcasts the update.
-    def cleanup_player(self, player_id):
-        with self.lock:
-            address = self.lobby_state['addresses'][player_id]
-            client_socket = self.lobby_state['sockets'][player_id]
-            
-            if player_id == -1:  # Never got assigned a slot
+        if room is not None and player_id is not None:
+            self.cleanup_player(room, player_id)
+
+    # Clears all player data (name, socket, etc.) from the room's lobby and broadcasts the update.
+    # If client_socket is given, only clears the slot while it still belongs to that socket.
+    # Tears the room down once its last player has left.
+    def cleanup_player(self, room, player_id, client_socket=None):
+        if player_id == -1:  # Never got assigned a slot
+            return
+        with room.lock:
+            address = room.lobby_state['addresses'][player_id]
+            slot_socket = room.lobby_state['sockets'][player_id]
+
+            if slot_socket is None:  # Already cleaned up (disconnect message, then socket closed)
                 return
-            try:         
+            if client_socket is not None and slot_socket is not client_socket:
+                return
+            try:
                 # Clear the player's slot
-                self.lobby_state['players'][player_id] = None
-                self.lobby_state['sockets'][player_id] = None
-                self.lobby_state['ready_states'][player_id] = False
-                self.lobby_state['addresses'][player_id] = None
-                self.player_count -= 1
-                            
-                self.game_state.remove_player(player_id + 1)
-
-                print(f"Player {player_id} has left the game")
+                room.clear_slot(player_id)
+                self.close_udp_peer(slot_socket)
+
+                room.game_state.queue_removal(player_id + 1)
+
+                print(f"Player {player_id} has left room {room.room_id}")
             except (ConnectionResetError):
                 print(f"Client {address} disconnected abruptly")
             finally:
-                if client_socket is not None:
-                    client_socket.close()
-                self.broadcast_game_state()
-                self.broadcast_lobby_state()
+                slot_socket.close()
+                # The removal is applied and reaches the other players as a delta on the next game tick.
+                self.broadcast_lobby_state(room)
+            empty = room.player_count == 0
+        if empty:
+            self.teardown_room(room)
 
-    # Runs in a separate thread, repeatedly broadcasts the game state at 30 FPS.
+    # Returns a snapshot of the rooms that currently have a game in progress.
+    def get_active_rooms(self):
+        with self.lock:
+            return list(self.active_rooms.values())
+
+    # One fixed simulation step for a room: applies the inputs queued since the last tick in arrival order.
+    # This is the only place a running game's GameState is written.
+    def tick_room(self, room):
+        coalesced = room.game_state.step()
+        if coalesced:
+            self.metrics.count("inputs_coalesced", coalesced)
+
+    # Simulation task: finishes the recordings of matches that ended since the last tick, then steps every
+    # active room once and records how long that took.
+    def simulate_rooms(self):
+        started = time.perf_counter()
+        while self.finished_games:
+            self.finished_games.popleft().finish_recording()
+        for room in self.get_active_rooms():
+            self.tick_room(room)
+        self.metrics.observe("tick_duration", time.perf_counter() - started)
+
+    # Broadcast task: sends every active room's state changes to the clients that are due a frame.
+    def broadcast_rooms(self):
+        started = time.perf_counter()
+        now = time.monotonic()
+        for room in self.get_active_rooms():
+            self.broadcast_game_state(room, now)
+        self.metrics.observe("broadcast_duration", time.perf_counter() - started)
+
+    # Returns the scheduler for the game loop: the simulation at tick_rate, then the broadcast at broadcast_rate.
+    # Lateness and overruns are recorded as tick_* and broadcast_* metrics.
+    def build_scheduler(self):
+        scheduler = TickScheduler(self.metrics)
+        scheduler.add("tick", self.tick_rate, self.simulate_rooms)
+        scheduler.add("broadcast", self.broadcast_rate, self.broadcast_rooms)
+        scheduler.add("reservations", 1, self.expire_reservations)
+        if self.checkpoint_path is not None:
+            scheduler.add("checkpoint", 1 / self.checkpoint_interval, self.checkpoint_rooms)
+        return scheduler
+
+    # Checkpoint task: packs every room on the game loop, where the GameStates can't change underneath it,
+    # and hands the round to the writer thread for the disk I/O.
+    def checkpoint_rooms(self):
+        if self.checkpoint_writer is None:
+            self.checkpoint_writer = CheckpointWriter(self.checkpoint_path)
+        with self.lock:
+            rooms = list(self.rooms.values())
+        with self.metrics.timer("checkpoint_pack"):
+            data = pack_round([pack_room(room) for room in rooms])
+        self.checkpoint_writer.submit(data)
+
+    # Restores the rooms of the last checkpoint, if there is one. Every player's slot is reserved for
+    # reattach_grace seconds; in-progress games resume where the checkpoint left them. Called before listening.
+    def restore_checkpoint(self):
+        if self.checkpoint_path is None:
+            return
+        checkpoint = load_checkpoint(self.checkpoint_path)
+        if checkpoint is None:
+            return
+        written_at, saved_rooms = checkpoint
+        deadline = time.monotonic() + self.reattach_grace
+        with self.lock:
+            for saved in saved_rooms:
+                if not any(taken for taken, _, _ in saved["slots"]):
+                    continue
+                room = Room(saved["room_id"], saved["grid_size"], len(saved["slots"]),
+                            lock=TimedLock(self.metrics, "room_lock"), view_radius=self.view_radius)
+                for i, (taken, ready, session) in enumerate(saved["slots"]):
+                    if taken:
+                        room.lobby_state['players'][i] = f"Player_{i+1}"
+                        room.lobby_state['ready_states'][i] = ready
+                        room.sessions[i] = session
+                        room.reserved_until[i] = deadline
+                        room.player_count += 1
+                if saved["in_game"]:
+                    room.game_state = GameState.restore(saved["grid_size"], saved["players"], saved["flag"],
+                                                        saved["locked_cells"], saved["tick"], saved["version"],
+                                                        self.layout_for(room))
+                    room.game_state.max_moves_per_tick = self.max_moves_per_tick
+                    room.in_game = True
+                    self.active_rooms[room.room_id] = room
+                self.rooms[room.room_id] = room
+            self.room_ids = itertools.count(max(self.rooms, default=0) + 1)
+        print(f"Restored {len(self.rooms)} rooms from the checkpoint written at {time.ctime(written_at)}")
+
+    # Gives up the reserved slots of restored players who didn't reattach within the grace window,
+    # removing them from their game and closing rooms nobody came back to.
+    def expire_reservations(self):
+        now = time.monotonic()
+        with self.lock:
+            rooms = list(self.rooms.values())
+        for room in rooms:
+            expired = False
+            with room.lock:
+                for i, deadline in enumerate(room.reserved_until):
+                    if deadline is not None and now >= deadline and room.lobby_state['sockets'][i] is None:
+                        print(f"Player {i} did not reattach to room {room.room_id} in time")
+                        room.clear_slot(i)
+                        room.game_state.queue_removal(i + 1)
+                        expired = True
+                if expired:
+                    self.broadcast_lobby_state(room)
+                empty = room.player_count == 0
+            if expired and empty:
+                self.teardown_room(room)
+
+    # Runs in a separate thread: simulates and broadcasts the active rooms at their configured rates.
+    # Rooms still in their lobby are not ticked.
     def game_loop(self):
-        clock = pygame.time.Clock()
-        while True:
-            self.broadcast_game_state()
-            clock.tick(30)  # 30 updates per second
-    
-    # Sends a shutdown message to all players notifying them the server is down.
+        self.build_scheduler().run_forever()
+
+    # Sends a shutdown message to every player in every room notifying them the server is down.
     def broadcast_server_shutdown(self):
-        shutdown_msg = json.dumps({
+        shutdown_msg = {
             "type": "server_down",
             "message": "Server is shutting down. Disconnecting..."
-        }) + "\n"
-        shutdown_msg = shutdown_msg.encode()
-        for i, sock in enumerate(self.lobby_state["sockets"]):
-            if sock:
+        }
+        encoded = {}
+        with self.lock:
+            rooms = list(self.rooms.values())
+        for room in rooms:
+            for key, sock, protocol in room.subscribers():
                 try:
-                    sock.sendall(shutdown_msg)
+                    sock.send(self.encode_once(encoded, shutdown_msg, protocol))
                 except Exception as e:
-                    print(f"Failed to send shutdown message to player {i + 1}: {e}")
-                    
+                    print(f"Failed to send shutdown message to {room.describe(key)} in room {room.room_id}: {e}")
+
+    # Builds the plain-text stats page: the metrics registry plus gauges computed at scrape time —
+    # rooms, connected players, spectators and relays, and traffic and queue depth for every connected client.
+    def render_stats(self):
+        with self.lock:
+            rooms = list(self.rooms.values())
+            active = len(self.active_rooms)
+        connected = 0
+        udp_players = 0
+        spectators = 0
+        compressed_raw = 0
+        compressed_bytes = 0
+        compression_seconds = 0.0
+        max_queue_depth = 0
+        clients = []
+        for room in rooms:
+            players = room.game_state.players
+            for i, connection in room.connected_sockets():
+                connected += 1
+                if room.in_game and (i + 1) not in players:
+                    spectators += 1
+                depth = connection.queue_depth()
+                max_queue_depth = max(max_queue_depth, depth)
+                label = f'{{room="{room.room_id}",player="{i}"}}'
+                peer = connection.udp_peer
+                if peer is not None:
+                    udp_players += 1
+                    clients += [
+                        (f"client_udp_bytes_out{label}", peer.bytes_sent),
+                        (f"client_udp_datagrams_out{label}", peer.datagrams_sent),
+                    ]
+                compressor = connection.compressor
+                if compressor is not None:
+                    compressed_raw += compressor.raw_bytes
+                    compressed_bytes += compressor.compressed_bytes
+                    compression_seconds += compressor.seconds
+                    if compressor.compressed_bytes:
+                        clients.append((f"client_compression_ratio{label}",
+                                        round(compressor.raw_bytes / compressor.compressed_bytes, 2)))
+                clients += [
+                    (f"client_bytes_out{label}", connection.bytes_sent),
+                    (f"client_messages_out{label}", connection.messages_sent),
+                    (f"client_bytes_in{label}", connection.bytes_received),
+                    (f"client_messages_in{label}", connection.messages_received),
+                    (f"client_queue_depth{label}", depth),
+                ]
+        gauges = [
+            ("rooms", len(rooms)),
+            ("active_rooms", active),
+            ("connected_players", connected),
+            ("udp_players", udp_players),
+            ("spectators", spectators),
+            ("relays", sum(len(room.relays) for room in rooms)),
+            ("max_queue_depth", max_queue_depth),
+            ("compression_bytes_in", compressed_raw),
+            ("compression_bytes_out", compressed_bytes),
+            ("compression_ratio", round(compressed_raw / compressed_bytes, 2) if compressed_bytes else 0),
+            ("compression_cpu_ms", round(compression_seconds * 1000, 3)),
+        ]
+        return self.metrics.render(gauges + clients)
+
+    # Starts the stats endpoint if a stats_port was configured. It only listens on localhost.
+    def start_stats(self):
+        if self.stats_port is not None:
+            serve_stats("127.0.0.1", self.stats_port, self.render_stats, {"/profile": self.handle_profile_request})
+
+    # Gives queued messages (e.g. the shutdown notice) up to timeout seconds to reach each client.
+    def flush_outbound(self, timeout=1.0):
+        with self.lock:
+            rooms = list(self.rooms.values())
+        for room in rooms:
+            for _, connection in room.connected_sockets():
+                connection.flush(timeout)
+
     # Starts the server socket, listens for clients, and spawns threads for each connection.
     def start(self):
+        self.restore_checkpoint()
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server_socket.bind((self.host, self.port))
-        server_socket.listen(4)
+        server_socket.listen(socket.SOMAXCONN)
         print(f"Server listening on {self.host}:{self.port}")
+        if self.udp_port is not None:
+            self.udp_transport = serve_udp_in_thread(self.host, self.udp_port, self.handle_datagram)
+            print(f"UDP state channel on {self.host}:{self.udp_port}")
+
+        self.start_stats()
+        install_profile_signal(self.profiler)
 
         game_thread = threading.Thread(target=self.game_loop)
         game_thread.daemon = True
@@ -273,5 +1069,6 @@ class GameServer:
         except KeyboardInterrupt:
             print("Server shutting down.")
             self.broadcast_server_shutdown()
+            self.flush_outbound()
         finally:
-            server_socket.close()
\ No newline at end of file
+            server_socket.close()
@@ -1,125 +1,315 @@
-import threading
 import random
+from array import array
+from collections import deque
 from player import Player
+from protocol import PlayerList
+from team_layout import TeamLayout
 
 class GameState:
     # Initializes the game state with a grid, player positions, team bases, 
     # and a randomly placed flag. Sets up player objects for each connected ID.
-    def __init__(self, grid_size=15, connected_players_ids = None):
+    # The server's simulation tick is the only reader and writer of a GameState: client threads only queue
+    # inputs and removals (queue_input/queue_removal), which step() applies in one batch, so no lock is needed.
+    # The flag's spawn points come from a random generator seeded with seed (a fresh random one by default),
+    # so a match can be replayed exactly from its seed and inputs (see recording.py).
+    # layout (see team_layout.py) places the team bases and spawn points; by default there is a base in each
+    # corner, and players 1 to 4 each play for their own corner, with any further players joining them in turn.
+    def __init__(self, grid_size=15, connected_players_ids = None, seed=None, layout=None):
         self.grid_size = grid_size
+        self.seed = random.getrandbits(64) if seed is None else seed
+        self.rng = random.Random(self.seed)
+        # Set by the server to a MatchRecorder to log every applied input and removal.
+        self.recorder = None
+        # Most moves applied per player per tick (None = no limit); step() drops the rest.
+        self.max_moves_per_tick = None
+        self.layout = layout or TeamLayout.corners(grid_size)
+        # bases[t] is team t's base cell; team_of maps each player id to its team.
+        self.bases = self.layout.bases
+        self.team_of = {}
         self.players = {}
         if connected_players_ids is None:
             connected_players_ids = []
+        taken = set()
         for pid in connected_players_ids:
-            if pid == 1:
-                start_pos = (0, 0)
-                color = (255, 0, 0)  
-            elif pid == 2:
-                start_pos = (grid_size - 1, 0)
-                color = (0, 0, 255)
-            elif pid == 3:
-                start_pos = (0, grid_size - 1)
-                color = (255, 255, 0)
-            elif pid == 4:
-                start_pos = (grid_size - 1, grid_size - 1)
-                color = (0, 255, 255)
-            self.players[pid] = Player(pid, start_pos, color)
+            team = self.layout.team_of(pid)
+            start_pos = next((cell for cell in self.layout.spawn_order(team) if cell not in taken), None)
+            if start_pos is None:
+                raise ValueError(f"No free cell to spawn player {pid} on a {grid_size}x{grid_size} grid")
+            taken.add(start_pos)
+            self.team_of[pid] = team
+            self.players[pid] = Player(pid, start_pos, self.layout.color(team))
         self.flag_pos = (grid_size // 2, grid_size // 2)
-        self.bases = {
-            1: (0, 0),
-            2: (grid_size - 1, 0),
-            3: (0, grid_size - 1),
-            4: (grid_size - 1, grid_size - 1),
-        }
         self.locked_cells = set()
-        self.state_lock = threading.Lock()
-        self.flag_pos = self.generate_random_flag_position()
+
+        # Occupancy grid: the id of the player on each cell (0 = empty), indexed by y * grid_size + x.
+        # free_cells lists every empty non-base cell, with free_index mapping a cell to its slot in the list,
+        # so the flag can spawn uniformly in O(1). flag_carrier is the id of the player holding the flag, if any.
+        self.occupancy = array('H', [0]) * (grid_size * grid_size)
+        self.base_cells = set(self.bases)
+        self.free_cells = [(x, y) for y in range(grid_size) for x in range(grid_size) if (x, y) not in self.base_cells]
+        self.free_index = {cell: i for i, cell in enumerate(self.free_cells)}
+        self.flag_carrier = None
+        for pid, player in self.players.items():
+            self.place_player(pid, player.pos)
+
+        self.flag_pos = self.generate_random_flag_position() or self.flag_pos
+
+        # Change tracking for delta broadcasts: version increases on every visible change,
+        # and the dirty flags record what changed since the last collect_delta().
+        self.version = 1
+        self.delta_base = 0
+        self.dirty_players = set(self.players)
+        self.removed_players = set()
+        self.flag_dirty = True
+        self.locked_dirty = True
+
+        # Fixed-timestep simulation: inputs wait in arrival order until the next step(). deque appends and
+        # pops are atomic, so client threads can queue while the tick drains. last_input_seq holds the
+        # sequence number of the last input applied for each player, which updates echo back as "acks".
+        self.tick = 0
+        self.pending_inputs = deque()
+        self.pending_removals = deque()
+        self.last_input_seq = {}
+        self.dirty_acks = set()
+
+    # Rebuilds a game from a checkpoint (see checkpoint.py): players as (id, x, y, has_flag, score) tuples, the
+    # flag position, locked cells, tick and version. The flag RNG starts from a fresh seed.
+    @classmethod
+    def restore(cls, grid_size, players, flag_pos, locked_cells, tick, version, layout=None):
+        state = cls(grid_size, [pid for pid, *_ in players], layout=layout)
+        for player in state.players.values():
+            state.clear_cell(player.pos)
+        for pid, x, y, has_flag, score in players:
+            player = state.players[pid]
+            player.pos = (x, y)
+            player.has_flag = has_flag
+            player.score = score
+            state.place_player(pid, player.pos)
+            if has_flag:
+                state.flag_carrier = pid
+        state.flag_pos = tuple(flag_pos)
+        state.locked_cells = set(map(tuple, locked_cells))
+        state.tick = tick
+        state.version = version
+        return state
+
+    # Queues a move to be applied on the next step(). seq is the client's input sequence number.
+    def queue_input(self, player_id, seq, dx, dy):
+        self.pending_inputs.append((player_id, seq, dx, dy))
+
+    # Queues a disconnected player's removal for the next step().
+    def queue_removal(self, player_id):
+        self.pending_removals.append(player_id)
+
+    # Advances the simulation by one tick: applies every queued input in arrival order, then removals.
+    # Only inputs queued before the step began are applied; later ones wait for the next tick.
+    # An input whose seq isn't newer than the player's last applied one is a copy and is skipped, whichever way
+    # it arrived: the UDP channel repeats recent inputs, and some of them may already have come over TCP.
+    # With max_moves_per_tick set, a player's moves past that many in one tick are coalesced away: they are
+    # dropped (and not recorded), but still acknowledged, so the client's prediction stops replaying them.
+    # Returns the number of moves dropped.
+    def step(self):
+        self.tick += 1
+        inputs = self.pending_inputs
+        limit = self.max_moves_per_tick
+        moves = {}
+        dropped = 0
+        for _ in range(len(inputs)):
+            player_id, seq, dx, dy = inputs.popleft()
+            if player_id not in self.players:
+                continue
+            if seq is not None and player_id in self.last_input_seq and seq <= self.last_input_seq[player_id]:
+                continue
+            if limit is not None:
+                count = moves.get(player_id, 0)
+                if count >= limit:
+                    dropped += 1
+                    if seq is not None:
+                        self.last_input_seq[player_id] = seq
+                        self.dirty_acks.add(player_id)
+                    continue
+                moves[player_id] = count + 1
+            if self.recorder is not None:
+                self.recorder.record_input(self.tick, player_id, dx, dy)
+            self.move_player(player_id, dx, dy)
+            if seq is not None:
+                self.last_input_seq[player_id] = seq
+                self.dirty_acks.add(player_id)
+        removals = self.pending_removals
+        for _ in range(len(removals)):
+            player_id = removals.popleft()
+            if self.recorder is not None and player_id in self.players:
+                self.recorder.record_removal(self.tick, player_id)
+            self.remove_player(player_id)
+        if self.dirty_acks and self.version == self.delta_base:
+            # Rejected moves change nothing else, but the client still needs to see them acknowledged.
+            self.version += 1
+        return dropped
+
+    # Ends the match's recording, if any, with its final state. Called from the simulation tick once the
+    # GameState is no longer stepped.
+    def finish_recording(self):
+        if self.recorder is not None:
+            self.recorder.finish(self)
+            self.recorder = None
     
     # Randomly selects a grid cell for the flag that isn’t a player’s base 
-    # or currently occupied by a player.
+    # or currently occupied by a player. Returns None if every such cell is taken.
     def generate_random_flag_position(self):
-        while True:
-            x = random.randint(0, self.grid_size - 1)
-            y = random.randint(0, self.grid_size - 1)
-            pos = (x, y)
-            
-            # Check if position is not a base and not occupied by a player
-            if (pos not in self.bases.values() and 
-                not self.is_cell_occupied(pos)):
-                return pos
+        if not self.free_cells:
+            return None
+        return self.rng.choice(self.free_cells)
 
     # Checks if a grid cell is occupied by any player, 
     # optionally excluding a specific player from the check (e.g., when moving that player).
     def is_cell_occupied(self, pos, exclude_player_id=None):
-        for pid, player in self.players.items():
-            if exclude_player_id is not None and pid == exclude_player_id:
-                continue
-            if player.pos == pos:
-                return True
-        return False
+        x, y = pos
+        occupant = self.occupancy[y * self.grid_size + x]
+        return occupant != 0 and occupant != exclude_player_id
+
+    # Marks pos as occupied by player_id in the occupancy grid and free-cell index.
+    def place_player(self, player_id, pos):
+        x, y = pos
+        self.occupancy[y * self.grid_size + x] = player_id
+        i = self.free_index.pop(pos, None)
+        if i is not None:
+            # Swap-remove: move the last free cell into the vacated slot.
+            last = self.free_cells.pop()
+            if last != pos:
+                self.free_cells[i] = last
+                self.free_index[last] = i
+
+    # Marks pos as empty again; base cells never return to the free-cell index.
+    def clear_cell(self, pos):
+        x, y = pos
+        self.occupancy[y * self.grid_size + x] = 0
+        if pos not in self.free_index and pos not in self.base_cells:
+            self.free_index[pos] = len(self.free_cells)
+            self.free_cells.append(pos)
 
     # Handles a player's move:
     # - Validates move within bounds and checks for collisions or locked cells.
     # - If carrying a flag, the flag moves with the player.
-    # - Allows stealing the flag from adjacent players.
+    # - Allows stealing the flag from adjacent players on other teams.
     # - Lets players capture the flag by stepping on it.
     # Returns the flag to base to score a point, and resets the flag.
+    # Every check uses the occupancy grid, flag_carrier and team_of, so a move costs the same however many
+    # players there are: a steal only needs the carrier's position, never a scan of the other players.
     def move_player(self, player_id, dx, dy):
-        with self.state_lock:
-            player = self.players.get(player_id)
-            if not player:
-                return
-            x, y = player.pos
-            new_x, new_y = x + dx, y + dy
-
-            if (0 <= new_x < self.grid_size and 0 <= new_y < self.grid_size and
-                (new_x, new_y) not in self.locked_cells and
-                not self.is_cell_occupied((new_x, new_y), exclude_player_id=player_id)):
-
-                # If player has flag, move flag with them
-                if player.has_flag:
-                    # Remove lock from previous flag position
-                    if self.flag_pos in self.locked_cells:
-                        self.locked_cells.remove(self.flag_pos)
-                    self.flag_pos = (new_x, new_y)
-
-                player.pos = (new_x, new_y)
-
-                # Check if player stole flag from another player
-                if not player.has_flag:
-                    for other_id, other_player in self.players.items():
-                        if other_id != player_id and other_player.has_flag:
-                            ox, oy = other_player.pos
-                            px, py = player.pos
-                            if abs(px - ox) + abs(py - oy) == 1:  # Check if adjacent
-                                other_player.has_flag = False
-                                player.has_flag = True
-                                break
-
-                # Capture flag if stepping on its cell.
-                if (new_x, new_y) == self.flag_pos and not any(p.has_flag for p in self.players.values()):
+        player = self.players.get(player_id)
+        if not player:
+            return
+        x, y = player.pos
+        new_x, new_y = x + dx, y + dy
+
+        if (0 <= new_x < self.grid_size and 0 <= new_y < self.grid_size and
+            (new_x, new_y) not in self.locked_cells and
+            not self.is_cell_occupied((new_x, new_y), exclude_player_id=player_id)):
+
+            self.version += 1
+            self.dirty_players.add(player_id)
+
+            # If player has flag, move flag with them
+            if player.has_flag:
+                # Remove lock from previous flag position
+                if self.flag_pos in self.locked_cells:
+                    self.locked_cells.remove(self.flag_pos)
+                    self.locked_dirty = True
+                self.flag_pos = (new_x, new_y)
+                self.flag_dirty = True
+
+            self.clear_cell(player.pos)
+            player.pos = (new_x, new_y)
+            self.place_player(player_id, player.pos)
+
+            # Check if player stole flag from a player on another team
+            team = self.team_of[player_id]
+            if (not player.has_flag and self.flag_carrier is not None and
+                    self.team_of[self.flag_carrier] != team):
+                other_player = self.players[self.flag_carrier]
+                ox, oy = other_player.pos
+                if abs(new_x - ox) + abs(new_y - oy) == 1:  # Check if adjacent
+                    other_player.has_flag = False
                     player.has_flag = True
-                    self.locked_cells.add((new_x, new_y))
+                    self.dirty_players.add(other_player.id)
+                    self.flag_carrier = player_id
+
+            # Capture flag if stepping on its cell.
+            if (new_x, new_y) == self.flag_pos and self.flag_carrier is None:
+                player.has_flag = True
+                self.flag_carrier = player_id
+                self.locked_cells.add((new_x, new_y))
+                self.locked_dirty = True
 
-                # If player returns flag to base, update score.
-                if player.has_flag and (new_x, new_y) == self.bases[player_id]:
-                    player.score += 1
-                    player.has_flag = False
-                    self.flag_pos = self.generate_random_flag_position()  # Flag respawns randomly
-                    self.locked_cells.clear()
+            # If player returns flag to their team's base, update score.
+            if player.has_flag and (new_x, new_y) == self.bases[team]:
+                player.score += 1
+                player.has_flag = False
+                self.flag_carrier = None
+                # Flag respawns randomly (or stays put in the unlikely case that no cell is free)
+                self.flag_pos = self.generate_random_flag_position() or self.flag_pos
+                self.locked_cells.clear()
+                self.flag_dirty = True
+                self.locked_dirty = True
+
+    # Builds the full state dictionary. Its players are the Player objects themselves (see PlayerList), whose
+    # cached encodings are only redone for players that changed since the last broadcast.
+    def build_state(self):
+        return {
+            "version": self.version,
+            "tick": self.tick,
+            "players": PlayerList(self.players.values()),
+            "flag": self.flag_pos,
+            "locked_cells": list(self.locked_cells),
+            "acks": [[pid, seq] for pid, seq in self.last_input_seq.items()],
+        }
 
-    # Returns a dictionary representing the current game state: player positions, flag location, and locked cells. 
-    # Used for broadcasting to clients.
+    # Returns a dictionary representing the current game state: version, tick, player positions, flag location,
+    # locked cells, and [player_id, seq] acks of the last input applied per player. Used for broadcasting keyframes.
     def get_state(self):
-        with self.state_lock:
-            return {
-                "players": [player.to_dict() for player in self.players.values()],
-                "flag": self.flag_pos,
-                "locked_cells": list(self.locked_cells),
-            }
+        return self.build_state()
+
+    # Returns (delta, state) for one broadcast tick and clears the dirty flags.
+    # delta describes what changed since the previous call — "base", "version" and "tick", the changed "players",
+    # "removed" player ids, the "acks" that moved, plus "flag" and "locked_cells" only if they changed — or is
+    # None if the version hasn't moved. state is the full get_state() at the same version when include_state
+    # is set, else None.
+    def collect_delta(self, include_state=False):
+        state = self.build_state() if include_state else None
+        if self.version == self.delta_base:
+            return None, state
+        delta = {
+            "base": self.delta_base,
+            "version": self.version,
+            "players": PlayerList([self.players[pid] for pid in self.dirty_players if pid in self.players]),
+            "tick": self.tick,
+            "removed": list(self.removed_players),
+            "acks": [[pid, self.last_input_seq[pid]] for pid in self.dirty_acks if pid in self.last_input_seq],
+        }
+        if self.flag_dirty:
+            delta["flag"] = self.flag_pos
+        if self.locked_dirty:
+            delta["locked_cells"] = list(self.locked_cells)
+
+        self.delta_base = self.version
+        self.dirty_players.clear()
+        self.removed_players.clear()
+        self.dirty_acks.clear()
+        self.flag_dirty = False
+        self.locked_dirty = False
+        return delta, state
     
     # Remove player from the game when disconnected.
     def remove_player(self, game_state_id):
-        with self.state_lock:
-            if game_state_id in self.players:
-                del self.players[game_state_id]
\ No newline at end of file
+        if game_state_id in self.players:
+            player = self.players.pop(game_state_id)
+            self.team_of.pop(game_state_id, None)
+            self.clear_cell(player.pos)
+            if self.flag_carrier == game_state_id:
+                # The flag stays on the cell the player was carrying it on.
+                self.flag_carrier = None
+            self.dirty_players.discard(game_state_id)
+            self.last_input_seq.pop(game_state_id, None)
+            self.dirty_acks.discard(game_state_id)
+            self.removed_players.add(game_state_id)
+            self.version += 1
@@ -0,0 +1,73 @@
+from protocol import PlayerList
+
+# How many cells past the view radius a player stays visible once seen, so a player stepping back and forth
+# across the edge of someone's view doesn't appear and vanish every tick.
+VIEW_MARGIN = 2
+
+class InterestFilter:
+    # Area-of-interest filtering of one room's state stream: each player is only sent the other players within
+    # radius cells of their own (in both directions, i.e. a square view) and their own input ack. The flag, and
+    # with it the locked cell (only ever the flag's), is always sent. A player who was visible stays so until
+    # they are more than radius + margin cells away.
+    # visible remembers, per slot, the game ids its last frame covered, so deltas can add the players that came
+    # into view (in full) and list the ones that left it as removed; the client applies both as usual.
+    # A slot whose player isn't in the game gets the unfiltered stream. Only used from the game loop (by
+    # broadcast_game_state, which doesn't hold the room's lock), so it needs no lock of its own.
+    def __init__(self, radius, margin=VIEW_MARGIN):
+        self.radius = radius
+        self.margin = margin
+        self.visible = {}
+
+    # Forgets every slot's view, e.g. when a new game starts.
+    def reset(self):
+        self.visible.clear()
+
+    # Returns the game ids slot's player sees now (including its own), or None if it isn't in the game, and
+    # remembers them as the slot's view.
+    def update_view(self, slot, game_state):
+        game_id = slot + 1
+        own = game_state.players.get(game_id)
+        if own is None:
+            self.visible.pop(slot, None)
+            return None
+        previous = self.visible.get(slot, ())
+        x, y = own.pos
+        radius = self.radius
+        keep = radius + self.margin
+        visible = set()
+        for pid, player in game_state.players.items():
+            distance = max(abs(player.pos[0] - x), abs(player.pos[1] - y))
+            if distance <= radius or (distance <= keep and pid in previous):
+                visible.add(pid)
+        self.visible[slot] = visible
+        return visible
+
+    # Returns the keyframe message (an update built from GameState.get_state) cut down to what slot sees.
+    def filter_keyframe(self, slot, game_state, message):
+        visible = self.update_view(slot, game_state)
+        if visible is None:
+            return message
+        filtered = dict(message)
+        filtered["players"] = PlayerList([player for player in message["players"] if player.id in visible])
+        filtered["acks"] = [ack for ack in message["acks"] if ack[0] == slot + 1]
+        return filtered
+
+    # Returns the delta message (from GameState.collect_delta) cut down to what slot sees, for a client whose
+    # last frame was the delta's base: changed players it sees, players that came into view, and the ones that
+    # left it (or the game) as removed.
+    def filter_delta(self, slot, game_state, message):
+        previous = self.visible.get(slot)
+        visible = self.update_view(slot, game_state)
+        if visible is None:
+            return message
+        if previous is None:
+            # The client was on the unfiltered stream, so it has every player.
+            previous = set(game_state.players) | set(message["removed"])
+        filtered = dict(message)
+        players = PlayerList([player for player in message["players"] if player.id in visible])
+        sent = {player.id for player in players}
+        players += [game_state.players[pid] for pid in visible - previous if pid not in sent]
+        filtered["players"] = players
+        filtered["removed"] = list(previous - visible)
+        filtered["acks"] = [ack for ack in message["acks"] if ack[0] == slot + 1]
+        return filtered
@@ -1,8 +1,116 @@
-from game_server import GameServer
+import argparse
+import os
+import secrets
+import sys
+
+# protocol.py is shared with the client
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+from game_server import MAX_MOVES_PER_TICK, MAX_ROOM_PLAYERS, SPECTATOR_SEND_RATE, GameServer
+from async_game_server import AsyncGameServer
+from spectator_relay import SpectatorRelay
+from compression import SUPPORTED_COMPRESSIONS
+from profiler import parse_profile_seconds
+from protocol import JSON, SUPPORTED_PROTOCOLS
+from rate_limit import CONTROL_BURST, CONTROL_RATE, MESSAGE_BURST, MESSAGE_RATE
+from team_layout import TeamLayout
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Capture the Flag game server")
+    parser.add_argument("--mode", choices=["async", "threaded"], default="async",
+                        help="async runs everything on one event loop; threaded uses one thread per client")
+    parser.add_argument("--max-rooms", type=int, default=500,
+                        help="maximum number of rooms (independent games) hosted at once")
+    parser.add_argument("--grid-size", type=int, default=15, help="width and height of the grid, in cells")
+    parser.add_argument("--max-players", type=int, default=4,
+                        help=f"players per room, 2 to {MAX_ROOM_PLAYERS}; past the number of teams, players share bases")
+    parser.add_argument("--teams", type=int, default=4,
+                        help="teams per match, 1 to 4, each with a base in a corner of the grid")
+    parser.add_argument("--layout",
+                        help='JSON file with the team bases and spawn points, {"bases": [[x, y], ...], '
+                             '"spawns": [[[x, y], ...], ...]}; replaces --teams')
+    parser.add_argument("--tick-rate", type=int, default=30, help="simulation ticks per second")
+    parser.add_argument("--broadcast-rate", type=int,
+                        help="state broadcasts per second (default: the tick rate)")
+    parser.add_argument("--spectator-rate", type=int, default=SPECTATOR_SEND_RATE,
+                        help="most state frames per second sent to a spectator")
+    parser.add_argument("--message-rate", type=float, default=MESSAGE_RATE,
+                        help="moves per second a client may send; the rest are dropped")
+    parser.add_argument("--message-burst", type=int, default=MESSAGE_BURST,
+                        help="moves a client may send in a burst above --message-rate")
+    parser.add_argument("--control-rate", type=float, default=CONTROL_RATE,
+                        help="lobby and control messages per second a client may send; the rest are dropped")
+    parser.add_argument("--control-burst", type=int, default=CONTROL_BURST,
+                        help="lobby and control messages a client may send in a burst above --control-rate")
+    parser.add_argument("--max-moves-per-tick", type=int, default=MAX_MOVES_PER_TICK,
+                        help="moves applied per player per tick; extra moves in the same tick are dropped")
+    parser.add_argument("--view-radius", type=int,
+                        help="only send each player the players within this many cells of them (default: everyone)")
+    parser.add_argument("--udp-port", type=int,
+                        help="offer clients a UDP channel for state snapshots and inputs on UDP_PORT")
+    parser.add_argument("--relay-port", type=int,
+                        help="also run a spectator relay for this server on its own event loop, on RELAY_PORT")
+    parser.add_argument("--relay-secret",
+                        help="shared secret spectator relays must send to subscribe (default: only relays on "
+                             "this machine may)")
+    parser.add_argument("--record-dir",
+                        help="record every match into this directory (replay with game/tools/replay.py)")
+    parser.add_argument("--checkpoint",
+                        help="checkpoint every room to this file, and restore the rooms from it on startup")
+    parser.add_argument("--checkpoint-interval", type=float, default=5.0, help="seconds between checkpoints")
+    parser.add_argument("--reattach-grace", type=float, default=30.0,
+                        help="seconds restored players have to reconnect before their slot is freed")
+    parser.add_argument("--stats-port", type=int,
+                        help="serve plain-text server metrics on http://127.0.0.1:STATS_PORT/")
+    parser.add_argument("--profile", metavar="SECONDS",
+                        help="capture a profile of the first SECONDS (later ones: GET /profile on the stats port, "
+                             "or SIGUSR1)")
+    parser.add_argument("--profile-dir", default="profiles", help="directory profiles are written to")
+    parser.add_argument("--no-compression", action="store_true",
+                        help="never compress what the server sends, even to clients that offer it")
+    parser.add_argument("--json", action="store_true",
+                        help="force the newline-delimited JSON protocol on every connection (for debugging)")
+    args = parser.parse_args()
+    if not 2 <= args.max_players <= MAX_ROOM_PLAYERS:
+        parser.error(f"--max-players must be between 2 and {MAX_ROOM_PLAYERS}")
+    if args.view_radius is not None and args.view_radius < 1:
+        parser.error("--view-radius must be at least 1")
+    if args.profile is not None:
+        try:
+            args.profile = parse_profile_seconds(args.profile)
+        except ValueError as e:
+            parser.error(f"--profile: {e}")
+    try:
+        if args.layout:
+            layout = TeamLayout.load(args.grid_size, args.layout)
+        else:
+            layout = TeamLayout.corners(args.grid_size, args.teams)
+    except (OSError, ValueError, KeyError) as e:
+        parser.error(f"Invalid team layout: {e}")
+
     host = input("Enter the host IP address: ")
     port = int(input("Enter the port number: ") or 12345)
-    
-    server = GameServer(host, port)
-    server.start()
\ No newline at end of file
+
+    server_class = AsyncGameServer if args.mode == "async" else GameServer
+    protocols = (JSON,) if args.json else SUPPORTED_PROTOCOLS
+    compressions = () if args.no_compression else SUPPORTED_COMPRESSIONS
+    server = server_class(host, port, grid_size=args.grid_size, max_players=args.max_players, layout=layout,
+                          max_rooms=args.max_rooms, message_rate=args.message_rate,
+                          message_burst=args.message_burst, control_rate=args.control_rate,
+                          control_burst=args.control_burst, max_moves_per_tick=args.max_moves_per_tick,
+                          protocols=protocols, stats_port=args.stats_port,
+                          tick_rate=args.tick_rate, broadcast_rate=args.broadcast_rate,
+                          spectator_rate=args.spectator_rate, record_dir=args.record_dir,
+                          checkpoint_path=args.checkpoint, checkpoint_interval=args.checkpoint_interval,
+                          reattach_grace=args.reattach_grace, udp_port=args.udp_port,
+                          view_radius=args.view_radius, compressions=compressions, profile_dir=args.profile_dir,
+                          relay_secret=args.relay_secret)
+    if args.relay_port is not None:
+        # The built-in relay may connect over a non-loopback address, so it always gets a secret.
+        if server.relay_secret is None:
+            server.relay_secret = secrets.token_hex(16)
+        SpectatorRelay(host, port, host, args.relay_port, tick_rate=server.broadcast_rate,
+                       secret=server.relay_secret).start_in_thread()
+    if args.profile:
+        server.profiler.start(args.profile)
+    server.start()
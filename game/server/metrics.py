@@ -0,0 +1,126 @@
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+class Timing:
+    # Running summary of one timed operation: how often it ran, total, last and worst duration (seconds).
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+class Metrics:
+    # In-memory metrics registry for the server: counters and timings, updated inline by the code being
+    # measured. Recording is an addition under an uncontended lock; nothing is formatted until render()
+    # is called by a scrape, so the cost when nobody is looking is a few clock reads per operation.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(Timing)
+
+    # Adds amount to a counter.
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    # Records one duration, in seconds, for a timing.
+    def observe(self, name, seconds):
+        with self.lock:
+            self.timings[name].add(seconds)
+
+    # Context manager that records how long its block took.
+    def timer(self, name):
+        return MetricsTimer(self, name)
+
+    # Formats every metric, plus the given gauges ((name, value) pairs), as plain text: one "name value"
+    # line each. Timings are reported in milliseconds as name_count, name_avg_ms, name_last_ms and name_max_ms.
+    def render(self, gauges=()):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            timings = sorted((name, (t.count, t.total, t.last, t.max)) for name, t in self.timings.items())
+        lines = [f"{name} {value}" for name, value in gauges]
+        lines += [f"{name} {value}" for name, value in counters]
+        for name, (count, total, last, worst) in timings:
+            lines.append(f"{name}_count {count}")
+            lines.append(f"{name}_avg_ms {1000 * total / count:.3f}")
+            lines.append(f"{name}_last_ms {1000 * last:.3f}")
+            lines.append(f"{name}_max_ms {1000 * worst:.3f}")
+        return "\n".join(lines) + "\n"
+
+class MetricsTimer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.started)
+
+class TimedLock:
+    # A threading.Lock that records how long callers waited for it (name_wait) and held it (name_hold).
+    # Only supports use as a context manager, which is how the server takes its locks.
+    def __init__(self, metrics, name):
+        self.lock = threading.Lock()
+        self.metrics = metrics
+        self.wait_name = name + "_wait"
+        self.hold_name = name + "_hold"
+        self.acquired_at = 0.0
+
+    def __enter__(self):
+        started = time.perf_counter()
+        self.lock.acquire()
+        self.acquired_at = time.perf_counter()
+        self.metrics.observe(self.wait_name, self.acquired_at - started)
+        return self
+
+    def __exit__(self, *exc):
+        held = time.perf_counter() - self.acquired_at
+        self.lock.release()
+        self.metrics.observe(self.hold_name, held)
+
+# Serves render() as plain text over HTTP on (host, port) from a daemon thread; any GET path returns the stats,
+# except the admin paths in actions, {path: action}, which return action(query) instead (query as parse_qs gives it).
+# An action raises ValueError for a bad request, which is answered with 400 and the error's message.
+# Returns the HTTP server so callers can shut it down.
+def serve_stats(host, port, render, actions=None):
+    actions = actions or {}
+
+    class StatsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            action = actions.get(url.path)
+            status = 200
+            try:
+                body = action(parse_qs(url.query)) if action else render()
+            except ValueError as e:
+                status = 400
+                body = f"{e}\n"
+            body = body.encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes would otherwise print a line each
+
+    http_server = ThreadingHTTPServer((host, port), StatsHandler)
+    thread = threading.Thread(target=http_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print(f"Stats available at http://{host}:{port}/")
+    return http_server
@@ -0,0 +1,234 @@
+import socket
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+
+# Defaults for the slow-consumer limits, see OutboundQueue.
+MAX_PENDING_BYTES = 256 * 1024
+MAX_STALE_FRAMES = 90  # 3 seconds of game state at 30 Hz
+
+class SlowConsumerError(ConnectionError):
+    # Raised by a send when the connection had to be dropped for falling too far behind.
+    pass
+
+class OutboundQueue(ABC):
+    # Bounded outbound buffer for one client connection. Sends only queue the already-encoded frame and
+    # return; a writer (a thread or an asyncio task, see the subclasses) drains the queue to the client,
+    # so one congested client never stalls the game loop or a lock holder. Subclasses provide wake, close and
+    # abort; a class missing one can't be instantiated.
+    # - send() queues lobby and control messages, which are never dropped.
+    # - send_state() queues a game state frame. If an older state frame is still waiting, it is dropped:
+    #   the newest state wins. Callers should only replace a state frame with a keyframe (see is_behind).
+    # The client is disconnected once more than max_pending_bytes are waiting, or once max_stale_frames
+    # state frames in a row were replaced before the writer could send any of them.
+    # State frames can also be limited to a lower rate than the server's broadcast (see set_send_rate).
+    # Once start_compression has been called, frames queued from then on are compressed by the writer as it
+    # sends them (see compression.py), so a dropped state frame never reaches the compressed stream.
+    def __init__(self, max_pending_bytes=MAX_PENDING_BYTES, max_stale_frames=MAX_STALE_FRAMES):
+        self.max_pending_bytes = max_pending_bytes
+        self.max_stale_frames = max_stale_frames
+        self.lock = threading.Lock()
+        self.pending = deque()  # (payload, is_state, compress) in send order
+        self.pending_bytes = 0
+        self.state_pending = False
+        self.stale_frames = 0
+        self.closed = False
+
+        # State frames per second for this client (None = every broadcast), the rate the client asked
+        # for itself, and when it is next due a frame. Only used by the game loop.
+        self.send_rate = None
+        self.requested_rate = None
+        self.send_interval = 0.0
+        self.next_send_at = 0.0
+
+        # The token of the client's UDP channel, if it was offered one, and the channel itself (a UdpPeer)
+        # once the client has confirmed it works; state frames then go over UDP instead (see udp_channel.py).
+        self.udp_token = None
+        self.udp_peer = None
+
+        # The compression method negotiated for the connection, if any, and its StreamCompressor once the
+        # compressed part of the stream has started. The compressor is only used by the writer.
+        self.compression = None
+        self.compressor = None
+
+        # Traffic counters for the stats endpoint. Each is only written by one thread (the writer, or the
+        # client's read loop), so they need no lock.
+        self.bytes_sent = 0
+        self.messages_sent = 0
+        self.bytes_received = 0
+        self.messages_received = 0
+
+    # Queues a lobby or control message. Raises ConnectionError if the connection is closed or too slow.
+    def send(self, data):
+        self.enqueue(data, False)
+
+    # Queues a game state frame, dropping any older state frame still waiting to be sent.
+    def send_state(self, data):
+        self.enqueue(data, True)
+
+    # True while a state frame is still waiting, i.e. the client hasn't kept up with the last tick.
+    def is_behind(self):
+        return self.state_pending
+
+    # Limits state frames to rate per second; None sends one every broadcast.
+    def set_send_rate(self, rate):
+        self.send_rate = rate
+        self.send_interval = 1 / rate if rate else 0.0
+
+    # True if the client is due a state frame at monotonic time now, and if so schedules the next one.
+    # Like the tick scheduler, the next frame is due one interval after the previous one was, so a 10 Hz
+    # client on a 30 Hz broadcast still averages 10 frames a second; a client can't bank more than one frame.
+    def is_due(self, now):
+        if now < self.next_send_at:
+            return False
+        self.next_send_at = max(self.next_send_at, now - self.send_interval) + self.send_interval
+        return True
+
+    # Compresses every frame queued from now on with compressor (a StreamCompressor).
+    def start_compression(self, compressor):
+        with self.lock:
+            self.compressor = compressor
+
+    # Returns the bytes to write for a frame taken with next_frame. Called by the writer, so compressed frames
+    # go through the compressor in the order they are sent.
+    def wire_bytes(self, frame):
+        data, compress = frame
+        return self.compressor.compress(data) if compress else data
+
+    # Number of frames waiting to be written.
+    def queue_depth(self):
+        return len(self.pending)
+
+    # Records a frame handed to the client; called by the writer.
+    def count_sent(self, size):
+        self.bytes_sent += size
+        self.messages_sent += 1
+
+    # Records a message read from the client; passed to read_message as on_read.
+    def count_received(self, size):
+        self.bytes_received += size
+        self.messages_received += 1
+
+    def enqueue(self, data, is_state):
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("Connection is closed")
+            if is_state and self.state_pending:
+                self.drop_pending_state()
+            self.pending.append((data, is_state, self.compressor is not None))
+            self.pending_bytes += len(data)
+            self.state_pending = self.state_pending or is_state
+            too_slow = (self.pending_bytes > self.max_pending_bytes or
+                        self.stale_frames > self.max_stale_frames)
+        if too_slow:
+            self.abort()
+            raise SlowConsumerError(
+                f"Client fell too far behind ({self.pending_bytes} bytes, {self.stale_frames} stale frames queued)"
+            )
+        self.wake()
+
+    # Removes the waiting state frame(s). Caller must hold self.lock.
+    def drop_pending_state(self):
+        kept = deque(item for item in self.pending if not item[1])
+        self.pending_bytes = sum(len(item[0]) for item in kept)
+        self.pending = kept
+        self.state_pending = False
+        self.stale_frames += 1
+
+    # Takes the next frame for the writer as (payload, compress), or returns None if nothing is waiting.
+    def next_frame(self):
+        with self.lock:
+            return self.pop_frame()
+
+    # next_frame without taking the lock. Caller must hold self.lock.
+    def pop_frame(self):
+        if not self.pending:
+            return None
+        data, is_state, compress = self.pending.popleft()
+        self.pending_bytes -= len(data)
+        if is_state:
+            self.state_pending = False
+            self.stale_frames = 0
+        return data, compress
+
+    # Tells the writer new data is waiting.
+    @abstractmethod
+    def wake(self):
+        pass
+
+    # Closes the connection once the frames already queued have been written.
+    @abstractmethod
+    def close(self):
+        pass
+
+    # Closes the connection immediately, discarding anything still queued.
+    @abstractmethod
+    def abort(self):
+        pass
+
+class SocketConnection(OutboundQueue):
+    # Outbound queue for the threaded server: a writer thread per client drains the queue with blocking
+    # sendall, so only that thread waits on a congested link.
+    def __init__(self, client_socket, max_pending_bytes=MAX_PENDING_BYTES, max_stale_frames=MAX_STALE_FRAMES):
+        super().__init__(max_pending_bytes, max_stale_frames)
+        self.socket = client_socket
+        self.ready = threading.Condition(self.lock)
+        self.writing = False
+        writer_thread = threading.Thread(target=self.write_loop)
+        writer_thread.daemon = True
+        writer_thread.start()
+
+    def wake(self):
+        with self.ready:
+            self.ready.notify_all()
+
+    # Writer thread: sends queued frames in order until the connection is closed and the queue is empty.
+    def write_loop(self):
+        try:
+            while True:
+                with self.ready:
+                    while not self.pending and not self.closed:
+                        self.writing = False
+                        self.ready.notify_all()
+                        self.ready.wait()
+                    if not self.pending:
+                        break
+                    self.writing = True
+                    frame = self.pop_frame()
+                data = self.wire_bytes(frame)
+                self.socket.sendall(data)
+                self.count_sent(len(data))
+        except OSError:
+            pass
+        finally:
+            with self.ready:
+                self.closed = True
+                self.writing = False
+                self.pending.clear()
+                self.ready.notify_all()
+            self.shutdown_socket()
+
+    # Blocks until everything queued has been written, or timeout seconds have passed.
+    def flush(self, timeout=1.0):
+        with self.ready:
+            self.ready.wait_for(lambda: not (self.pending or self.writing), timeout)
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify_all()
+
+    def abort(self):
+        with self.ready:
+            self.closed = True
+            self.pending.clear()
+            self.ready.notify_all()
+        # Also wakes the writer if it is blocked in sendall, and the client's read loop.
+        self.shutdown_socket()
+
+    def shutdown_socket(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
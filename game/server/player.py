@@ -1,4 +1,14 @@
+import json
+from protocol import PLAYER_RECORD
+
 class Player:
+    # Slotted, since a server holds one per player in every running game and broadcasts read them every tick.
+    # The player's JSON text and binary PLAYER_RECORD are cached for state messages (see PlayerList in
+    # protocol.py), and only re-encoded once its position, flag or score differ from what they were made from;
+    # id and color never change. The fields can therefore be assigned directly, as GameState does.
+    __slots__ = ("id", "pos", "color", "has_flag", "score",
+                 "encoded_pos", "encoded_flag", "encoded_score", "json_text", "record")
+
     # Initializes a player with a unique ID, starting position, color, no flag, and a score of zero.
     def __init__(self, player_id, pos, color):
         self.id = player_id
@@ -6,6 +16,11 @@ class Player:
         self.color = color
         self.has_flag = False
         self.score = 0
+        self.encoded_pos = None
+        self.encoded_flag = None
+        self.encoded_score = None
+        self.json_text = None
+        self.record = None
 
     # Returns the player's data as a dictionary
     def to_dict(self):
@@ -15,4 +30,28 @@ class Player:
             "color": self.color,
             "has_flag": self.has_flag,
             "score": self.score,
-        }
\ No newline at end of file
+        }
+
+    # Drops the cached encodings if the player changed since they were made.
+    def check_encoded(self):
+        if self.pos != self.encoded_pos or self.has_flag != self.encoded_flag or self.score != self.encoded_score:
+            self.encoded_pos = self.pos
+            self.encoded_flag = self.has_flag
+            self.encoded_score = self.score
+            self.json_text = None
+            self.record = None
+
+    # Returns the player as JSON text, exactly as json.dumps(to_dict()) writes it.
+    def to_json(self):
+        self.check_encoded()
+        if self.json_text is None:
+            self.json_text = json.dumps(self.to_dict())
+        return self.json_text
+
+    # Returns the player as a binary PLAYER_RECORD.
+    def to_record(self):
+        self.check_encoded()
+        if self.record is None:
+            x, y = self.pos
+            self.record = PLAYER_RECORD.pack(self.id, x, y, *self.color, self.has_flag, self.score)
+        return self.record
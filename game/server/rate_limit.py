@@ -0,0 +1,50 @@
+import time
+
+# Default limit on the messages a client may send after joining: a steady rate per second, plus a burst
+# allowance for a quick run of key presses. Far above anything a person at a keyboard sends.
+MESSAGE_RATE = 60
+MESSAGE_BURST = 30
+# Default limit on lobby and control messages (ready, start, send rate and keyframe requests and the like),
+# which have their own bucket so a flood of moves can't crowd them out. Each can make the server broadcast to
+# the whole room, so they are capped too, well above what a client sends on its own.
+CONTROL_RATE = 10
+CONTROL_BURST = 20
+# Messages that are never dropped: a client leaving must always free its slot.
+UNLIMITED_TYPES = frozenset({"disconnect"})
+
+class TokenBucket:
+    # Token-bucket rate limiter for one connection's incoming messages: the bucket holds up to burst tokens and
+    # refills at rate tokens per second; each message takes one, and a message finding the bucket empty is dropped.
+    # Only touched by the connection's own reader (thread or task), so it needs no lock.
+    def __init__(self, rate=MESSAGE_RATE, burst=MESSAGE_BURST, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.dropped = 0
+
+    # Takes a token if there is one. Returns False (and counts a drop) if the message should be dropped.
+    def allow(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.dropped += 1
+        return False
+
+class MessageLimiter:
+    # Rate limits for one connection's incoming messages: moves ("input") take tokens from one TokenBucket and
+    # every other message but those in UNLIMITED_TYPES from a second one. Like TokenBucket, it needs no lock.
+    def __init__(self, rate=MESSAGE_RATE, burst=MESSAGE_BURST, control_rate=CONTROL_RATE,
+                 control_burst=CONTROL_BURST, clock=time.monotonic):
+        self.moves = TokenBucket(rate, burst, clock)
+        self.control = TokenBucket(control_rate, control_burst, clock)
+
+    # Returns False if a message of this type should be dropped.
+    def allow(self, message_type):
+        if message_type == "input":
+            return self.moves.allow()
+        return message_type in UNLIMITED_TYPES or self.control.allow()
@@ -0,0 +1,107 @@
+import json
+import os
+import struct
+import time
+from collections import namedtuple
+
+# Match recordings: everything needed to re-run a match's GameState exactly, and nothing else.
+# A match is deterministic given its grid size, its players in join order, the seed of its flag RNG and
+# the inputs and removals applied on each tick, so that is all a recording holds:
+# - header: magic, format version, grid size, server tick rate, seed, player count, then one byte per player id,
+#   then the team layout (see team_layout.py) as a length-prefixed JSON object
+# - one EVENT record per applied input or removal: tick, player id (with REMOVAL_BIT set for a removal), dx, dy
+# - when the match ends, one END record followed by the final state, used to verify replays: tick, flag position,
+#   player count, then one SUMMARY_PLAYER record per player still in the game
+MAGIC = b"CTFR"
+FORMAT_VERSION = 2
+HEADER = struct.Struct("!4sBHHQB")
+LAYOUT_LENGTH = struct.Struct("!H")
+EVENT = struct.Struct("!IBbb")
+REMOVAL_BIT = 0x80
+END_MARKER = 0xFF
+SUMMARY = struct.Struct("!HHB")
+SUMMARY_PLAYER = struct.Struct("!BHH?I")
+
+# Event kinds in a loaded recording.
+INPUT = "input"
+REMOVAL = "removal"
+
+# A loaded recording. events is a list of (tick, kind, player_id, dx, dy) in the order they were applied;
+# summary is the final state as {"tick", "flag", "players": {id: (pos, has_flag, score)}}, or None if the
+# recording was cut off (e.g. the server was stopped mid-match). layout is the team layout's to_dict() form.
+Recording = namedtuple("Recording", ["grid_size", "tick_rate", "seed", "player_ids", "events", "summary", "layout"])
+
+class MatchRecorder:
+    # Appends one match's inputs to a compact binary log (see the format above). Written only from the
+    # simulation tick, through a buffered file, so recording an input costs one struct pack and a buffer append.
+    def __init__(self, path, game_state, tick_rate=30):
+        self.path = path
+        self.file = open(path, "wb")
+        player_ids = list(game_state.players)
+        self.file.write(HEADER.pack(MAGIC, FORMAT_VERSION, game_state.grid_size, tick_rate, game_state.seed,
+                                    len(player_ids)))
+        self.file.write(bytes(player_ids))
+        layout = json.dumps(game_state.layout.to_dict(), separators=(",", ":")).encode()
+        self.file.write(LAYOUT_LENGTH.pack(len(layout)) + layout)
+
+    # Opens a recording for game_state in directory, named after the room and the time the match started.
+    @classmethod
+    def create(cls, directory, room_id, game_state, tick_rate=30):
+        os.makedirs(directory, exist_ok=True)
+        name = f"room{room_id}-{time.strftime('%Y%m%d-%H%M%S')}-{game_state.seed:016x}.ctfr"
+        return cls(os.path.join(directory, name), game_state, tick_rate)
+
+    # Records a move applied on tick (valid or not: a rejected move is replayed as rejected).
+    def record_input(self, tick, player_id, dx, dy):
+        self.file.write(EVENT.pack(tick, player_id, dx, dy))
+
+    # Records a player's removal on tick.
+    def record_removal(self, tick, player_id):
+        self.file.write(EVENT.pack(tick, player_id | REMOVAL_BIT, 0, 0))
+
+    # Writes the final state and closes the file.
+    def finish(self, game_state):
+        flag_x, flag_y = game_state.flag_pos
+        self.file.write(EVENT.pack(game_state.tick, END_MARKER, 0, 0))
+        self.file.write(SUMMARY.pack(flag_x, flag_y, len(game_state.players)))
+        for player in game_state.players.values():
+            self.file.write(SUMMARY_PLAYER.pack(player.id, player.pos[0], player.pos[1], player.has_flag, player.score))
+        self.file.close()
+
+# Reads a recording file. Raises ValueError if it isn't one.
+def load_recording(path):
+    with open(path, "rb") as file:
+        data = file.read()
+    if len(data) < HEADER.size:
+        raise ValueError(f"{path} is not a match recording")
+    magic, version, grid_size, tick_rate, seed, player_count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError(f"{path} is not a version {FORMAT_VERSION} match recording")
+    offset = HEADER.size
+    player_ids = list(data[offset:offset + player_count])
+    offset += player_count
+    (length,) = LAYOUT_LENGTH.unpack_from(data, offset)
+    offset += LAYOUT_LENGTH.size
+    layout = json.loads(data[offset:offset + length])
+    offset += length
+
+    events = []
+    summary = None
+    while offset + EVENT.size <= len(data):
+        tick, player_id, dx, dy = EVENT.unpack_from(data, offset)
+        offset += EVENT.size
+        if player_id == END_MARKER:
+            flag_x, flag_y, count = SUMMARY.unpack_from(data, offset)
+            offset += SUMMARY.size
+            players = {}
+            for _ in range(count):
+                pid, x, y, has_flag, score = SUMMARY_PLAYER.unpack_from(data, offset)
+                offset += SUMMARY_PLAYER.size
+                players[pid] = ((x, y), has_flag, score)
+            summary = {"tick": tick, "flag": (flag_x, flag_y), "players": players}
+            break
+        if player_id & REMOVAL_BIT:
+            events.append((tick, REMOVAL, player_id & ~REMOVAL_BIT, 0, 0))
+        else:
+            events.append((tick, INPUT, player_id, dx, dy))
+    return Recording(grid_size, tick_rate, seed, player_ids, events, summary, layout)
@@ -0,0 +1,29 @@
+import argparse
+import os
+import sys
+
+# protocol.py is shared with the client
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+from spectator_relay import SpectatorRelay
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Capture the Flag spectator relay")
+    parser.add_argument("--upstream-host", default="127.0.0.1", help="game server to relay")
+    parser.add_argument("--upstream-port", type=int, default=12345, help="game server port")
+    parser.add_argument("--host", default="127.0.0.1", help="address spectators connect to")
+    parser.add_argument("--port", type=int, default=12346, help="port spectators connect to")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds spectators lag behind the game")
+    parser.add_argument("--batch-ticks", type=int, default=1, help="server ticks sent to spectators per frame")
+    parser.add_argument("--tick-rate", type=int, default=30,
+                        help="state frames per second the game server sends: its --broadcast-rate, or its "
+                             "--tick-rate if that isn't set")
+    parser.add_argument("--secret", help="the game server's --relay-secret; needed unless it runs on this machine")
+    args = parser.parse_args()
+    if args.tick_rate < 1 or args.batch_ticks < 1:
+        parser.error("--tick-rate and --batch-ticks must be at least 1")
+
+    relay = SpectatorRelay(args.upstream_host, args.upstream_port, args.host, args.port,
+                           delay=args.delay, batch_ticks=args.batch_ticks, tick_rate=args.tick_rate,
+                           secret=args.secret)
+    relay.start()
@@ -0,0 +1,104 @@
+import threading
+from game_state import GameState
+from interest import InterestFilter
+
+class Room:
+    # A single independent match hosted by the server: its own lobby slots, GameState and client sockets.
+    # The lock guards the lobby state; the server only ticks rooms that have a game in progress.
+    # The server passes in a lock that records its wait and hold times; any context-manager lock works.
+    # With a view_radius, each player is only sent the part of the state around them (see interest.py).
+    def __init__(self, room_id, grid_size=15, max_players=4, lock=None, view_radius=None):
+        self.room_id = room_id
+        self.grid_size = grid_size
+        self.max_players = max_players
+        self.lock = lock or threading.Lock()
+        self.game_state = GameState(grid_size)
+        self.player_count = 0
+        self.in_game = False
+        self.closed = False
+
+        self.lobby_state = {
+            'players': [None] * max_players,
+            'ready_states': [False] * max_players,
+            'sockets': [None] * max_players,
+            'addresses': [None] * max_players,
+            'protocols': [None] * max_players
+        }
+
+        # Per slot: the session token its player can reattach with after a server restart, and until when
+        # (monotonic time) a restored slot stays reserved for its player to come back.
+        self.sessions = [None] * max_players
+        self.reserved_until = [None] * max_players
+
+        # Spectator relays subscribed to this room's state stream, as (connection, protocol) pairs.
+        self.relays = []
+
+        # Delta broadcast bookkeeping: the GameState version each subscriber (a slot, or a relay's connection)
+        # was last sent (missing or None = needs a keyframe), and ticks since the last periodic keyframe.
+        self.sent_versions = {}
+        self.broadcast_source = None
+        self.ticks_since_keyframe = 0
+        self.interest = InterestFilter(view_radius) if view_radius else None
+
+    # Returns True if a new player can be matched into this room (lobby not full and no game running).
+    def is_open(self):
+        return not self.closed and not self.in_game and self.player_count < self.max_players
+
+    # Returns the first empty lobby slot, or -1 if the room is full.
+    def free_slot(self):
+        for i in range(self.max_players):
+            if self.lobby_state['players'][i] is None:
+                return i
+        return -1
+
+    # Returns True if at least two players are ready — used to validate game start conditions.
+    def check_can_start(self):
+        players = self.lobby_state['players']
+        ready = self.lobby_state['ready_states']
+        ready_count = sum(
+            1 for p, r in zip(players, ready) if p is not None and r
+        )
+        return ready_count >= 2
+
+    # Empties a lobby slot. Caller must hold self.lock.
+    def clear_slot(self, player_id):
+        self.lobby_state['players'][player_id] = None
+        self.lobby_state['sockets'][player_id] = None
+        self.lobby_state['ready_states'][player_id] = False
+        self.lobby_state['addresses'][player_id] = None
+        self.lobby_state['protocols'][player_id] = None
+        self.sessions[player_id] = None
+        self.reserved_until[player_id] = None
+        self.player_count -= 1
+
+    # Returns the slot holding the given session token whose player isn't connected, or -1.
+    def reserved_slot(self, session):
+        for i, token in enumerate(self.sessions):
+            if token is not None and token == session and self.lobby_state['sockets'][i] is None:
+                return i
+        return -1
+
+    # Returns the connection of the player in slot player_id, or None if the slot is empty or doesn't exist.
+    def connection_of(self, player_id):
+        if not isinstance(player_id, int) or not 0 <= player_id < self.max_players:
+            return None
+        return self.lobby_state['sockets'][player_id]
+
+    # Returns the wire protocol negotiated by the player in the given slot.
+    def protocol_of(self, player_id):
+        return self.lobby_state['protocols'][player_id]
+
+    # Returns (player_id, socket) pairs for every connected player in this room.
+    def connected_sockets(self):
+        return [(i, sock) for i, sock in enumerate(self.lobby_state['sockets']) if sock]
+
+    # Returns (key, connection, protocol) for everything that receives the game state: the connected players,
+    # keyed by slot, and the spectator relays, keyed by their connection.
+    def subscribers(self):
+        subscribers = [(i, sock, self.protocol_of(i)) for i, sock in self.connected_sockets()]
+        subscribers += [(connection, connection, protocol) for connection, protocol in self.relays]
+        return subscribers
+
+    # Names a subscriber key for log messages.
+    def describe(self, key):
+        return f"player {key + 1}" if isinstance(key, int) else "spectator relay"
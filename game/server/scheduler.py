@@ -0,0 +1,57 @@
+import time
+
+class PeriodicTask:
+    # One callback run at a fixed rate by a TickScheduler.
+    def __init__(self, name, rate, callback):
+        self.name = name
+        self.interval = 1 / rate
+        self.callback = callback
+        self.deadline = None
+        self.overruns = 0
+
+class TickScheduler:
+    # Runs periodic callbacks (e.g. the simulation tick and the broadcast) at independent fixed rates on the
+    # monotonic clock, from one thread or event loop, without needing pygame.
+    # - Drift compensation: a task's next deadline is its previous deadline plus its interval, not the time it
+    #   finished plus its interval, so time spent in callbacks and sleep overshoot don't slow the rate down.
+    # - Overruns: a task that is still behind its next deadline once it has run counts an overrun
+    #   (name_overruns) and resynchronizes, skipping the runs it missed instead of bursting to catch up.
+    # With a metrics registry, each run's lateness behind its deadline is recorded as name_lateness.
+    def __init__(self, metrics=None, clock=time.monotonic):
+        self.metrics = metrics
+        self.clock = clock
+        self.tasks = []
+
+    # Schedules callback() to run rate times per second, starting with the next run_pending.
+    def add(self, name, rate, callback):
+        task = PeriodicTask(name, rate, callback)
+        self.tasks.append(task)
+        if self.metrics is not None:
+            self.metrics.count(name + "_overruns", 0)
+        return task
+
+    # Runs every task whose deadline has passed, in the order they were added, and returns the number of
+    # seconds until the next deadline.
+    def run_pending(self):
+        for task in self.tasks:
+            now = self.clock()
+            if task.deadline is None:
+                task.deadline = now
+            if now < task.deadline:
+                continue
+            if self.metrics is not None:
+                self.metrics.observe(task.name + "_lateness", now - task.deadline)
+            task.callback()
+            task.deadline += task.interval
+            finished = self.clock()
+            if finished >= task.deadline:
+                task.overruns += 1
+                if self.metrics is not None:
+                    self.metrics.count(task.name + "_overruns")
+                task.deadline = finished
+        return max(0.0, min(task.deadline for task in self.tasks) - self.clock())
+
+    # Runs the tasks until the process exits; for a dedicated thread.
+    def run_forever(self, sleep=time.sleep):
+        while True:
+            sleep(self.run_pending())
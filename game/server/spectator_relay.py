@@ -0,0 +1,249 @@
+import asyncio
+import json
+import socket
+import threading
+import time
+from collections import deque
+from async_game_server import StreamConnection
+from outbound import MAX_PENDING_BYTES, MAX_STALE_FRAMES
+from protocol import JSON, SUPPORTED_PROTOCOLS, ProtocolError, choose_protocol, encode, encode_json, read_message_async
+from scheduler import TickScheduler
+
+class RoomFeed:
+    # The relay's subscription to one room on the game server, shared by all of its spectators of that room.
+    # Upstream messages wait in backlog as (arrival time, message) until the relay's delay has passed. They are
+    # then applied to a mirror of the room's state and go out to the spectators. The mirror is the delayed state,
+    # kept so a spectator joining late can start from a keyframe.
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.spectators = {}  # StreamConnection -> protocol
+        self.fresh = set()    # spectators that haven't had their first keyframe yet
+        self.backlog = deque()
+        self.ready = asyncio.Event()  # set once the server answered the subscription
+        self.error = None
+        self.grid_size = None
+        self.bases = None
+        self.closed = False
+        self.task = None
+
+        self.version = None
+        self.tick = 0
+        self.players = {}
+        self.flag = (0, 0)
+        self.locked_cells = []
+        self.acks = {}
+
+    # Applies an update or delta to the mirror. Returns False for a delta that doesn't follow the mirrored
+    # version; it is not forwarded, and the mirror waits for the server's next periodic keyframe.
+    def apply(self, message):
+        if message["type"] == "update":
+            self.players = {p["id"]: p for p in message["players"]}
+            self.locked_cells = message["locked_cells"]
+            self.acks = dict(message["acks"])
+        elif message.get("base") != self.version:
+            return False
+        else:
+            for player in message["players"]:
+                self.players[player["id"]] = player
+            for player_id in message["removed"]:
+                self.players.pop(player_id, None)
+            self.locked_cells = message.get("locked_cells", self.locked_cells)
+            self.acks.update(message["acks"])
+        self.flag = message.get("flag", self.flag)
+        self.version = message["version"]
+        self.tick = message["tick"]
+        return True
+
+    # Returns the mirrored state as a keyframe update message.
+    def keyframe(self):
+        return {
+            "type": "update", "room_id": self.room_id, "keyframe": True, "version": self.version, "tick": self.tick,
+            "players": list(self.players.values()), "flag": self.flag, "locked_cells": self.locked_cells,
+            "acks": [[pid, seq] for pid, seq in self.acks.items()],
+        }
+
+class SpectatorRelay:
+    # Fan-out tier for spectators. The game server sends one state stream per watched room to the relay
+    # (a "relay" join, see GameServer.register_relay), and the relay re-broadcasts it to any number of
+    # spectators, so the players' tick costs the same however many people are watching. Run it as its own
+    # process (relay_main.py) or on its own event loop thread (start_in_thread).
+    # - Spectators connect like a normal client and join a room by id. They get lobby_init (with no player id)
+    #   and game_start, then the game state, delayed by delay seconds.
+    # - Frames go out every batch_ticks server ticks (tick_rate per second). All the updates in a batch are
+    #   written to each spectator at once, encoded once per protocol.
+    # - A spectator whose previous batch is still queued gets a keyframe instead, like a slow player does.
+    # - secret is the game server's relay secret, if it has one; without one the server only takes relays
+    #   connecting over loopback.
+    def __init__(self, upstream_host, upstream_port, host="127.0.0.1", port=12346, delay=0.0, batch_ticks=1,
+                 tick_rate=30, protocols=SUPPORTED_PROTOCOLS, max_outbound_bytes=MAX_PENDING_BYTES,
+                 max_stale_frames=MAX_STALE_FRAMES, secret=None):
+        self.upstream_host = upstream_host
+        self.upstream_port = upstream_port
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.batch_ticks = batch_ticks
+        self.tick_rate = tick_rate
+        self.protocols = protocols
+        self.max_outbound_bytes = max_outbound_bytes
+        self.max_stale_frames = max_stale_frames
+        self.secret = secret
+        self.feeds = {}
+
+    # Returns the feed for a room, subscribing to it on the game server first if nobody is watching it yet.
+    # Returns None if the server refused the subscription.
+    async def get_feed(self, room_id):
+        feed = self.feeds.get(room_id)
+        if feed is None:
+            feed = self.feeds[room_id] = RoomFeed(room_id)
+            feed.task = asyncio.create_task(self.run_feed(feed))
+        await feed.ready.wait()
+        if feed.error:
+            self.forget_feed(feed)
+            return None
+        return feed
+
+    # Reads a room's state stream from the game server into the feed's backlog until the server closes it.
+    async def run_feed(self, feed):
+        writer = None
+        try:
+            reader, writer = await asyncio.open_connection(self.upstream_host, self.upstream_port)
+            join = {"type": "join", "relay": True, "room_id": feed.room_id, "protocols": list(self.protocols)}
+            if self.secret is not None:
+                join["secret"] = self.secret
+            writer.write(encode_json(join))
+            reply = json.loads(await reader.readline() or "{}")
+            if reply.get("type") != "relay_init":
+                feed.error = reply.get("message", "Could not subscribe to the room")
+                return
+            feed.grid_size = reply.get("grid_size")
+            feed.bases = reply.get("bases")
+            protocol = reply.get("protocol", JSON)
+            feed.ready.set()
+            while True:
+                try:
+                    message = await read_message_async(reader, protocol)
+                except ProtocolError:
+                    continue
+                if message is None:
+                    break
+                feed.backlog.append((time.monotonic(), message))
+        except (OSError, ValueError) as e:
+            feed.error = feed.error or str(e)
+        finally:
+            feed.closed = True
+            feed.ready.set()
+            if writer is not None:
+                writer.close()
+
+    # Serves one spectator: reads its join message, subscribes it to the room's feed and then waits for it to
+    # leave. Anything else the spectator sends is ignored.
+    async def handle_spectator(self, reader, writer):
+        connection = StreamConnection(writer, self.max_outbound_bytes, self.max_stale_frames)
+        feed = None
+        try:
+            try:
+                join_message = json.loads(await reader.readline() or "{}")
+            except ValueError:
+                join_message = {}
+            room_id = join_message.get("room_id")
+            feed = await self.get_feed(room_id) if room_id is not None else None
+            if feed is None or feed.closed:
+                error = "Spectators must join a room by id" if room_id is None else f"Room {room_id} is not available"
+                connection.send(encode_json({"type": "join_error", "message": error}))
+                feed = None
+                return
+            protocol = choose_protocol(join_message.get("protocols"), self.protocols)
+            connection.send(encode_json({
+                "type": "lobby_init", "room_id": room_id, "your_id": None, "spectator": True,
+                "protocol": protocol, "grid_size": feed.grid_size, "bases": feed.bases,
+            }))
+            feed.spectators[connection] = protocol
+            feed.fresh.add(connection)
+            while await reader.read(4096):
+                pass
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            if feed is not None:
+                feed.spectators.pop(connection, None)
+                feed.fresh.discard(connection)
+                self.forget_feed(feed)
+            connection.close()
+
+    # Unsubscribes from a room nobody is watching any more.
+    def forget_feed(self, feed):
+        if feed is not None and not feed.spectators and self.feeds.get(feed.room_id) is feed:
+            del self.feeds[feed.room_id]
+            feed.task.cancel()
+
+    # Delivery task, run every batch_ticks server ticks: forwards each feed's due updates.
+    def deliver(self):
+        now = time.monotonic()
+        for feed in list(self.feeds.values()):
+            self.deliver_feed(feed, now)
+
+    # Applies the feed's updates that have waited out the delay to its mirror, and sends them to every spectator
+    # as one frame. Spectators who are new or behind get a keyframe of the mirror instead.
+    # Once the server has closed the feed and its backlog is drained, the spectators are disconnected.
+    def deliver_feed(self, feed, now):
+        due = []
+        controls = []
+        while feed.backlog and feed.backlog[0][0] + self.delay <= now:
+            message = feed.backlog.popleft()[1]
+            if message.get("type") not in ("update", "delta"):
+                controls.append(message)
+            elif feed.apply(message):
+                due.append(message)
+        batches = {}
+        keyframes = {}
+        for connection, protocol in list(feed.spectators.items()):
+            try:
+                for message in controls:
+                    connection.send(encode(message, protocol))
+                if connection in feed.fresh or (due and connection.is_behind()):
+                    if feed.version is None:
+                        continue
+                    if connection in feed.fresh:
+                        connection.send(encode({"type": "game_start", "room_id": feed.room_id}, protocol))
+                        feed.fresh.discard(connection)
+                    if protocol not in keyframes:
+                        keyframes[protocol] = encode(feed.keyframe(), protocol)
+                    connection.send_state(keyframes[protocol])
+                elif due:
+                    if protocol not in batches:
+                        batches[protocol] = b"".join(encode(message, protocol) for message in due)
+                    connection.send_state(batches[protocol])
+            except ConnectionError:
+                feed.spectators.pop(connection, None)
+                feed.fresh.discard(connection)
+        if feed.closed and not feed.backlog:
+            for connection in feed.spectators:
+                connection.close()
+            feed.spectators.clear()
+            self.forget_feed(feed)
+
+    # Opens the spectator port and runs the delivery task until the relay is stopped.
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_spectator, self.host, self.port, reuse_address=True,
+                                            backlog=socket.SOMAXCONN)
+        print(f"Spectator relay listening on {self.host}:{self.port}, "
+              f"relaying {self.upstream_host}:{self.upstream_port}")
+        scheduler = TickScheduler()
+        scheduler.add("relay", self.tick_rate / self.batch_ticks, self.deliver)
+        async with server:
+            while True:
+                await asyncio.sleep(scheduler.run_pending())
+
+    def start(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+    # Runs the relay on its own event loop in a daemon thread of this process.
+    def start_in_thread(self):
+        thread = threading.Thread(target=self.start)
+        thread.daemon = True
+        thread.start()
+        return thread
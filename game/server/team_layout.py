@@ -0,0 +1,81 @@
+import colorsys
+import json
+
+# Colors of the first four teams, as the original four players had; later teams get evenly spaced hues.
+TEAM_COLORS = [(255, 0, 0), (0, 0, 255), (255, 255, 0), (0, 255, 255)]
+
+class TeamLayout:
+    # Where a match's teams have their bases and where their players start.
+    # - bases[t] is team t's base: its players score by bringing the flag there, and the flag never spawns on it.
+    # - spawns[t] lists the cells team t's players start on, in join order. A team with more players than
+    #   spawn points (or none given) continues with the cells nearest its base.
+    # Player id p plays for team (p - 1) % team count, so with the default four corner bases players 1 to 4 each
+    # have a base of their own, and players 5 to 8 join them, and so on.
+    def __init__(self, grid_size, bases, spawns=None):
+        self.grid_size = grid_size
+        self.bases = [tuple(base) for base in bases]
+        if not self.bases:
+            raise ValueError("A layout needs at least one base")
+        for x, y in self.bases:
+            if not (0 <= x < grid_size and 0 <= y < grid_size):
+                raise ValueError(f"Base {(x, y)} is off the {grid_size}x{grid_size} grid")
+        spawns = spawns or [[] for _ in self.bases]
+        if len(spawns) != len(self.bases):
+            raise ValueError("A layout needs one spawn list per base")
+        self.spawns = [[tuple(cell) for cell in cells] for cells in spawns]
+        for x, y in (cell for cells in self.spawns for cell in cells):
+            if not (0 <= x < grid_size and 0 <= y < grid_size):
+                raise ValueError(f"Spawn point {(x, y)} is off the {grid_size}x{grid_size} grid")
+        self.spawn_orders = [None] * len(self.bases)
+
+    # The default layout: a base in each of the grid's first team_count corners (top left, top right,
+    # bottom left, bottom right; two teams play from opposite corners), with players spawning around them.
+    @classmethod
+    def corners(cls, grid_size, team_count=4):
+        corners = [(0, 0), (grid_size - 1, 0), (0, grid_size - 1), (grid_size - 1, grid_size - 1)]
+        if not 1 <= team_count <= len(corners):
+            raise ValueError("The corner layout has room for 1 to 4 teams")
+        if team_count == 2:
+            return cls(grid_size, [corners[0], corners[3]])
+        return cls(grid_size, corners[:team_count])
+
+    # Builds a layout from its to_dict() form: {"bases": [[x, y], ...], "spawns": [[[x, y], ...], ...]}.
+    @classmethod
+    def from_dict(cls, grid_size, data):
+        return cls(grid_size, data["bases"], data.get("spawns"))
+
+    # Reads a layout from a JSON file in the to_dict() form.
+    @classmethod
+    def load(cls, grid_size, path):
+        with open(path) as file:
+            return cls.from_dict(grid_size, json.load(file))
+
+    def to_dict(self):
+        return {"bases": [list(base) for base in self.bases],
+                "spawns": [[list(cell) for cell in cells] for cells in self.spawns]}
+
+    @property
+    def team_count(self):
+        return len(self.bases)
+
+    def team_of(self, player_id):
+        return (player_id - 1) % len(self.bases)
+
+    def color(self, team):
+        if team < len(TEAM_COLORS):
+            return TEAM_COLORS[team]
+        r, g, b = colorsys.hsv_to_rgb((team * 0.618034) % 1.0, 0.8, 1.0)
+        return (int(r * 255), int(g * 255), int(b * 255))
+
+    # Returns every cell team may start on, best first: its spawn points, then all other cells by distance from
+    # its base. Other teams' bases are left out. Computed once per team.
+    def spawn_order(self, team):
+        order = self.spawn_orders[team]
+        if order is None:
+            base_x, base_y = self.bases[team]
+            others = set(self.bases) - {self.bases[team]}
+            nearest = sorted(((x, y) for y in range(self.grid_size) for x in range(self.grid_size)),
+                             key=lambda cell: (abs(cell[0] - base_x) + abs(cell[1] - base_y), cell[1], cell[0]))
+            order = [cell for cell in self.spawns[team] + nearest if cell not in others]
+            self.spawn_orders[team] = order
+        return order
@@ -0,0 +1,70 @@
+import asyncio
+import socket
+import threading
+from protocol import MAX_DATAGRAM_SIZE, UDP_HEADER, UDP_STATE
+from rate_limit import TokenBucket
+
+class UdpPeer:
+    # One player's UDP channel (see the UDP_* notes in protocol.py), found by its token. address is where the
+    # client's last datagram came from, so a client whose NAT mapping changes keeps its channel. Snapshots only
+    # go over it once the client confirms over TCP that datagrams reach it (connection.udp_peer is then set).
+    # Inputs are accepted as soon as the channel is open, rate-limited like the TCP stream.
+    def __init__(self, room, player_id, connection, token, rate, burst):
+        self.room = room
+        self.player_id = player_id
+        self.connection = connection
+        self.token = token
+        self.address = None
+        self.sent_seq = 0
+        self.last_input_seq = 0
+        self.limiter = TokenBucket(rate, burst)
+        # Written only by the game loop, for the stats endpoint.
+        self.bytes_sent = 0
+        self.datagrams_sent = 0
+
+    # Sends an encoded update (encode_update) as the next UDP_STATE datagram. Best effort: a datagram that
+    # can't be sent is simply lost, like one dropped on the way.
+    def send_state(self, transport, payload):
+        if self.address is None:
+            return
+        self.sent_seq += 1
+        datagram = UDP_HEADER.pack(UDP_STATE, self.token, self.sent_seq) + payload
+        try:
+            transport.sendto(datagram, self.address)
+        except OSError:
+            return
+        self.bytes_sent += len(datagram)
+        self.datagrams_sent += 1
+
+# Datagram endpoint of the event-loop server: hands every datagram to on_datagram(data, address).
+class UdpServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, on_datagram):
+        self.on_datagram = on_datagram
+
+    def datagram_received(self, data, address):
+        self.on_datagram(data, address)
+
+    # ICMP errors (e.g. a client that has gone away) are not worth stopping the endpoint for.
+    def error_received(self, exc):
+        pass
+
+# Opens a UDP socket on (host, port) for the threaded server and hands every datagram to
+# on_datagram(data, address) from a daemon thread. Returns the socket, which is also used to send.
+def serve_udp_in_thread(host, port, on_datagram):
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_socket.bind((host, port))
+
+    def receive_loop():
+        while True:
+            try:
+                data, address = udp_socket.recvfrom(MAX_DATAGRAM_SIZE)
+            except ConnectionError:  # ICMP port unreachable from an earlier send, on some platforms
+                continue
+            except OSError:
+                break
+            on_datagram(data, address)
+
+    thread = threading.Thread(target=receive_loop)
+    thread.daemon = True
+    thread.start()
+    return udp_socket
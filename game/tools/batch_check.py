@@ -0,0 +1,119 @@
+import argparse
+import os
+import sys
+import time
+
+GAME_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(GAME_DIR, "server"))
+sys.path.append(os.path.join(GAME_DIR, "common"))
+
+try:
+    import numpy as np
+except ImportError:
+    sys.exit("The batch simulator needs NumPy: pip install numpy")
+
+from batch_simulator import ACTION_MOVES, BatchSimulator
+from game_state import GameState
+
+class ScriptedFlagState(GameState):
+    # The reference GameState for one batch match. Its flag respawns on the cell the batch simulator picked,
+    # as long as that is a cell GameState could have picked itself; otherwise the spawn is reported in problems.
+    def __init__(self, grid_size, player_ids, problems):
+        self.spawn = None
+        self.problems = problems
+        super().__init__(grid_size, player_ids)
+
+    def generate_random_flag_position(self):
+        if self.spawn is None or not self.free_cells:
+            return super().generate_random_flag_position()
+        if self.spawn not in self.free_index:
+            self.problems.append(f"flag spawned on {self.spawn}, which is not a free cell")
+        return self.spawn
+
+# Compares a reference GameState with one batch match; returns a list of differences (empty if none).
+def compare(reference, batch_state):
+    problems = []
+    if reference.flag_pos != batch_state["flag"]:
+        problems.append(f"flag at {batch_state['flag']}, reference {reference.flag_pos}")
+    if reference.locked_cells != batch_state["locked_cells"]:
+        problems.append(f"locked cells {batch_state['locked_cells']}, reference {reference.locked_cells}")
+    for pid, player in reference.players.items():
+        expected = (player.pos, player.has_flag, player.score)
+        if batch_state["players"][pid] != expected:
+            problems.append(f"player {pid}: (pos, has_flag, score) {batch_state['players'][pid]}, reference {expected}")
+    return problems
+
+# Runs random action streams through the batch simulator and through one reference GameState per match,
+# comparing every match after every tick. Returns the first differences found, or an empty list.
+def check_conformance(matches, ticks, grid_size, player_count, seed, idle_chance):
+    rng = np.random.default_rng(seed)
+    batch = BatchSimulator(matches, grid_size, player_count, seed=seed)
+    problems = []
+    references = []
+    player_ids = list(range(1, player_count + 1))
+    for k in range(matches):
+        reference = ScriptedFlagState(grid_size, player_ids, problems)
+        reference.flag_pos = batch.match_state(k)["flag"]
+        references.append(reference)
+
+    for tick in range(1, ticks + 1):
+        actions = rng.integers(1, len(ACTION_MOVES), size=(matches, player_count))
+        actions[rng.random((matches, player_count)) < idle_chance] = 0
+        batch.step(actions)
+        for k, reference in enumerate(references):
+            batch_state = batch.match_state(k)
+            reference.spawn = batch_state["flag"]
+            for slot, action in enumerate(actions[k]):
+                if action:
+                    dx, dy = ACTION_MOVES[action]
+                    reference.queue_input(slot + 1, None, int(dx), int(dy))
+            reference.step()
+            problems.extend(compare(reference, batch_state))
+            if problems:
+                return [f"match {k}, tick {tick}: {problem}" for problem in problems]
+    return []
+
+# Times the batch simulator on random actions and returns match ticks per second.
+def benchmark(matches, ticks, grid_size, player_count, seed):
+    rng = np.random.default_rng(seed)
+    batch = BatchSimulator(matches, grid_size, player_count, seed=seed)
+    actions = rng.integers(0, len(ACTION_MOVES), size=(16, matches, player_count))
+    started = time.perf_counter()
+    for tick in range(ticks):
+        batch.step(actions[tick % len(actions)])
+    elapsed = time.perf_counter() - started
+    captures = int(batch.score.sum())
+    print(f"Simulated {matches} matches x {ticks} ticks in {elapsed:.3f}s: "
+          f"{matches * ticks / elapsed:,.0f} match ticks/s ({captures} captures)")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Check the batch simulator against GameState and time it")
+    parser.add_argument("--matches", type=int, default=200, help="matches to check against GameState")
+    parser.add_argument("--ticks", type=int, default=2000, help="ticks to check")
+    parser.add_argument("--grid-size", type=int, default=7, help="grid size (small grids capture more often)")
+    parser.add_argument("--players", type=int, default=4, help="players per match, 1 to 4")
+    parser.add_argument("--idle-chance", type=float, default=0.2, help="chance a player sends no input on a tick")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--bench-matches", type=int, default=10000, help="matches to time (0 to skip)")
+    parser.add_argument("--bench-ticks", type=int, default=500, help="ticks to time")
+    return parser.parse_args(argv)
+
+# Exits with status 1 if any batch match drifts from its reference GameState.
+def main(argv=None):
+    args = parse_args(argv)
+    started = time.perf_counter()
+    problems = check_conformance(args.matches, args.ticks, args.grid_size, args.players, args.seed,
+                                 args.idle_chance)
+    if problems:
+        print("The batch simulator does not match GameState:")
+        for problem in problems:
+            print(f"  {problem}")
+        return 1
+    print(f"{args.matches} matches x {args.ticks} ticks on a {args.grid_size}x{args.grid_size} grid match GameState "
+          f"({time.perf_counter() - started:.1f}s)")
+    if args.bench_matches:
+        benchmark(args.bench_matches, args.bench_ticks, 15, args.players, args.seed)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,487 @@
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+SCRIPT_PATH = os.path.abspath(__file__)
+GAME_DIR = os.path.join(os.path.dirname(SCRIPT_PATH), "..")
+sys.path.append(os.path.join(GAME_DIR, "server"))
+sys.path.append(os.path.join(GAME_DIR, "client"))
+sys.path.append(os.path.join(GAME_DIR, "common"))
+
+from game_client import GameClient
+from game_state import GameState
+from protocol import BINARY, encode, encode_json
+
+GRID_SIZES = (15, 50, 200)
+PLAYER_COUNTS = (4, 16, 64)
+# A benchmark fails once it is this much slower than its baseline (0.5 = 50%). Micro-benchmarks on shared or
+# virtual machines drift by a good fraction of that between runs, so a tighter default fails on noise.
+THRESHOLD = 0.5
+# A benchmark that looks slower than its baseline is measured up to RETRIES more times before it counts as a
+# regression: on a busy or virtual machine one slow measurement proves little.
+RETRIES = 2
+# With --base, every benchmark is measured by ROUNDS pairs of processes, one on the base commit and one on the
+# working tree, the two right after each other, and the median change across the pairs counts. A slow spell
+# of the machine then hits both sides of a pair alike, and no result depends on one process's luck with
+# memory layout, which can cost as much as 2x.
+ROUNDS = 3
+# Each benchmark runs REPEATS rounds of about ROUND_SECONDS and reports its median round, which neither a
+# stall nor a burst of turbo clock speed in one round can move much.
+REPEATS = 7
+ROUND_SECONDS = 0.02
+# Random cells per is_cell_occupied call batch.
+CELL_SAMPLES = 1024
+
+class Case:
+    # One benchmark: run() is timed. If reset is given it is called (untimed) before every run, for runs that
+    # change the state they measure; each run is then timed on its own. ops is how many operations one run does.
+    def __init__(self, run, reset=None, ops=1):
+        self.run = run
+        self.reset = reset
+        self.ops = ops
+
+    # Times rounds of iterations runs; returns the median round's seconds per operation. The garbage collector
+    # is off while timing, as in timeit, so a collection that happens to land in one round doesn't skew it.
+    def time(self, iterations, repeats):
+        rounds = []
+        run = self.run
+        reset = self.reset
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            for _ in range(repeats):
+                if reset is None:
+                    started = time.perf_counter()
+                    for _ in range(iterations):
+                        run()
+                    elapsed = time.perf_counter() - started
+                else:
+                    # A single call is short enough for one timer hiccup to outweigh it, so a round counts
+                    # its median call rather than the sum of them.
+                    calls = []
+                    for _ in range(iterations):
+                        reset()
+                        started = time.perf_counter()
+                        run()
+                        calls.append(time.perf_counter() - started)
+                    elapsed = statistics.median(calls) * iterations
+                rounds.append(elapsed)
+        finally:
+            if collecting:
+                gc.enable()
+        return statistics.median(rounds) / (iterations * self.ops)
+
+    # Returns how many runs make a round of about seconds.
+    def calibrate(self, seconds):
+        per_run = self.time(10, 1) * self.ops
+        return max(10, int(seconds / max(per_run, 1e-9)))
+
+# Moves a player to pos, keeping the occupancy grid and free-cell index in step.
+def relocate(state, player_id, pos):
+    player = state.players[player_id]
+    state.clear_cell(player.pos)
+    player.pos = pos
+    state.place_player(player_id, pos)
+
+# Returns a GameState with player ids 1 to players on the grid, seeded so every run builds the same one.
+def build_state(grid_size, players):
+    return GameState(grid_size, list(range(1, players + 1)), seed=1)
+
+# Returns length horizontally adjacent cells that are empty and not bases, as far from every base as possible.
+def free_row(state, length):
+    middle = state.grid_size // 2
+    for distance in range(middle + 1):
+        for y in (middle - distance, middle + distance):
+            for x in range(state.grid_size - length + 1):
+                cells = [(x + i, y) for i in range(length)]
+                if all(not state.is_cell_occupied(cell) and cell not in state.base_cells for cell in cells):
+                    return cells
+    raise ValueError("No free row of cells on the grid")
+
+# Clears cells of other players (moving them to free cells elsewhere) and puts the flag somewhere else too.
+def clear_area(state, cells, keep=()):
+    spare = [cell for cell in state.free_cells if cell not in cells]
+    for pid, player in state.players.items():
+        if player.pos in cells and pid not in keep:
+            relocate(state, pid, spare.pop())
+    state.flag_pos = spare.pop()
+    state.flag_carrier = None
+    state.locked_cells.clear()
+    for player in state.players.values():
+        player.has_flag = False
+
+# move_player: player 1 stepping back and forth between two free cells.
+def move_free(grid_size, players):
+    state = build_state(grid_size, players)
+    left, right = free_row(state, 2)
+    clear_area(state, [left, right])
+    relocate(state, 1, left)
+    direction = [1]
+
+    def run():
+        state.move_player(1, direction[0], 0)
+        direction[0] = -direction[0]
+    return Case(run)
+
+# move_player: player 1 walking into player 2, which is rejected.
+def move_blocked(grid_size, players):
+    state = build_state(grid_size, players)
+    left, right = free_row(state, 2)
+    clear_area(state, [left, right])
+    relocate(state, 1, left)
+    relocate(state, 2, right)
+    return Case(lambda: state.move_player(1, 1, 0))
+
+# move_player: player 1 stepping next to player 2 (another team) and taking the flag off them.
+def move_steal(grid_size, players):
+    state = build_state(grid_size, players)
+    start, beside, carrier = cells = free_row(state, 3)
+    clear_area(state, cells)
+    relocate(state, 2, carrier)
+    mover, holder = state.players[1], state.players[2]
+
+    def reset():
+        relocate(state, 1, start)
+        mover.has_flag = False
+        holder.has_flag = True
+        state.flag_carrier = 2
+        state.flag_pos = carrier
+    return Case(lambda: state.move_player(1, 1, 0), reset)
+
+# move_player: player 1 stepping onto the loose flag and picking it up.
+def move_pickup(grid_size, players):
+    state = build_state(grid_size, players)
+    start, flag = cells = free_row(state, 2)
+    clear_area(state, cells)
+    player = state.players[1]
+
+    def reset():
+        relocate(state, 1, start)
+        player.has_flag = False
+        state.flag_carrier = None
+        state.flag_pos = flag
+        state.locked_cells.clear()
+    return Case(lambda: state.move_player(1, 1, 0), reset)
+
+# move_player: player 1 carrying the flag onto their base, scoring, and the flag respawning.
+def move_capture(grid_size, players):
+    state = build_state(grid_size, players)
+    base = state.bases[state.team_of[1]]
+    start = (base[0] + 1, base[1]) if base[0] == 0 else (base[0] - 1, base[1])
+    clear_area(state, [base, start], keep=(1,))
+    player = state.players[1]
+    dx = base[0] - start[0]
+
+    def reset():
+        relocate(state, 1, start)
+        player.has_flag = True
+        state.flag_carrier = 1
+        state.flag_pos = start
+        state.locked_cells.clear()
+    return Case(lambda: state.move_player(1, dx, 0), reset)
+
+# is_cell_occupied on random cells, CELL_SAMPLES per run.
+def cell_occupied(grid_size, players):
+    state = build_state(grid_size, players)
+    rng = random.Random(1)
+    cells = [(rng.randrange(grid_size), rng.randrange(grid_size)) for _ in range(CELL_SAMPLES)]
+    occupied = state.is_cell_occupied
+
+    def run():
+        for cell in cells:
+            occupied(cell)
+    return Case(run, ops=CELL_SAMPLES)
+
+# generate_random_flag_position; occupancy grows with the player count and shrinks with the grid.
+def flag_spawn(grid_size, players):
+    state = build_state(grid_size, players)
+    return Case(state.generate_random_flag_position)
+
+# A JSON keyframe as the server builds it every broadcast: get_state plus json.dumps.
+def state_json(grid_size, players):
+    state = build_state(grid_size, players)
+    return Case(lambda: encode_json({"type": "update", "room_id": 1, "keyframe": True, **state.get_state()}))
+
+# The same keyframe as a binary frame, the protocol clients use by default.
+def state_binary(grid_size, players):
+    state = build_state(grid_size, players)
+    return Case(lambda: encode({"type": "update", "room_id": 1, "keyframe": True, **state.get_state()}, BINARY))
+
+# GameClient.handle_update on a keyframe as it arrives: json.loads of the line, then applying it.
+def client_update(grid_size, players):
+    state = build_state(grid_size, players)
+    line = encode_json({"type": "update", "room_id": 1, "keyframe": True, **state.get_state()})
+    client = GameClient(connect=False)
+    client.grid_size = grid_size
+    client.lobby_state["player_id"] = 0
+    return Case(lambda: client.handle_update(json.loads(line)))
+
+BENCHMARKS = {
+    "move_player.free": move_free,
+    "move_player.blocked": move_blocked,
+    "move_player.steal": move_steal,
+    "move_player.pickup": move_pickup,
+    "move_player.capture": move_capture,
+    "is_cell_occupied": cell_occupied,
+    "generate_random_flag_position": flag_spawn,
+    "get_state+json": state_json,
+    "get_state+binary": state_binary,
+    "client.handle_update": client_update,
+}
+
+# Returns the microseconds per operation of one benchmark at one grid size and player count.
+def measure(name, grid_size, players, repeats=REPEATS, seconds=ROUND_SECONDS):
+    case = BENCHMARKS[name](grid_size, players)
+    iterations = case.calibrate(seconds)
+    return round(case.time(iterations, repeats) * 1e6, 4)
+
+# Yields (name, grid_size, players) for every benchmark whose name contains one of only (all by default) on
+# every grid size and player count that fits.
+def select(grid_sizes, player_counts, only=None):
+    for name in BENCHMARKS:
+        if only and not any(pattern in name for pattern in only):
+            continue
+        for grid_size in grid_sizes:
+            for players in player_counts:
+                if players * 2 <= grid_size * grid_size:
+                    yield name, grid_size, players
+
+# Runs the selected benchmarks. Returns {(name, grid_size, players): microseconds per operation}.
+def run_benchmarks(grid_sizes, player_counts, only=None, repeats=REPEATS):
+    results = {}
+    for result in select(grid_sizes, player_counts, only):
+        results[result] = value = measure(*result, repeats)
+        print(f"{result_key(*result):<60} {value:>10.3f} us")
+    return results
+
+# Names the machine results were measured on: its host, CPU and Python version. Saved results are only
+# compared with a run on the same machine.
+def machine_id():
+    cpu = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as file:
+            for line in file:
+                if line.startswith("model name"):
+                    cpu = line.split(":", 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    return f"{platform.node()} / {cpu or platform.machine()} / Python {platform.python_version()}"
+
+# The name a result is reported under.
+def result_key(name, grid_size, players):
+    return f"{name}[grid={grid_size},players={players}]"
+
+# Writes results to path, along with the machine they were measured on.
+def save_results(path, results):
+    with open(path, "w") as file:
+        json.dump({
+            "machine": machine_id(),
+            "results": [{"name": name, "grid_size": grid_size, "players": players, "us": value}
+                        for (name, grid_size, players), value in results.items()],
+        }, file, indent=2)
+        file.write("\n")
+
+# Reads results written by save_results; returns (machine, results).
+def load_results(path):
+    with open(path) as file:
+        saved = json.load(file)
+    return saved["machine"], {(result["name"], result["grid_size"], result["players"]): result["us"]
+                              for result in saved["results"]}
+
+# Returns {result: (before, after, change)} for the results that are in both results and baseline.
+def changes_between(results, baseline):
+    return {result: (baseline[result], value, value / baseline[result] - 1)
+            for result, value in results.items() if baseline.get(result)}
+
+# Sorts changes out by the threshold; returns (regressions, improvements) as {result: report line}.
+def compare(changes, threshold):
+    regressions = {}
+    improvements = {}
+    for result, (before, after, change) in changes.items():
+        line = f"{result_key(*result)}: {before:.3f} -> {after:.3f} us ({change:+.0%})"
+        if change > threshold:
+            regressions[result] = line
+        elif change < -threshold:
+            improvements[result] = line
+    return regressions, improvements
+
+# Prints the comparison; returns the exit status.
+def report(regressions, improvements, threshold, against):
+    for line in improvements.values():
+        print(f"Faster: {line}")
+    if regressions:
+        print(f"Slower than {against} by more than {threshold:.0%}:")
+        for line in regressions.values():
+            print(f"  {line}")
+        return 1
+    print(f"No benchmark is more than {threshold:.0%} slower than {against}")
+    return 0
+
+# Measures benchmarks named on stdin, one JSON [name, grid_size, players] per line, answering each with its
+# microseconds per operation, or null if this tree can't run it. Used by --base for both sides.
+def serve_measurements(repeats):
+    for line in sys.stdin:
+        name, grid_size, players = json.loads(line)
+        try:
+            value = measure(name, grid_size, players, repeats)
+        except (KeyError, TypeError, AttributeError, ValueError) as e:
+            print(f"{result_key(name, grid_size, players)}: {e!r}", file=sys.stderr)
+            value = None
+        print(json.dumps(value), flush=True)
+
+class Worker:
+    # A process running script --worker, which measures the game in the tree that script is in.
+    def __init__(self, label, script, repeats):
+        self.label = label
+        self.process = subprocess.Popen([sys.executable, script, "--worker", "--repeats", str(repeats)],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+
+    # Returns the microseconds per operation of one benchmark, or None if this tree can't run it.
+    def measure(self, result):
+        self.process.stdin.write(json.dumps(result) + "\n")
+        self.process.stdin.flush()
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError(f"Benchmarking {self.label} failed: the worker exited with status "
+                               f"{self.process.wait()}")
+        return json.loads(line)
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+# Starts rounds pairs of workers, one on base_script and one on this script each.
+def start_workers(base, base_script, rounds, repeats):
+    return [(Worker(base, base_script, repeats), Worker("the working tree", SCRIPT_PATH, repeats))
+            for _ in range(rounds)]
+
+def close_workers(pairs):
+    for pair in pairs:
+        for worker in pair:
+            worker.close()
+
+# Measures the game at the git commit base and in the working tree and compares them. The base is measured
+# with this script, so both sides run the same benchmarks, and the two alternate benchmark by benchmark.
+def compare_with_commit(args):
+    with tempfile.TemporaryDirectory() as tree:
+        archive = subprocess.run(["git", "archive", "--format=tar", args.base, "game"],
+                                 cwd=os.path.join(GAME_DIR, ".."), capture_output=True)
+        if archive.returncode != 0:
+            print(f"Can't read {args.base}: {archive.stderr.decode().strip()}")
+            return 2
+        with tarfile.open(fileobj=io.BytesIO(archive.stdout)) as tar:
+            tar.extractall(tree, filter="data")
+        base_script = os.path.join(tree, "game", "tools", "benchmark.py")
+        os.makedirs(os.path.dirname(base_script), exist_ok=True)
+        shutil.copy(SCRIPT_PATH, base_script)
+        # {result: [(base, working tree) microseconds, one per pair of workers]}
+        samples = {}
+
+        # Measures result with every pair of workers, one side right after the other, starting with a
+        # different side each time. Results only one side can run aren't compared.
+        def measure_both(result, pairs):
+            for index, (base_worker, head_worker) in enumerate(pairs):
+                if index % 2 == 0:
+                    before, after = base_worker.measure(result), head_worker.measure(result)
+                else:
+                    after, before = head_worker.measure(result), base_worker.measure(result)
+                if before and after:
+                    samples.setdefault(result, []).append((before, after))
+
+        # The median of each side, and the median change between the two measurements of a pair.
+        def changes(results):
+            return {result: (statistics.median(before for before, _ in samples[result]),
+                             statistics.median(after for _, after in samples[result]),
+                             statistics.median(after / before - 1 for before, after in samples[result]))
+                    for result in results if result in samples}
+
+        pairs = start_workers(args.base, base_script, args.rounds, args.repeats)
+        try:
+            for result in select(args.grid_sizes, args.players, args.only):
+                measure_both(result, pairs)
+                if result in samples:
+                    before, after, change = changes([result])[result]
+                    print(f"{result_key(*result):<60} {before:>10.3f} -> {after:>10.3f} us  {change:+.0%}")
+                else:
+                    print(f"{result_key(*result):<60} not run by both sides")
+            regressions, improvements = compare(changes(samples), args.threshold)
+            # Apparent regressions are measured again in fresh processes.
+            for _ in range(RETRIES):
+                if not regressions:
+                    break
+                close_workers(pairs)
+                pairs = start_workers(args.base, base_script, args.rounds, args.repeats)
+                for result in regressions:
+                    measure_both(result, pairs)
+                regressions, _ = compare(changes(regressions), args.threshold)
+        except RuntimeError as e:
+            print(e)
+            return 2
+        finally:
+            close_workers(pairs)
+    return report(regressions, improvements, args.threshold, args.base)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for GameState and message encoding")
+    parser.add_argument("--grid-sizes", type=int, nargs="+", default=GRID_SIZES)
+    parser.add_argument("--players", type=int, nargs="+", default=PLAYER_COUNTS)
+    parser.add_argument("--only", nargs="+", help="only run benchmarks whose name contains one of these")
+    parser.add_argument("--base", help="git commit to measure and compare against, e.g. main")
+    parser.add_argument("--rounds", type=int, default=ROUNDS, help="rounds per benchmark and side with --base")
+    parser.add_argument("--save", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare with results saved on this machine by --save")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="fail if a benchmark is this much slower than its baseline (0.5 = 50%%)")
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.base and args.baseline:
+        parser.error("--base and --baseline can't be used together")
+    if args.rounds < 1:
+        parser.error("--rounds must be at least 1")
+    return args
+
+# Exits with status 1 if any benchmark regressed beyond the threshold against the base commit or saved
+# baseline, and with status 2 if the comparison couldn't be made.
+def main(argv=None):
+    args = parse_args(argv)
+    if args.worker:
+        serve_measurements(args.repeats)
+        return 0
+    if args.base:
+        return compare_with_commit(args)
+    results = run_benchmarks(args.grid_sizes, args.players, args.only, args.repeats)
+    if args.save:
+        save_results(args.save, results)
+        print(f"Saved {len(results)} results to {args.save}")
+    if not args.baseline:
+        return 0
+    machine, baseline = load_results(args.baseline)
+    if machine != machine_id():
+        print(f"{args.baseline} was measured on {machine}, not on this machine ({machine_id()}); "
+              f"save a baseline here with --save, or use --base")
+        return 2
+    regressions, improvements = compare(changes_between(results, baseline), args.threshold)
+    for _ in range(RETRIES):
+        if not regressions:
+            break
+        for result in regressions:
+            results[result] = min(results[result], measure(*result, args.repeats))
+        regressions, _ = compare(changes_between({result: results[result] for result in regressions}, baseline),
+                                 args.threshold)
+    return report(regressions, improvements, args.threshold, args.baseline)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,357 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+GAME_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(GAME_DIR, "server"))
+sys.path.append(os.path.join(GAME_DIR, "common"))
+
+from game_server import MAX_ROOM_PLAYERS
+from protocol import BINARY, FRAME_HEADER, JSON, decode_frame, encode, parse_header
+
+try:
+    import resource  # Unix only; used for the server subprocess's CPU time
+except ImportError:
+    resource = None
+
+# Scripted movement: each bot walks a small square, so players keep moving without leaving the board.
+SQUARE_MOVES = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+RANDOM_MOVES = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+
+# Returns the p-th percentile (0-100) of an already sorted list, or None if it is empty.
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+# Summarizes a list of latencies in seconds as milliseconds.
+def latency_summary(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean_ms": 1000 * sum(values) / len(values),
+        "p50_ms": 1000 * percentile(values, 50),
+        "p90_ms": 1000 * percentile(values, 90),
+        "p99_ms": 1000 * percentile(values, 99),
+        "max_ms": 1000 * values[-1],
+    }
+
+class Bot:
+    # A headless protocol-level client: joins (or creates) a room, readies up, lets the room's host start
+    # the game, then sends moves at input_rate and measures how long each input takes to be acknowledged
+    # in a state update. Speaks the same wire protocols as GameClient, without pygame or tkinter.
+    def __init__(self, bot_id, host, port, protocol, room_size, input_rate, moves, room_id=None, create=False):
+        self.bot_id = bot_id
+        self.host = host
+        self.port = port
+        self.offered_protocol = protocol
+        self.protocol = JSON  # until lobby_init says otherwise
+        self.room_size = room_size
+        self.input_rate = input_rate
+        self.moves = moves
+        self.requested_room = room_id
+        self.create = create
+
+        self.room_id = None
+        self.player_id = None
+        self.is_host = False
+        self.started = asyncio.Event()
+        self.joined = asyncio.Event()
+        self.sent_start = False
+
+        self.seq = 0
+        self.sent_at = {}  # seq -> send time, until acknowledged
+        self.acked = 0
+
+        self.accept_latency = None
+        self.input_latencies = []
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages_in = 0
+        self.messages_out = 0
+        self.state_messages = 0
+        self.error = None
+
+    async def send(self, message_type, data=None):
+        message = {"type": message_type, "room_id": self.room_id}
+        if data:
+            message.update(data)
+        payload = encode(message, self.protocol)
+        self.writer.write(payload)
+        self.bytes_out += len(payload)
+        self.messages_out += 1
+        await self.writer.drain()
+
+    # Reads one message in the connection's protocol; returns None at end of stream.
+    async def receive(self):
+        if self.protocol == BINARY:
+            try:
+                header = await self.reader.readexactly(FRAME_HEADER.size)
+                length, kind = parse_header(header)
+                payload = await self.reader.readexactly(length)
+            except asyncio.IncompleteReadError:
+                return None
+            self.bytes_in += FRAME_HEADER.size + length
+            message = decode_frame(kind, payload)
+        else:
+            line = await self.reader.readline()
+            if not line:
+                return None
+            self.bytes_in += len(line)
+            message = json.loads(line)
+        self.messages_in += 1
+        return message
+
+    # Connects and joins; accept latency covers connect until lobby_init arrives.
+    async def connect(self):
+        started = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        await self.send("join", {"room_id": self.requested_room, "create": self.create,
+                                 "protocols": [self.offered_protocol, JSON]})
+        message = await self.receive()
+        if message is None or message.get("type") != "lobby_init":
+            raise ConnectionError(f"Join failed: {message}")
+        self.accept_latency = time.perf_counter() - started
+        if len(message.get("players", ())) < self.room_size:
+            raise ConnectionError(f"The server's rooms hold {len(message.get('players', ()))} players, "
+                                  f"fewer than the room size of {self.room_size}")
+        self.room_id = message["room_id"]
+        self.player_id = message["your_id"]
+        self.is_host = message.get("is_host", False)
+        self.protocol = message.get("protocol", JSON)
+        self.joined.set()
+        await self.send("ready", {"player_id": self.player_id})
+
+    def handle_message(self, message):
+        message_type = message.get("type")
+        if message_type == "lobby_update":
+            ready = sum(1 for p, r in zip(message["players"], message["ready_states"]) if p is not None and r)
+            if self.is_host and not self.sent_start and message.get("can_start") and ready >= self.room_size:
+                self.sent_start = True
+                asyncio.create_task(self.send("start_request", {"player_id": self.player_id}))
+        elif message_type == "game_start":
+            self.started.set()
+        elif message_type in ("update", "delta"):
+            self.state_messages += 1
+            self.record_acks(message.get("acks", []))
+
+    # Every input up to the acknowledged sequence number has now been applied by the server.
+    def record_acks(self, acks):
+        now = time.perf_counter()
+        game_id = self.player_id + 1
+        for pid, seq in acks:
+            if pid != game_id or seq <= self.acked:
+                continue
+            for pending in range(self.acked + 1, seq + 1):
+                sent = self.sent_at.pop(pending, None)
+                if sent is not None:
+                    self.input_latencies.append(now - sent)
+            self.acked = seq
+
+    async def read_loop(self):
+        while True:
+            message = await self.receive()
+            if message is None:
+                break
+            self.handle_message(message)
+
+    async def input_loop(self, stop_at):
+        await self.started.wait()
+        interval = 1 / self.input_rate
+        step = 0
+        while time.perf_counter() < stop_at:
+            if self.moves == "square":
+                dx, dy = SQUARE_MOVES[step % len(SQUARE_MOVES)]
+            else:
+                dx, dy = random.choice(RANDOM_MOVES)
+            step += 1
+            self.seq += 1
+            self.sent_at[self.seq] = time.perf_counter()
+            await self.send("input", {"player_id": self.player_id, "seq": self.seq, "move": {"dx": dx, "dy": dy}})
+            await asyncio.sleep(interval)
+
+    # Runs until stop_at (a perf_counter time), then leaves the game.
+    async def run(self, stop_at):
+        try:
+            await self.connect()
+            reader_task = asyncio.create_task(self.read_loop())
+            try:
+                await asyncio.wait_for(self.input_loop(stop_at), max(0, stop_at - time.perf_counter()))
+            except asyncio.TimeoutError:
+                pass
+            await self.send("disconnect", {"player_id": self.player_id})
+            reader_task.cancel()
+        except (OSError, ValueError) as e:
+            self.error = str(e)
+        finally:
+            if hasattr(self, "writer"):
+                self.writer.close()
+
+# Starts every bot: the first bot of each room creates it and the rest join it by id.
+async def run_bots(args):
+    bots = []
+    tasks = []
+    stop_at = time.perf_counter() + args.duration
+    for first in range(0, args.bots, args.room_size):
+        size = min(args.room_size, args.bots - first)
+        host_bot = Bot(first, args.host, args.port, args.protocol, size, args.input_rate, args.moves, create=True)
+        bots.append(host_bot)
+        host_task = asyncio.create_task(host_bot.run(stop_at))
+        tasks.append(host_task)
+        joined = asyncio.create_task(host_bot.joined.wait())
+        await asyncio.wait([joined, host_task], return_when=asyncio.FIRST_COMPLETED)
+        if not host_bot.joined.is_set():
+            # The host couldn't join (see its error), so there is no room for the rest.
+            joined.cancel()
+            continue
+        for i in range(first + 1, first + size):
+            bot = Bot(i, args.host, args.port, args.protocol, size, args.input_rate, args.moves,
+                      room_id=host_bot.room_id)
+            bots.append(bot)
+            tasks.append(asyncio.create_task(bot.run(stop_at)))
+        if args.connect_delay:
+            await asyncio.sleep(args.connect_delay)
+    await asyncio.gather(*tasks)
+    return bots
+
+# Blocks until something accepts connections on (host, port), or raises after timeout seconds.
+def wait_for_server(host, port, timeout=10.0):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+# Starts the server under test in a subprocess and returns the Popen; main.py reads the host and port from stdin.
+def start_server_subprocess(args):
+    command = [sys.executable, os.path.join(GAME_DIR, "server", "main.py"), "--mode", args.mode,
+               "--max-rooms", str(args.bots), "--max-players", str(args.room_size),
+               "--grid-size", str(args.grid_size)]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL, text=True)
+    process.stdin.write(f"{args.host}\n{args.port}\n")
+    process.stdin.flush()
+    return process
+
+# Starts the server under test on a background thread of this process.
+def start_server_in_process(args):
+    from game_server import GameServer
+    from async_game_server import AsyncGameServer
+    server_class = AsyncGameServer if args.mode == "async" else GameServer
+    server = server_class(args.host, args.port, grid_size=args.grid_size, max_rooms=args.bots,
+                          max_players=args.room_size)
+    thread = threading.Thread(target=server.start)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=GAME_DIR, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Collects the bots' measurements into one JSON-serializable report.
+def build_report(args, bots, elapsed, server_cpu):
+    connected = [bot for bot in bots if bot.accept_latency is not None]
+    total_in = sum(bot.bytes_in for bot in bots)
+    total_out = sum(bot.bytes_out for bot in bots)
+    state_messages = sum(bot.state_messages for bot in bots)
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "elapsed_s": elapsed,
+        "bots": len(bots),
+        "connected": len(connected),
+        "errors": [bot.error for bot in bots if bot.error],
+        "accept_latency": latency_summary([bot.accept_latency for bot in connected]),
+        "input_to_update_latency": latency_summary([lat for bot in bots for lat in bot.input_latencies]),
+        "unacknowledged_inputs": sum(len(bot.sent_at) for bot in bots),
+        "broadcast": {
+            "state_messages": state_messages,
+            "state_messages_per_s": state_messages / elapsed,
+            "bytes_per_s": total_in / elapsed,
+        },
+        "per_client": {
+            "bytes_in": total_in / max(1, len(connected)),
+            "bytes_out": total_out / max(1, len(connected)),
+            "messages_in": sum(bot.messages_in for bot in bots) / max(1, len(connected)),
+            "messages_out": sum(bot.messages_out for bot in bots) / max(1, len(connected)),
+        },
+        "server_cpu_s": server_cpu,
+        "server_cpu_percent": None if server_cpu is None else 100 * server_cpu / elapsed,
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Drive a Capture the Flag server with headless bot clients")
+    parser.add_argument("--bots", type=int, default=100, help="number of bot clients")
+    parser.add_argument("--room-size", type=int, default=4,
+                        help="bots per room; a server started by the tool gets it as --max-players, an external "
+                             "one must allow at least this many")
+    parser.add_argument("--grid-size", type=int, default=15, help="grid size of a server started by the tool")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to play after connecting")
+    parser.add_argument("--input-rate", type=float, default=10.0, help="moves per second per bot")
+    parser.add_argument("--moves", choices=["random", "square"], default="random",
+                        help="random moves, or a scripted square walk")
+    parser.add_argument("--protocol", choices=[BINARY, JSON], default=BINARY, help="wire protocol the bots offer")
+    parser.add_argument("--server", choices=["subprocess", "inprocess", "external"], default="subprocess",
+                        help="start the server as a subprocess, on a thread in this process, or use a running one")
+    parser.add_argument("--mode", choices=["async", "threaded"], default="async", help="server mode to start")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12399)
+    parser.add_argument("--connect-delay", type=float, default=0.0, help="seconds between opening rooms")
+    parser.add_argument("--output", help="write the JSON report here as well as to stdout")
+    args = parser.parse_args(argv)
+    if not 2 <= args.room_size <= MAX_ROOM_PLAYERS:
+        parser.error(f"--room-size must be between 2 and {MAX_ROOM_PLAYERS}")
+    return args
+
+# Runs one load test and returns the report. Server CPU is only measured for the subprocess server:
+# an in-process server shares its CPU time with the bots.
+def main(argv=None):
+    args = parse_args(argv)
+    process = None
+    if args.server == "subprocess":
+        process = start_server_subprocess(args)
+    elif args.server == "inprocess":
+        start_server_in_process(args)
+    try:
+        wait_for_server(args.host, args.port)
+        started = time.perf_counter()
+        bots = asyncio.run(run_bots(args))
+        elapsed = time.perf_counter() - started
+    finally:
+        server_cpu = None
+        if process is not None:
+            process.terminate()
+            process.wait()
+            if resource is not None:
+                usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+                server_cpu = usage.ru_utime + usage.ru_stime
+
+    report = build_report(args, bots, elapsed, server_cpu)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    return report
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import argparse
+import bisect
+import copy
+import os
+import sys
+import time
+
+GAME_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(GAME_DIR, "server"))
+sys.path.append(os.path.join(GAME_DIR, "common"))
+
+from game_state import GameState
+from recording import INPUT, load_recording
+from team_layout import TeamLayout
+
+# Ticks between the keyframes kept for seeking during playback (5 seconds at 30 Hz).
+KEYFRAME_TICKS = 150
+
+# Playback speeds, slowest to fastest; the up and down arrow keys step through them.
+SPEEDS = [0.25, 0.5, 1, 2, 4, 8, 16]
+
+class Replay:
+    # Re-runs a recorded match on a real GameState, with no sockets and no rendering. Ticks without events
+    # are skipped outright, so a headless run goes as fast as the inputs can be applied.
+    # With keyframe_ticks set, a copy of the state is kept every keyframe_ticks ticks, so seek() only has to
+    # re-simulate from the nearest keyframe before the target rather than from the start.
+    def __init__(self, recording, keyframe_ticks=None):
+        self.recording = recording
+        self.keyframe_ticks = keyframe_ticks
+        # Events grouped by tick: [(tick, [(kind, player_id, dx, dy), ...]), ...] in order.
+        self.ticks = []
+        for tick, kind, player_id, dx, dy in recording.events:
+            if not self.ticks or self.ticks[-1][0] != tick:
+                self.ticks.append((tick, []))
+            self.ticks[-1][1].append((kind, player_id, dx, dy))
+        if recording.summary is not None:
+            self.end_tick = recording.summary["tick"]
+        else:
+            self.end_tick = self.ticks[-1][0] if self.ticks else 0
+        # Keyframes as parallel sorted lists: the tick each copy was taken at, and (state copy, next group).
+        self.keyframe_at = []
+        self.keyframes = []
+        self.layout = TeamLayout.from_dict(recording.grid_size, recording.layout)
+        self.reset()
+
+    # Goes back to the start of the match.
+    def reset(self):
+        self.state = GameState(self.recording.grid_size, self.recording.player_ids, seed=self.recording.seed,
+                               layout=self.layout)
+        self.next_group = 0
+
+    # Simulates forward until the state is at tick.
+    def advance_to(self, tick):
+        while self.next_group < len(self.ticks) and self.ticks[self.next_group][0] <= tick:
+            group_tick, events = self.ticks[self.next_group]
+            if self.keyframe_ticks and (not self.keyframe_at or
+                                        group_tick >= self.keyframe_at[-1] + self.keyframe_ticks):
+                self.save_keyframe()
+            # Nothing happens on the ticks in between, so jump straight to the one before this group.
+            self.state.tick = group_tick - 1
+            for kind, player_id, dx, dy in events:
+                if kind == INPUT:
+                    self.state.queue_input(player_id, None, dx, dy)
+                else:
+                    self.state.queue_removal(player_id)
+            self.state.step()
+            self.next_group += 1
+        self.state.tick = max(self.state.tick, tick)
+
+    # Keeps a copy of the current state (if it is later than the last one kept) for seek().
+    def save_keyframe(self):
+        if self.keyframe_at and self.state.tick <= self.keyframe_at[-1]:
+            return
+        self.keyframe_at.append(self.state.tick)
+        self.keyframes.append((copy.deepcopy(self.state), self.next_group))
+
+    # Moves to any tick, forwards or backwards, restarting from the latest keyframe at or before it.
+    def seek(self, tick):
+        tick = max(0, min(tick, self.end_tick))
+        if tick < self.state.tick:
+            i = bisect.bisect_right(self.keyframe_at, tick) - 1
+            if i < 0:
+                self.reset()
+            else:
+                state, next_group = self.keyframes[i]
+                self.state = copy.deepcopy(state)
+                self.next_group = next_group
+        self.advance_to(tick)
+
+    # Plays the whole match and returns the final GameState.
+    def run(self):
+        self.advance_to(self.end_tick)
+        return self.state
+
+    # Compares the current state with the recorded final state; returns a list of differences (empty if none).
+    def verify(self):
+        summary = self.recording.summary
+        if summary is None:
+            return ["recording has no final state (the match was cut off)"]
+        problems = []
+        if self.state.flag_pos != summary["flag"]:
+            problems.append(f"flag at {self.state.flag_pos}, recorded {summary['flag']}")
+        replayed = {pid: (p.pos, p.has_flag, p.score) for pid, p in self.state.players.items()}
+        for pid in sorted(set(replayed) | set(summary["players"])):
+            if replayed.get(pid) != summary["players"].get(pid):
+                problems.append(f"player {pid}: (pos, has_flag, score) {replayed.get(pid)}, "
+                                f"recorded {summary['players'].get(pid)}")
+        return problems
+
+# Shows a replay in the client's GameRenderer. Space pauses, left/right seek back or forward 5 seconds,
+# up/down change the speed (0.25x to 16x), Home restarts. Closing the window ends playback.
+def play(replay, speed=1):
+    import pygame
+    sys.path.append(os.path.join(GAME_DIR, "client"))
+    from game_renderer import GameRenderer
+
+    renderer = GameRenderer(grid_size=replay.recording.grid_size, bases=replay.state.bases)
+    tick_rate = replay.recording.tick_rate
+    speed_index = min(range(len(SPEEDS)), key=lambda i: abs(SPEEDS[i] - speed))
+    position = 0.0
+    paused = False
+    caption = None
+    last = time.perf_counter()
+    while True:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                pygame.quit()
+                return
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_SPACE:
+                    paused = not paused
+                elif event.key == pygame.K_RIGHT:
+                    position += 5 * tick_rate
+                elif event.key == pygame.K_LEFT:
+                    position -= 5 * tick_rate
+                elif event.key == pygame.K_UP:
+                    speed_index = min(speed_index + 1, len(SPEEDS) - 1)
+                elif event.key == pygame.K_DOWN:
+                    speed_index = max(speed_index - 1, 0)
+                elif event.key == pygame.K_HOME:
+                    position = 0.0
+        now = time.perf_counter()
+        if not paused:
+            position += (now - last) * tick_rate * SPEEDS[speed_index]
+        last = now
+        position = max(0.0, min(position, replay.end_tick))
+        replay.seek(int(position))
+
+        state = replay.state
+        text = (f"Replay tick {state.tick}/{replay.end_tick}  {SPEEDS[speed_index]}x"
+                f"{'  (paused)' if paused else ''}")
+        if text != caption:
+            pygame.display.set_caption(text)
+            caption = text
+        renderer.render([p.to_dict() for p in state.players.values()], state.flag_pos)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a recorded Capture the Flag match")
+    parser.add_argument("recording", help="a .ctfr file written by the server's --record-dir")
+    parser.add_argument("--play", action="store_true", help="watch the match in the game window")
+    parser.add_argument("--speed", type=float, default=1, help="initial playback speed, 0.25 to 16")
+    parser.add_argument("--repeat", type=int, default=1, help="headless runs to time (for benchmarking)")
+    return parser.parse_args(argv)
+
+# Replays a recording headless, as fast as possible, and verifies the final scores and positions.
+# Exits with status 1 if the replay doesn't match the recording. With --play, shows it in the game window instead.
+def main(argv=None):
+    args = parse_args(argv)
+    recording = load_recording(args.recording)
+    if args.play:
+        play(Replay(recording, keyframe_ticks=KEYFRAME_TICKS), args.speed)
+        return 0
+
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        replay = Replay(recording)
+        replay.run()
+    elapsed = time.perf_counter() - started
+    problems = replay.verify() if recording.summary is not None else []
+    ticks = replay.end_tick * args.repeat
+    print(f"Replayed {len(recording.events)} events over {replay.end_tick} ticks "
+          f"({replay.end_tick / recording.tick_rate:.1f}s of play) x{args.repeat} in {elapsed:.3f}s: "
+          f"{ticks / elapsed:.0f} ticks/s, {len(recording.events) * args.repeat / elapsed:.0f} events/s")
+    for pid, player in sorted(replay.state.players.items()):
+        print(f"  player {pid}: score {player.score} at {player.pos}{' with the flag' if player.has_flag else ''}")
+    if problems:
+        print("Replay does not match the recording:")
+        for problem in problems:
+            print(f"  {problem}")
+        return 1
+    if recording.summary is None:
+        print("The recording was cut off before the match ended, so there is nothing to verify against.")
+    else:
+        print("Final scores and positions match the recording.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+GAME_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(GAME_DIR, "server"))
+sys.path.append(os.path.join(GAME_DIR, "client"))
+sys.path.append(os.path.join(GAME_DIR, "common"))
+
+from async_game_server import AsyncGameServer
+from game_client import GameClient
+from game_server import GameServer
+from protocol import UDP_HEADER, UDP_HELLO, UDP_WELCOME, encode_udp_inputs
+
+DIRECTIONS = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+
+# Waits up to timeout seconds for condition() to hold; returns whether it did.
+def wait_for(condition, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+# Returns a direction a player at pos can walk three cells in, or None. Three, so a move applied twice would
+# show up as a third step.
+def open_direction(state, pos):
+    for dx, dy in DIRECTIONS:
+        cells = [(pos[0] + dx * step, pos[1] + dy * step) for step in (1, 2, 3)]
+        if all(0 <= x < state.grid_size and 0 <= y < state.grid_size and (x, y) not in state.locked_cells and
+               not state.is_cell_occupied((x, y)) for x, y in cells):
+            return dx, dy
+    return None
+
+# Joins a client, retrying while the server thread is still starting up.
+def join(port, **kwargs):
+    for _ in range(50):
+        try:
+            return GameClient("127.0.0.1", port, **kwargs)
+        except ConnectionError:
+            time.sleep(0.1)
+    return GameClient("127.0.0.1", port, **kwargs)
+
+# Sends a move over TCP, then opens the UDP channel and sends a datagram that repeats that move along with the
+# next one, as a client does when its channel comes up with the move still unacknowledged. The player has to
+# end up exactly two cells away. Returns a list of problems (empty if none).
+def check(server_class, port):
+    server = server_class("127.0.0.1", port, udp_port=port + 1)
+    threading.Thread(target=server.start, daemon=True).start()
+    host = join(port)
+    guest = join(port, room_id=host.room_id, use_udp=False)
+    if host.udp_channel is None:
+        return ["the server didn't offer a UDP channel"]
+    token = host.udp_channel.token
+    # Keep the client's own channel out of the way, so its move goes over TCP.
+    host.udp_channel.close()
+    host.udp_channel = None
+
+    room = server.rooms[host.room_id]
+    host.send_toggle_ready()
+    guest.send_toggle_ready()
+    if not wait_for(lambda: all(room.lobby_state["ready_states"][:2])):
+        return ["the players never got ready"]
+    host.send_start_request()
+    if not wait_for(lambda: room.in_game):
+        return ["the game never started"]
+
+    state = room.game_state
+    player_id = host.lobby_state["player_id"]
+    game_id = player_id + 1
+    start = state.players[game_id].pos
+    direction = open_direction(state, start)
+    if direction is None:
+        return [f"no free cells next to {start}"]
+    dx, dy = direction
+    seq = host.send_input(player_id, dx, dy)
+    if not wait_for(lambda: state.last_input_seq.get(game_id) == seq):
+        return ["the move sent over TCP was never applied"]
+
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp.settimeout(2.0)
+    try:
+        udp.sendto(UDP_HEADER.pack(UDP_HELLO, token, 1), ("127.0.0.1", port + 1))
+        kind, _, _ = UDP_HEADER.unpack_from(udp.recv(UDP_HEADER.size))
+        if kind != UDP_WELCOME:
+            return [f"the UDP hello was answered with datagram kind {kind}"]
+        udp.sendto(encode_udp_inputs(token, [(seq, dx, dy), (seq + 1, dx, dy)]), ("127.0.0.1", port + 1))
+        if not wait_for(lambda: state.last_input_seq.get(game_id) == seq + 1):
+            return ["the move sent over UDP was never applied"]
+    except (OSError, socket.timeout) as e:
+        return [f"UDP channel failed: {e}"]
+    finally:
+        udp.close()
+        host.close()
+        guest.close()
+
+    expected = (start[0] + 2 * dx, start[1] + 2 * dy)
+    pos = state.players[game_id].pos
+    if pos != expected:
+        return [f"player moved from {start} to {pos}, expected {expected}"]
+    return []
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Check that a move is applied once when it arrives over both "
+                                                 "TCP and the UDP channel")
+    parser.add_argument("--port", type=int, default=23471, help="TCP port (the UDP port is the next one)")
+    parser.add_argument("--mode", choices=["async", "threaded", "both"], default="both")
+    return parser.parse_args(argv)
+
+# Exits with status 1 if any server mode applied a move twice.
+def main(argv=None):
+    args = parse_args(argv)
+    modes = {"async": AsyncGameServer, "threaded": GameServer}
+    failed = False
+    for offset, (mode, server_class) in enumerate(modes.items()):
+        if args.mode not in (mode, "both"):
+            continue
+        problems = check(server_class, args.port + offset * 2)
+        for problem in problems:
+            print(f"{mode}: {problem}")
+        if not problems:
+            print(f"{mode}: a move repeated over UDP was applied once")
+        failed = failed or bool(problems)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())